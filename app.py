@@ -1,15 +1,19 @@
-import asyncio
+import hmac
+import json
 import os
 import time
 
 import flask
 from flask import Flask
 from kink import di
-from telebot import TeleBot, types
+from telebot import TeleBot
 from telebot.async_telebot import AsyncTeleBot
 
 import startup
 from app_config import Configuration
+from shared.metrics import Metrics, instrument_handlers
+from shared.services import (EventLoopThread, UpdateDeduplicator,
+                             UpdateDispatcher, UpdateRecorder)
 from aspire.async_bot import async_bot_functions
 from aspire.sync_bot import sync_bot_functions
 from splitwiseSdk.bot import bot_functions
@@ -29,14 +33,17 @@ else:
     sync_bot_functions(di["bot_instance"])
 
 bot_functions(di["bot_instance"])
+instrument_handlers(di["bot_instance"], *di["observers"])
 
 if isinstance(di["bot_instance"], AsyncTeleBot):
-    asyncio.run(di["bot_instance"].delete_webhook(drop_pending_updates=True))
+    di[EventLoopThread].run(
+        di["bot_instance"].delete_webhook(drop_pending_updates=True))
     time.sleep(0.5)
     if di[Configuration]["update_mode"] == "polling":
-        asyncio.run(di["bot_instance"].infinity_polling(skip_pending=True))
+        di[EventLoopThread].run(
+            di["bot_instance"].infinity_polling(skip_pending=True))
     elif di[Configuration]["update_mode"] == "webhook":
-        asyncio.run(
+        di[EventLoopThread].run(
             di["bot_instance"].set_webhook(
                 url=WEBHOOK_URL_BASE + WEBHOOK_URL_PATH)
         )
@@ -55,16 +62,37 @@ app = Flask(__name__)
 @app.route(WEBHOOK_URL_PATH, methods=["POST"])
 def receive_updates():
     if flask.request.headers.get("content-type") == "application/json":
-        json_string = flask.request.get_data().decode("utf-8")
-        update = types.Update.de_json(json_string)
-        if isinstance(di["bot_instance"], AsyncTeleBot):
-            asyncio.run(di["bot_instance"].process_new_updates([update]))
-        elif isinstance(di["bot_instance"], TeleBot):
-            di["bot_instance"].process_new_updates([update])
+        try:
+            data = json.loads(flask.request.get_data())
+        except ValueError:
+            flask.abort(400)
+        if not isinstance(data, dict) or "update_id" not in data:
+            flask.abort(400)
+        if di[UpdateRecorder] is not None:
+            di[UpdateRecorder].record(data)
+        # Telegram resends updates that were not answered in time
+        if di[UpdateDeduplicator].seen(data["update_id"]):
+            return ""
+        if not di[UpdateDispatcher].submit(data):
+            # let Telegram deliver it again later
+            di[UpdateDeduplicator].forget(data["update_id"])
+            flask.abort(503)
         return ""
     else:
         flask.abort(403)
 
 
+@app.route("/metrics")
+def metrics():
+    token = di[Configuration]["metrics_token"]
+    if not token:
+        flask.abort(404)
+    if not hmac.compare_digest(flask.request.headers.get("Authorization", "").encode(),
+                               f"Bearer {token}".encode()):
+        flask.abort(401)
+    return flask.Response(di[Metrics].render(),
+                          mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run(port=8084)
@@ -31,7 +31,29 @@ class Configuration:
             "splitwise_secret": "",
             "splitwise_token": "",
             "friend_id": "",
-            "group_id": ""
+            "group_id": "",
+            "trx_batch_size": 20,
+            "trx_batch_delay": 2.0,
+            "session_store": "memory://",
+            "session_ttl": 86400,
+            "snapshot_path": "",
+            "expense_workers": 2,
+            "expense_max_attempts": 5,
+            "outbox_path": "",
+            "update_dedup_store": "",
+            "update_workers": 4,
+            "update_queue_size": 100,
+            "update_record_path": "",
+            "trace_log": False,
+            "trace_export_path": "",
+            "trace_min_duration": 0.0,
+            "metrics_token": "",
+            "admin_ids": [],
+            "profile_mode": "",
+            "profile_dir": "",
+            "profile_keep": 10,
+            "profile_window": 3600.0,
+            "profile_interval": 0.005
         }
 
         ON_HEROKU = os.getenv("ON_HEROKU", "False").lower() in ("true", "1")
@@ -86,6 +108,48 @@ class Configuration:
         config["splitwise_token"] = os.environ.get(
             "SPLITWISE_TOKEN", "no_splitwise_token")
 
+        config["trx_batch_size"] = int(os.environ.get("TRX_BATCH_SIZE", "20"))
+        config["trx_batch_delay"] = float(
+            os.environ.get("TRX_BATCH_DELAY", "2"))
+        config["session_store"] = os.environ.get("SESSION_STORE", "memory://")
+        config["session_ttl"] = int(os.environ.get("SESSION_TTL", "86400"))
+        config["snapshot_path"] = os.environ.get(
+            "SNAPSHOT_PATH", "reference_data.snapshot")
+        config["expense_workers"] = int(
+            os.environ.get("EXPENSE_WORKERS", "2"))
+        config["expense_max_attempts"] = int(
+            os.environ.get("EXPENSE_MAX_ATTEMPTS", "5"))
+        config["outbox_path"] = os.environ.get("OUTBOX_PATH", "outbox.db")
+        config["update_dedup_store"] = os.environ.get("UPDATE_DEDUP_STORE", "")
+        config["update_workers"] = int(os.environ.get("UPDATE_WORKERS", "4"))
+        config["update_queue_size"] = int(
+            os.environ.get("UPDATE_QUEUE_SIZE", "100"))
+        config["update_record_path"] = os.environ.get("UPDATE_RECORD_PATH", "")
+        config["trace_log"] = os.getenv("TRACE_LOG", "False").lower() in (
+            "true",
+            "1",
+        )
+        config["trace_export_path"] = os.environ.get("TRACE_EXPORT_PATH", "")
+        config["trace_min_duration"] = float(
+            os.environ.get("TRACE_MIN_DURATION", "0"))
+        config["metrics_token"] = os.environ.get("METRICS_TOKEN", "")
+        config["admin_ids"] = [
+            int(i)
+            for i in list(
+                filter(
+                    None, os.environ.get("ADMIN_IDS", "").replace(
+                        " ", "").split(",")
+                )
+            )
+        ]
+        config["profile_mode"] = os.environ.get("PROFILE_MODE", "").lower()
+        config["profile_dir"] = os.environ.get("PROFILE_DIR", "profiles")
+        config["profile_keep"] = int(os.environ.get("PROFILE_KEEP", "10"))
+        config["profile_window"] = float(
+            os.environ.get("PROFILE_WINDOW", "3600"))
+        config["profile_interval"] = float(
+            os.environ.get("PROFILE_INTERVAL", "0.005"))
+
         return config
 
     def get_values(self):
@@ -1,198 +1,278 @@
+import asyncio
+from logging import Logger
+
 import shared.utils
-from kink.errors.service_error import ServiceError
 from kink import di
 from app_config import Configuration
 from telebot.async_telebot import AsyncTeleBot
 from telebot.callback_data import CallbackData
 from telebot import types
-from shared.services import Action, TextUtil, TransactionData, DateUtil, KeyboardUtil
-from gspread import Spreadsheet
+from shared.services import (QUICK_BATCH_REGEXP, Action, CallbackRouter, TextUtil, DateUtil, KeyboardUtil,
+                             Session, quick_entry_expense, quick_entry_row, resolve_quick_entry,
+                             with_session)
+from shared.profiling import UpdateProfiler
+from shared.utils import (AsyncSheets, DownloadError, ExpenseQueue, TransactionQueue, WriteDeferred,
+                          batch_summary)
 
 
 def async_bot_functions(bot_instance: AsyncTeleBot):
-    trx_categories = di["trx_categories"]
-    trx_accounts = di["trx_accounts"]
-    groups = di["groups"]
-    categories = di["categories"]
-    accounts = di["accounts"]
+    background_tasks = set()
 
     @bot_instance.message_handler(state="*", commands=["cancel", "q"])
-    async def async_cancel_trx(message: types.Message):
+    @with_session
+    async def async_cancel_trx(message: types.Message, session: Session):
         """
         Clears state and cancel current transaction
         """
-        di[TransactionData].reset()
-        message = di["current_trx_message"]
-        if await bot_instance.get_state(di["state"]):
-            await bot_instance.delete_state(di["state"])
-        await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
-            text="Transaction cancelled.",
-        )
+        await async_cancel_current(session)
+
+    async def async_cancel_current(session: Session):
+        """
+        Clears the session and marks its transaction message as cancelled
+        """
+        message_id = session.message_id
+        session.reset()
+        if message_id is not None:
+            await bot_instance.edit_message_text(
+                chat_id=session.chat_id,
+                message_id=message_id,
+                text="Transaction cancelled.",
+            )
+
+    async def async_cancel_previous(session: Session):
+        try:
+            await async_cancel_current(session)
+        except Exception as e:
+            error_msg = getattr(e, "message", repr(e))
+            if "Bad Request: message is not modified" in error_msg:
+                di[Logger].info("Previous transaction was already cancelled.")
 
     @bot_instance.message_handler(state=[Action.outflow, Action.inflow], is_digit=False)
     async def async_invalid_amt(message: types.Message):
         await bot_instance.reply_to(message, "Please enter a number")
 
-    async def async_upload_trx(message: types.Message):
+    async def async_upload_trx(message: types.Message, session: Session):
         """
         Clears state and upload transaction to sheets
         """
-        await bot_instance.delete_state(di["state"])
-        await async_upload(message)
+        session.state = None
+        await async_upload(message, session)
 
     @bot_instance.message_handler(
         state=[Action.outflow, Action.inflow, Action.memo], restrict=True
     )
-    async def async_save_current(message: types.Message):
+    @with_session
+    async def async_save_current(message: types.Message, session: Session):
         """
         Saves user input to selected option
         """
-        current_action = await bot_instance.get_state(di["state"])
-        di[TransactionData][current_action.name.capitalize()] = message.text
-        await async_item_selected(current_action, di["current_trx_message"])
+        current_action = session.state
+        session.trx[current_action.name.capitalize()] = message.text
+        await async_item_selected(current_action, session)
 
-    async def async_quick_save(message: types.Message):
-        await bot_instance.set_state(di["state"], Action.quick_end)
-        di["current_trx_message"] = await bot_instance.send_message(
+    async def async_quick_save(message: types.Message, session: Session):
+        session.state = Action.quick_end
+        session.message_id = (await bot_instance.send_message(
             chat_id=message.chat.id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
-        )
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
+        )).id
 
-    async def async_upload(message: types.Message):
+    async def async_upload(message: types.Message, session: Session):
         """
         Upload info to aspire google sheet
         """
         upload_data = [
-            di[TransactionData]["Date"],
-            di[TransactionData]["Outflow"],
-            di[TransactionData]["Inflow"],
-            di[TransactionData]["Category"],
-            di[TransactionData]["Account"],
-            di[TransactionData]["Memo"],
+            session.trx["Date"],
+            session.trx["Outflow"],
+            session.trx["Inflow"],
+            session.trx["Category"],
+            session.trx["Account"],
+            session.trx["Memo"],
         ]
-        shared.utils.append_trx(di[Spreadsheet], upload_data)
-        di[TransactionData].reset()
-        await bot_instance.reply_to(message, "✅ Transaction Saved\n")
+        session.reset()
+        reply = await bot_instance.reply_to(message, "⏳ Transaction Queued\n")
+        # wait for the write outside of the handler so the session is not held
+        task = asyncio.create_task(async_upload_done(reply, upload_data))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
-    @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
-    async def async_income_trx(message: types.Message):
+    async def async_upload_done(reply: types.Message, upload_data: list[str]):
         """
-        Add income transaction using Today's date, Inflow Amount and Memo
+        Edit the queued reply once the transaction is written
         """
         try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
-
-        result = TextUtil.text_splitter(message.text)
-        del result[0]
-        paramCount = len(result)
-        if paramCount != 2:
+            await di[AsyncSheets].append_trx(upload_data)
+        except WriteDeferred:
+            text = "⚠️ Transaction not saved yet, it will be retried automatically\n"
+        except Exception:
+            text = "❌ Transaction not saved, please try again\n"
+        else:
+            text = "✅ Transaction Saved\n"
+        await bot_instance.edit_message_text(
+            chat_id=reply.chat.id, message_id=reply.id, text=text)
+
+    @bot_instance.message_handler(regexp=QUICK_BATCH_REGEXP, restrict=True)
+    @with_session
+    async def async_batch_trx(message: types.Message, session: Session):
+        """
+        Add a transaction per AddExp, AddInc or AddSplit line, saved together once confirmed
+        """
+        await async_cancel_previous(session)
+
+        # resolving the hints may refresh the Splitwise cache, keep it off the event loop
+        entries, errors = await di[AsyncSheets].run(TextUtil.parse_quick_entries, message.text)
+        summary = TextUtil.format_batch(entries, errors)
+        if not entries:
             await bot_instance.reply_to(
-                message, f"Expected 2 parameters, received {paramCount}: [{result}]"
-            )
+                message, f"No transactions to save\n{summary}", parse_mode="")
             return
-        else:
-            inflow, memo = result
-            try:
-                inflow = float(inflow)
-            except ValueError:
-                await async_invalid_amt(message)
-            else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Inflow"] = inflow
-                di[TransactionData]["Memo"] = memo
-                await async_quick_save(message)
+        session.state = Action.batch_end
+        session.batch = entries
+        # memos are user input, send them without markdown parsing
+        session.message_id = (await bot_instance.send_message(
+            chat_id=message.chat.id,
+            text=f"Save {len(entries)} transactions?\n{summary}",
+            reply_markup=KeyboardUtil.create_batch_keyboard(),
+            parse_mode="",
+        )).id
 
-    @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
-    async def async_expense_trx(message: types.Message):
+    @bot_instance.callback_query_handler(
+        func=lambda c: c.data == "batch_save", state=Action.batch_end
+    )
+    @with_session
+    async def async_save_batch(call: types.CallbackQuery, session: Session):
+        """
+        Write the rows of the batch with one append and submit its splits concurrently
         """
-        Add expense transaction using Today's date, Outflow Amount and Memo
+        entries = session.batch
+        session.reset()
+        await bot_instance.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.id,
+            text=f"⏳ Saving {len(entries)} transactions...",
+        )
+        task = asyncio.create_task(async_batch_done(call.message, entries))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    async def async_batch_done(reply: types.Message, entries: list[dict]):
+        """
+        Edit the batch message once every transaction is saved or given up on
+        """
+        rows = [entry for entry in entries if entry["kind"] != "split"]
+        splits = [entry for entry in entries if entry["kind"] == "split"]
+
+        async def save_rows():
+            if rows:
+                await di[AsyncSheets].append_trx_rows([quick_entry_row(entry) for entry in rows])
+
+        expenses = await di[AsyncSheets].run(
+            lambda: [quick_entry_expense(entry) for entry in splits])
+        results = await asyncio.gather(
+            save_rows(),
+            *[asyncio.wrap_future(di[ExpenseQueue].put(expense)) for expense in expenses],
+            return_exceptions=True,
+        )
+        errors = [result if isinstance(result, BaseException) else None
+                  for result in results]
+        outcomes = [(TextUtil.describe_entry(entry), errors[0]) for entry in rows]
+        outcomes += [(TextUtil.describe_entry(entry), error)
+                     for entry, error in zip(splits, errors[1:])]
+        await bot_instance.edit_message_text(
+            chat_id=reply.chat.id,
+            message_id=reply.id,
+            text=batch_summary(outcomes),
+            parse_mode="",
+        )
+
+    @bot_instance.callback_query_handler(
+        func=lambda c: c.data == "batch_cancel", state=Action.batch_end
+    )
+    @with_session
+    async def async_cancel_batch(call: types.CallbackQuery, session: Session):
+        session.message_id = call.message.id
+        await async_cancel_current(session)
+
+    async def async_quick_entry(message: types.Message, session: Session):
+        """
+        Fill the transaction from a quick add line and show it for saving
         """
         try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
-
-        result = TextUtil.text_splitter(message.text)
-        del result[0]
-        paramCount = len(result)
-        if paramCount != 2:
-            await bot_instance.reply_to(
-                message, f"Expected 2 parameters, received {paramCount}: [{result}]"
-            )
+            entry = await di[AsyncSheets].run(
+                resolve_quick_entry, TextUtil.parse_quick_entry(message.text))
+        except ValueError as e:
+            await bot_instance.reply_to(message, f"❌ {e}", parse_mode="")
             return
-        else:
-            outflow, memo = result
-            try:
-                outflow = float(outflow)
-            except ValueError:
-                await async_invalid_amt(message)
-            else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Outflow"] = outflow
-                di[TransactionData]["Memo"] = memo
-                await async_quick_save(message)
+        session.trx["Date"] = entry.date or DateUtil.date_today()
+        session.trx[entry.kind.capitalize()] = entry.amount
+        session.trx["Memo"] = entry.memo
+        session.trx["Category"] = entry.category or ""
+        session.trx["Account"] = entry.account or ""
+        await async_quick_save(message, session)
+
+    @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
+    @with_session
+    async def async_income_trx(message: types.Message, session: Session):
+        """
+        Add income transaction from Inflow Amount and Memo, optionally a date, #Category and @Account
+        """
+        await async_cancel_previous(session)
+
+        await async_quick_entry(message, session)
+
+    @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
+    @with_session
+    async def async_expense_trx(message: types.Message, session: Session):
+        """
+        Add expense transaction from Outflow Amount and Memo, optionally a date, #Category and @Account
+        """
+        await async_cancel_previous(session)
+
+        await async_quick_entry(message, session)
 
     @bot_instance.callback_query_handler(
         func=lambda c: c.data == "back;category", state=Action.category_list
     )
-    async def async_back_to_category_groups_menu(call: types.CallbackQuery):
+    @with_session
+    async def async_back_to_category_groups_menu(call: types.CallbackQuery, session: Session):
         """
         Return to category groups selection menu
         """
-        await bot_instance.set_state(di["state"], Action.category)
-        await category_select_start(call.message)
+        session.state = Action.category
+        await category_select_start(session)
 
-    async def category_select_start(message: types.Message):
+    async def category_select_start(session: Session):
         # Creates a keyboard, each key has a callback_data : group_sel;"group name" e.g. group_sel:"Expenses"
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Group:",
-            reply_markup=shared.utils.create_category_inline(
-                trx_categories.keys(), "group_sel"
-            ),
+            reply_markup=KeyboardUtil.create_category_group_keyboard(),
         )
 
-    async def account_sel_start(message: types.Message):
+    async def account_sel_start(session: Session):
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Account:",
-            reply_markup=shared.utils.create_account_inline(
-                trx_accounts, "acc_sel"),
+            reply_markup=KeyboardUtil.create_account_keyboard(),
         )
 
-    async def date_sel_start(message: types.Message):
+    async def date_sel_start(session: Session):
         await bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Date:",
-            reply_markup=shared.utils.create_calendar(),
+            reply_markup=KeyboardUtil.create_calendar_keyboard(),
         )
 
-    async def async_item_selected(action: Action, message: types.Message):
+    async def async_item_selected(action: Action, session: Session):
         """
         Process item selected through /start command
         """
-        await bot_instance.set_state(di["state"], action)
-        data = di[TransactionData][action.name.capitalize()]
+        session.state = action
+        data = session.trx[action.name.capitalize()]
 
         if action == Action.outflow or action == Action.inflow:
             displayData = (
@@ -203,11 +283,11 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             displayData = data if data != "" else "''"
 
         if action == Action.category:
-            await category_select_start(message)
+            await category_select_start(session)
         elif action == Action.account:
-            await account_sel_start(message)
+            await account_sel_start(session)
         elif action == Action.date:
-            await date_sel_start(message)
+            await date_sel_start(session)
         else:
             text = (
                 f"\[Current Value: "
@@ -216,8 +296,8 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
                 + f"Enter {action.name.capitalize()} : "
             )
             await bot_instance.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=message.id,
+                chat_id=session.chat_id,
+                message_id=session.message_id,
                 text=text,
                 reply_markup=KeyboardUtil.create_save_keyboard("save"),
             )
@@ -228,71 +308,74 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
         state=[Action.start, Action.quick_end],
         restrict=True,
     )
-    async def async_actions_callback(call: types.CallbackQuery):
+    @with_session
+    async def async_actions_callback(call: types.CallbackQuery, session: Session):
         """
         Read and save state of bot depending on item selected from /start command
         """
         callback_data: dict = di[CallbackData].parse(callback_data=call.data)
         actionId = int(callback_data["action_id"])
         action = Action(actionId)
+        session.message_id = call.message.id
 
         if action == Action.cancel:
-            await async_cancel_trx(di["current_trx_message"])
+            await async_cancel_current(session)
         elif action == Action.done:
-            await async_upload_trx(call.message)
+            await async_upload_trx(call.message, session)
         else:
-            await async_item_selected(action, call.message)
+            await async_item_selected(action, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in categories, state=Action.category_list, restrict=True
+        func=None, route="save", state=Action.category_list, restrict=True
     )
-    async def async_get_category(call: types.CallbackQuery):
+    @with_session
+    async def async_get_category(call: types.CallbackQuery, session: Session):
         """
         Get user selection and store to Category
         """
-        action, choice = shared.utils.separate_callback_data(call.data)
-        di[TransactionData]["Category"] = choice
-        await async_save_callback(call)
+        action, choice = di[CallbackRouter].resolve(call)
+        session.trx["Category"] = choice
+        await async_save_callback(call, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in accounts, state=Action.account, restrict=True
+        func=None, route="acc_sel", state=Action.account, restrict=True
     )
-    async def async_get_account(call: types.CallbackQuery):
+    @with_session
+    async def async_get_account(call: types.CallbackQuery, session: Session):
         """
         Read user input and store to Account
         """
-        action, choice = shared.utils.separate_callback_data(call.data)
-        di[TransactionData]["Account"] = choice
-        await async_save_callback(call)
+        action, choice = di[CallbackRouter].resolve(call)
+        session.trx["Account"] = choice
+        await async_save_callback(call, session)
 
     @bot_instance.callback_query_handler(func=None, state=Action.date)
-    async def async_get_date(call: types.CallbackQuery):
+    @with_session
+    async def async_get_date(call: types.CallbackQuery, session: Session):
         """
         Read user selection from calendar and store to Date
         """
         selected, date = await shared.utils.async_process_calendar_selection(
-            call, bot_instance
-        )
+            call, bot_instance)
         if selected:
-            di[TransactionData]["Date"] = date.strftime("%m/%d/%Y")
-            await async_save_callback(call)
+            session.trx["Date"] = date.strftime("%m/%d/%Y")
+            await async_save_callback(call, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in groups, state=Action.category
+        func=None, route="group_sel", state=Action.category
     )
-    async def async_list_categories(call: types.CallbackQuery):
+    @with_session
+    async def async_list_categories(call: types.CallbackQuery, session: Session):
         """
         Show categories as InlineKeyboard
         """
-        await bot_instance.set_state(di["state"], Action.category_list)
-        action, choice = shared.utils.separate_callback_data(call.data)
+        session.state = Action.category_list
+        action, choice = di[CallbackRouter].resolve(call)
         await bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Select Category:",
-            reply_markup=shared.utils.create_category_inline(
-                trx_categories[choice], "save"
-            ),
+            reply_markup=KeyboardUtil.create_category_keyboard(choice),
         )
 
     @bot_instance.callback_query_handler(
@@ -306,47 +389,125 @@ def async_bot_functions(bot_instance: AsyncTeleBot):
             Action.date,
         ],
     )
-    async def async_save_callback(call: types.CallbackQuery):
+    @with_session
+    async def async_save_callback(call: types.CallbackQuery, session: Session):
         """
         Return to main menu of /start command showing new saved values
         """
-        await bot_instance.set_state(di["state"], Action.start)
+        session.state = Action.start
         await bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
 
     @bot_instance.callback_query_handler(
         func=lambda c: c.data == "quick_save", state=Action.quick_end
     )
-    async def async_savequick_callback(call: types.CallbackQuery):
+    @with_session
+    async def async_savequick_callback(call: types.CallbackQuery, session: Session):
         """
         Clears state and upload to sheets for quick add functions
         """
-        await bot_instance.delete_state(di["state"])
-        await async_upload(call.message)
+        session.state = None
+        await async_upload(call.message, session)
+
+    @bot_instance.message_handler(commands=["profile"], restrict=True, admin=True)
+    async def async_profile_summary(message: types.Message):
+        """
+        Show the slowest updates kept by the profiler and their hot spots
+        """
+        profiler = di[UpdateProfiler]
+        await bot_instance.reply_to(
+            message,
+            profiler.summary() if profiler is not None else "Profiling is off, set PROFILE_MODE to turn it on",
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(commands=["import"], restrict=True)
+    @with_session
+    async def async_import_start(message: types.Message, session: Session):
+        """
+        Ask for a CSV file of transactions to import
+        """
+        await async_cancel_previous(session)
+        session.state = Action.import_file
+        await bot_instance.reply_to(
+            message,
+            "Send a CSV file with Date, Outflow and Inflow (or a signed Amount), Category, Account and Memo columns. "
+            "The file caption is used as the account of rows without one.",
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(
+        content_types=["document"], state=Action.import_file, restrict=True
+    )
+    @with_session
+    async def async_import_document(message: types.Message, session: Session):
+        """
+        Import the uploaded CSV in the background, editing one message with the progress
+        """
+        session.reset()
+        reply = await bot_instance.reply_to(message, "⏳ Importing transactions...")
+        url = await bot_instance.get_file_url(message.document.file_id)
+        task = asyncio.create_task(async_import_trx(reply, url, message.caption))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    async def async_import_trx(reply: types.Message, url: str, default_account: str):
+        loop = asyncio.get_running_loop()
+        imported = 0
+
+        async def edit(text):
+            await bot_instance.edit_message_text(
+                chat_id=reply.chat.id, message_id=reply.id, text=text, parse_mode="")
+
+        def progress(count, skipped):
+            # called from the Sheets thread
+            nonlocal imported
+            imported = count
+            asyncio.run_coroutine_threadsafe(
+                edit(f"⏳ Imported {count} transactions, skipped {skipped}..."), loop).result()
+
+        sheets = di[AsyncSheets]
+        try:
+            result = await sheets.run(
+                shared.utils.import_trx_rows,
+                shared.utils.stream_lines(url),
+                di["trx_categories"],
+                di["trx_accounts"],
+                # through the queue, so the rows are journaled in the outbox
+                lambda rows: di[TransactionQueue].put_many(rows).result(),
+                default_account=default_account,
+                progress=progress,
+            )
+        except WriteDeferred as e:
+            di[Logger].error(f"Import failed: {e}")
+            await edit(f"⚠️ Import stopped after {imported} transactions, "
+                       f"the last rows read will be saved automatically: {e}")
+        except DownloadError as e:
+            di[Logger].error(f"Import failed, could not download the file: {e}")
+            await edit(f"❌ Import stopped after {imported} transactions, "
+                       "could not download the file")
+        except Exception as e:
+            di[Logger].error(f"Import failed: {e}")
+            await edit(f"❌ Import stopped after {imported} transactions: {e}")
+        else:
+            await edit(shared.utils.import_summary(result))
 
     @bot_instance.message_handler(commands=["start", "s"], restrict=True)
-    async def async_command_start(message: types.Message):
+    @with_session
+    async def async_command_start(message: types.Message, session: Session):
         """
         Start the conversation and ask user for input.
         Initialize with options to fill in.
         """
-        try:
-            await async_cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        await bot_instance.set_state(di["state"], Action.start)
-        di[TransactionData]["Date"] = DateUtil.date_today()
-        di["current_trx_message"] = await bot_instance.send_message(
+        await async_cancel_previous(session)
+        session.state = Action.start
+        session.trx["Date"] = DateUtil.date_today()
+        session.message_id = (await bot_instance.send_message(
             message.chat.id,
             "Select Option:",
             reply_markup=KeyboardUtil.create_default_options_keyboard(),
-        )
+        )).id
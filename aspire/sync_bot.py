@@ -1,198 +1,265 @@
+import threading
+from concurrent.futures import Future
+from logging import Logger
+
 import shared.utils
-from kink.errors.service_error import ServiceError
 from kink import di
 from app_config import Configuration
 from telebot.callback_data import CallbackData
 from telebot import TeleBot, types
-from shared.services import Action, TextUtil, TransactionData, DateUtil, KeyboardUtil
-from gspread import Spreadsheet
+from shared.services import (QUICK_BATCH_REGEXP, Action, CallbackRouter, TextUtil, DateUtil, KeyboardUtil,
+                             Session, quick_entry_expense, quick_entry_row, resolve_quick_entry,
+                             with_session)
+from shared.profiling import UpdateProfiler
+from shared.utils import (DownloadError, ExpenseQueue, ReplyEditor, TransactionQueue, WriteDeferred,
+                          batch_summary, when_all)
 
 
 def sync_bot_functions(bot_instance: TeleBot):
-    trx_categories = di["trx_categories"]
-    trx_accounts = di["trx_accounts"]
-    groups = di["groups"]
-    categories = di["categories"]
-    accounts = di["accounts"]
-
     @bot_instance.message_handler(state="*", commands=["cancel", "q"])
-    def cancel_trx(message: types.Message):
+    @with_session
+    def cancel_trx(message: types.Message, session: Session):
         """
         Clears state and cancel current transaction
         """
-        di[TransactionData].reset()
-        message = di["current_trx_message"]
-        if bot_instance.get_state(di["state"]):
-            bot_instance.delete_state(di["state"])
-        bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
-            text="Transaction cancelled.",
-        )
+        cancel_current(session)
+
+    def cancel_current(session: Session):
+        """
+        Clears the session and marks its transaction message as cancelled
+        """
+        message_id = session.message_id
+        session.reset()
+        if message_id is not None:
+            bot_instance.edit_message_text(
+                chat_id=session.chat_id,
+                message_id=message_id,
+                text="Transaction cancelled.",
+            )
+
+    def cancel_previous(session: Session):
+        try:
+            cancel_current(session)
+        except Exception as e:
+            error_msg = getattr(e, "message", repr(e))
+            if "Bad Request: message is not modified" in error_msg:
+                di[Logger].info("Previous transaction was already cancelled.")
 
     @bot_instance.message_handler(state=[Action.outflow, Action.inflow], is_digit=False)
     def invalid_amt(message: types.Message):
         bot_instance.reply_to(message, "Please enter a number")
 
-    def upload_trx(message: types.Message):
+    def upload_trx(message: types.Message, session: Session):
         """
         Clears state and upload transaction to sheets
         """
-        bot_instance.delete_state(di["state"])
-        upload(message)
+        session.state = None
+        upload(message, session)
 
     @bot_instance.message_handler(
         state=[Action.outflow, Action.inflow, Action.memo], restrict=True
     )
-    def save_current(message: types.Message):
+    @with_session
+    def save_current(message: types.Message, session: Session):
         """
         Saves user input to selected option
         """
-        current_action = bot_instance.get_state(di["state"])
-        di[TransactionData][current_action.name.capitalize()] = message.text
-        item_selected(current_action, di["current_trx_message"])
+        current_action = session.state
+        session.trx[current_action.name.capitalize()] = message.text
+        item_selected(current_action, session)
 
-    def quick_save(message: types.Message):
-        bot_instance.set_state(di["state"], Action.quick_end)
-        di["current_trx_message"] = bot_instance.send_message(
+    def quick_save(message: types.Message, session: Session):
+        session.state = Action.quick_end
+        session.message_id = bot_instance.send_message(
             chat_id=message.chat.id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
-        )
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
+        ).id
 
-    def upload(message: types.Message):
+    def upload(message: types.Message, session: Session):
         """
         Upload info to aspire google sheet
         """
         upload_data = [
-            di[TransactionData]["Date"],
-            di[TransactionData]["Outflow"],
-            di[TransactionData]["Inflow"],
-            di[TransactionData]["Category"],
-            di[TransactionData]["Account"],
-            di[TransactionData]["Memo"],
+            session.trx["Date"],
+            session.trx["Outflow"],
+            session.trx["Inflow"],
+            session.trx["Category"],
+            session.trx["Account"],
+            session.trx["Memo"],
         ]
-        shared.utils.append_trx(di[Spreadsheet], upload_data)
-        di[TransactionData].reset()
-        bot_instance.reply_to(message, "✅ Transaction Saved\n")
+        future = di[TransactionQueue].put(upload_data)
+        session.reset()
+        reply = bot_instance.reply_to(message, "⏳ Transaction Queued\n")
+        di[ReplyEditor].when_done(future, lambda f: upload_done(reply, f))
 
-    @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
-    def income_trx(message: types.Message):
+    def upload_done(reply: types.Message, future: Future):
         """
-        Add income transaction using Today's date, Inflow Amount and Memo
+        Edit the queued reply once the transaction is written
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
-
-        result = TextUtil.text_splitter(message.text)
-        del result[0]
-        paramCount = len(result)
-        if paramCount != 2:
+        error = future.exception()
+        if error is None:
+            text = "✅ Transaction Saved\n"
+        elif isinstance(error, WriteDeferred):
+            text = "⚠️ Transaction not saved yet, it will be retried automatically\n"
+        else:
+            text = "❌ Transaction not saved, please try again\n"
+        bot_instance.edit_message_text(
+            chat_id=reply.chat.id,
+            message_id=reply.id,
+            text=text,
+        )
+
+    @bot_instance.message_handler(regexp=QUICK_BATCH_REGEXP, restrict=True)
+    @with_session
+    def batch_trx(message: types.Message, session: Session):
+        """
+        Add a transaction per AddExp, AddInc or AddSplit line, saved together once confirmed
+        """
+        cancel_previous(session)
+
+        entries, errors = TextUtil.parse_quick_entries(message.text)
+        summary = TextUtil.format_batch(entries, errors)
+        if not entries:
             bot_instance.reply_to(
-                message, f"Expected 2 parameters, received {paramCount}: [{result}]"
-            )
+                message, f"No transactions to save\n{summary}", parse_mode="")
             return
-        else:
-            inflow, memo = result
-            try:
-                inflow = float(inflow)
-            except ValueError:
-                invalid_amt(message)
-            else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Inflow"] = inflow
-                di[TransactionData]["Memo"] = memo
-                quick_save(message)
+        session.state = Action.batch_end
+        session.batch = entries
+        # memos are user input, send them without markdown parsing
+        session.message_id = bot_instance.send_message(
+            chat_id=message.chat.id,
+            text=f"Save {len(entries)} transactions?\n{summary}",
+            reply_markup=KeyboardUtil.create_batch_keyboard(),
+            parse_mode="",
+        ).id
 
-    @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
-    def expense_trx(message: types.Message):
+    @bot_instance.callback_query_handler(
+        func=lambda c: c.data == "batch_save", state=Action.batch_end
+    )
+    @with_session
+    def save_batch(call: types.CallbackQuery, session: Session):
+        """
+        Write the rows of the batch with one append and queue its splits at once
+        """
+        entries = session.batch
+        session.reset()
+        rows = [entry for entry in entries if entry["kind"] != "split"]
+        splits = [entry for entry in entries if entry["kind"] == "split"]
+        futures = []
+        if rows:
+            future = di[TransactionQueue].put_many(
+                [quick_entry_row(entry) for entry in rows])
+            futures.extend((entry, future) for entry in rows)
+        for entry in splits:
+            futures.append(
+                (entry, di[ExpenseQueue].put(quick_entry_expense(entry))))
+        bot_instance.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.id,
+            text=f"⏳ Saving {len(entries)} transactions...",
+        )
+        di[ReplyEditor].when_done(when_all([future for _, future in futures]),
+                                  lambda f: batch_done(call.message, futures))
+
+    def batch_done(reply: types.Message, futures: list[tuple[dict, Future]]):
         """
-        Add expense transaction using Today's date, Outflow Amount and Memo
+        Edit the batch message once every transaction is saved or given up on
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
+        bot_instance.edit_message_text(
+            chat_id=reply.chat.id,
+            message_id=reply.id,
+            text=batch_summary([(TextUtil.describe_entry(entry), future.exception())
+                                for entry, future in futures]),
+            parse_mode="",
+        )
 
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+    @bot_instance.callback_query_handler(
+        func=lambda c: c.data == "batch_cancel", state=Action.batch_end
+    )
+    @with_session
+    def cancel_batch(call: types.CallbackQuery, session: Session):
+        session.message_id = call.message.id
+        cancel_current(session)
 
-        result = TextUtil.text_splitter(message.text)
-        del result[0]
-        paramCount = len(result)
-        if paramCount != 2:
-            bot_instance.reply_to(
-                message, f"Expected 2 parameters, received {paramCount}: [{result}]"
-            )
+    def quick_entry(message: types.Message, session: Session):
+        """
+        Fill the transaction from a quick add line and show it for saving
+        """
+        try:
+            entry = resolve_quick_entry(TextUtil.parse_quick_entry(message.text))
+        except ValueError as e:
+            bot_instance.reply_to(message, f"❌ {e}", parse_mode="")
             return
-        else:
-            outflow, memo = result
-            try:
-                outflow = float(outflow)
-            except ValueError:
-                invalid_amt(message)
-            else:
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Outflow"] = outflow
-                di[TransactionData]["Memo"] = memo
-                quick_save(message)
+        session.trx["Date"] = entry.date or DateUtil.date_today()
+        session.trx[entry.kind.capitalize()] = entry.amount
+        session.trx["Memo"] = entry.memo
+        session.trx["Category"] = entry.category or ""
+        session.trx["Account"] = entry.account or ""
+        quick_save(message, session)
+
+    @bot_instance.message_handler(regexp="^(A|a)dd(I|i)nc.+$", restrict=True)
+    @with_session
+    def income_trx(message: types.Message, session: Session):
+        """
+        Add income transaction from Inflow Amount and Memo, optionally a date, #Category and @Account
+        """
+        cancel_previous(session)
+
+        quick_entry(message, session)
+
+    @bot_instance.message_handler(regexp="^(A|a)dd(E|e)xp.+$", restrict=True)
+    @with_session
+    def expense_trx(message: types.Message, session: Session):
+        """
+        Add expense transaction from Outflow Amount and Memo, optionally a date, #Category and @Account
+        """
+        cancel_previous(session)
+
+        quick_entry(message, session)
 
     @bot_instance.callback_query_handler(
         func=lambda c: c.data == "back;category", state=Action.category_list
     )
-    def back_to_category_groups_menu(call: types.CallbackQuery):
+    @with_session
+    def back_to_category_groups_menu(call: types.CallbackQuery, session: Session):
         """
         Return to category groups selection menu
         """
-        bot_instance.set_state(di["state"], Action.category)
-        category_select_start(call.message)
+        session.state = Action.category
+        category_select_start(session)
 
-    def category_select_start(message: types.Message):
+    def category_select_start(session: Session):
         # Creates a keyboard, each key has a callback_data : group_sel;"group name" e.g. group_sel:"Expenses"
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Group:",
-            reply_markup=shared.utils.create_category_inline(
-                trx_categories.keys(), "group_sel"
-            ),
+            reply_markup=KeyboardUtil.create_category_group_keyboard(),
         )
 
-    def account_sel_start(message: types.Message):
+    def account_sel_start(session: Session):
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Account:",
-            reply_markup=shared.utils.create_account_inline(
-                trx_accounts, "acc_sel"),
+            reply_markup=KeyboardUtil.create_account_keyboard(),
         )
 
-    def date_sel_start(message: types.Message):
+    def date_sel_start(session: Session):
         bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
+            chat_id=session.chat_id,
+            message_id=session.message_id,
             text="Select Date:",
-            reply_markup=shared.utils.create_calendar(),
+            reply_markup=KeyboardUtil.create_calendar_keyboard(),
         )
 
-    def item_selected(action: Action, message: types.Message):
+    def item_selected(action: Action, session: Session):
         """
         Process item selected through /start command
         """
-        bot_instance.set_state(di["state"], action)
-        data = di[TransactionData][action.name.capitalize()]
+        session.state = action
+        data = session.trx[action.name.capitalize()]
 
         if action == Action.outflow or action == Action.inflow:
             displayData = (
@@ -203,11 +270,11 @@ def sync_bot_functions(bot_instance: TeleBot):
             displayData = data if data != "" else "''"
 
         if action == Action.category:
-            category_select_start(message)
+            category_select_start(session)
         elif action == Action.account:
-            account_sel_start(message)
+            account_sel_start(session)
         elif action == Action.date:
-            date_sel_start(message)
+            date_sel_start(session)
         else:
             text = (
                 f"\[Current Value: "
@@ -216,8 +283,8 @@ def sync_bot_functions(bot_instance: TeleBot):
                 + f"Enter {action.name.capitalize()} : "
             )
             bot_instance.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=message.id,
+                chat_id=session.chat_id,
+                message_id=session.message_id,
                 text=text,
                 reply_markup=KeyboardUtil.create_save_keyboard("save"),
             )
@@ -228,70 +295,74 @@ def sync_bot_functions(bot_instance: TeleBot):
         state=[Action.start, Action.quick_end],
         restrict=True,
     )
-    def actions_callback(call: types.CallbackQuery):
+    @with_session
+    def actions_callback(call: types.CallbackQuery, session: Session):
         """
         Read and save state of bot depending on item selected from /start command
         """
         callback_data: dict = di[CallbackData].parse(callback_data=call.data)
         actionId = int(callback_data["action_id"])
         action = Action(actionId)
+        session.message_id = call.message.id
 
         if action == Action.cancel:
-            cancel_trx(di["current_trx_message"])
+            cancel_current(session)
         elif action == Action.done:
-            upload_trx(call.message)
+            upload_trx(call.message, session)
         else:
-            item_selected(action, call.message)
+            item_selected(action, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in categories, state=Action.category_list, restrict=True
+        func=None, route="save", state=Action.category_list, restrict=True
     )
-    def get_category(call: types.CallbackQuery):
+    @with_session
+    def get_category(call: types.CallbackQuery, session: Session):
         """
         Get user selection and store to Category
         """
-        action, choice = shared.utils.separate_callback_data(call.data)
-        di[TransactionData]["Category"] = choice
-        save_callback(call)
+        action, choice = di[CallbackRouter].resolve(call)
+        session.trx["Category"] = choice
+        save_callback(call, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in accounts, state=Action.account, restrict=True
+        func=None, route="acc_sel", state=Action.account, restrict=True
     )
-    def get_account(call: types.CallbackQuery):
+    @with_session
+    def get_account(call: types.CallbackQuery, session: Session):
         """
         Read user input and store to Account
         """
-        action, choice = shared.utils.separate_callback_data(call.data)
-        di[TransactionData]["Account"] = choice
-        save_callback(call)
+        action, choice = di[CallbackRouter].resolve(call)
+        session.trx["Account"] = choice
+        save_callback(call, session)
 
     @bot_instance.callback_query_handler(func=None, state=Action.date)
-    def get_date(call: types.CallbackQuery):
+    @with_session
+    def get_date(call: types.CallbackQuery, session: Session):
         """
         Read user selection from calendar and store to Date
         """
         selected, date = shared.utils.process_calendar_selection(
             call, bot_instance)
         if selected:
-            di[TransactionData]["Date"] = date.strftime("%m/%d/%Y")
-            save_callback(call)
+            session.trx["Date"] = date.strftime("%m/%d/%Y")
+            save_callback(call, session)
 
     @bot_instance.callback_query_handler(
-        func=lambda c: c.data in groups, state=Action.category
+        func=None, route="group_sel", state=Action.category
     )
-    def list_categories(call: types.CallbackQuery):
+    @with_session
+    def list_categories(call: types.CallbackQuery, session: Session):
         """
         Show categories as InlineKeyboard
         """
-        bot_instance.set_state(di["state"], Action.category_list)
-        action, choice = shared.utils.separate_callback_data(call.data)
+        session.state = Action.category_list
+        action, choice = di[CallbackRouter].resolve(call)
         bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Select Category:",
-            reply_markup=shared.utils.create_category_inline(
-                trx_categories[choice], "save"
-            ),
+            reply_markup=KeyboardUtil.create_category_keyboard(choice),
         )
 
     @bot_instance.callback_query_handler(
@@ -305,47 +376,120 @@ def sync_bot_functions(bot_instance: TeleBot):
             Action.date,
         ],
     )
-    def save_callback(call: types.CallbackQuery):
+    @with_session
+    def save_callback(call: types.CallbackQuery, session: Session):
         """
         Return to main menu of /start command showing new saved values
         """
-        bot_instance.set_state(di["state"], Action.start)
+        session.state = Action.start
         bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
             text="Current Transaction:",
-            reply_markup=KeyboardUtil.create_options_keyboard(),
+            reply_markup=KeyboardUtil.create_options_keyboard(session.trx),
         )
 
     @bot_instance.callback_query_handler(
         func=lambda c: c.data == "quick_save", state=Action.quick_end
     )
-    def savequick_callback(call: types.CallbackQuery):
+    @with_session
+    def savequick_callback(call: types.CallbackQuery, session: Session):
         """
         Clears state and upload to sheets for quick add functions
         """
-        bot_instance.delete_state(di["state"])
-        upload(call.message)
+        session.state = None
+        upload(call.message, session)
+
+    @bot_instance.message_handler(commands=["profile"], restrict=True, admin=True)
+    def profile_summary(message: types.Message):
+        """
+        Show the slowest updates kept by the profiler and their hot spots
+        """
+        profiler = di[UpdateProfiler]
+        bot_instance.reply_to(
+            message,
+            profiler.summary() if profiler is not None else "Profiling is off, set PROFILE_MODE to turn it on",
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(commands=["import"], restrict=True)
+    @with_session
+    def import_start(message: types.Message, session: Session):
+        """
+        Ask for a CSV file of transactions to import
+        """
+        cancel_previous(session)
+        session.state = Action.import_file
+        bot_instance.reply_to(
+            message,
+            "Send a CSV file with Date, Outflow and Inflow (or a signed Amount), Category, Account and Memo columns. "
+            "The file caption is used as the account of rows without one.",
+            parse_mode="",
+        )
+
+    @bot_instance.message_handler(
+        content_types=["document"], state=Action.import_file, restrict=True
+    )
+    @with_session
+    def import_document(message: types.Message, session: Session):
+        """
+        Import the uploaded CSV in the background, editing one message with the progress
+        """
+        session.reset()
+        reply = bot_instance.reply_to(message, "⏳ Importing transactions...")
+        url = bot_instance.get_file_url(message.document.file_id)
+        threading.Thread(
+            target=import_trx, args=(reply, url, message.caption), name="trx-import", daemon=True
+        ).start()
+
+    def import_trx(reply: types.Message, url: str, default_account: str):
+        imported = 0
+
+        def edit(text):
+            bot_instance.edit_message_text(
+                chat_id=reply.chat.id, message_id=reply.id, text=text, parse_mode="")
+
+        def progress(count, skipped):
+            nonlocal imported
+            imported = count
+            edit(f"⏳ Imported {count} transactions, skipped {skipped}...")
+
+        try:
+            result = shared.utils.import_trx_rows(
+                shared.utils.stream_lines(url),
+                di["trx_categories"],
+                di["trx_accounts"],
+                # through the queue, so the rows are journaled in the outbox
+                lambda rows: di[TransactionQueue].put_many(rows).result(),
+                default_account=default_account,
+                progress=progress,
+            )
+        except WriteDeferred as e:
+            di[Logger].error(f"Import failed: {e}")
+            edit(f"⚠️ Import stopped after {imported} transactions, "
+                 f"the last rows read will be saved automatically: {e}")
+        except DownloadError as e:
+            di[Logger].error(f"Import failed, could not download the file: {e}")
+            edit(f"❌ Import stopped after {imported} transactions, "
+                 "could not download the file")
+        except Exception as e:
+            di[Logger].error(f"Import failed: {e}")
+            edit(f"❌ Import stopped after {imported} transactions: {e}")
+        else:
+            edit(shared.utils.import_summary(result))
 
     @bot_instance.message_handler(commands=["start", "s"], restrict=True)
-    def command_start(message: types.Message):
+    @with_session
+    def command_start(message: types.Message, session: Session):
         """
         Start the conversation and ask user for input.
         Initialize with options to fill in.
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-        di["state"] = message.from_user.id
-        bot_instance.set_state(di["state"], Action.start)
-        di[TransactionData]["Date"] = DateUtil.date_today()
-        di["current_trx_message"] = bot_instance.send_message(
+        cancel_previous(session)
+        session.state = Action.start
+        session.trx["Date"] = DateUtil.date_today()
+        session.message_id = bot_instance.send_message(
             message.chat.id,
             "Select Option:",
             reply_markup=KeyboardUtil.create_default_options_keyboard(),
-        )
+        ).id
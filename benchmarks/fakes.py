@@ -0,0 +1,232 @@
+"""
+In-process stand-ins for the Telegram Bot API, Google Sheets and Splitwise, each
+answering after a configurable latency so handlers can be measured offline.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+
+from gspread import utils
+from gspread.cell import Cell
+from splitwise.category import Category
+from splitwise.currency import Currency
+from splitwise.group import Group
+from telebot import apihelper, asyncio_helper
+
+CATEGORY_GROUPS = {
+    "Living": ["Rent", "Groceries", "Utilities"],
+    "Transport": ["Fuel", "Commute"],
+    "Fun": ["Dining Out", "Games"],
+}
+ACCOUNTS = ["Bank", "Cash"]
+CARDS = ["Credit Card"]
+
+SW_CATEGORIES = [
+    {"id": 1, "name": "Food and drink", "subcategories": [
+        {"id": 11, "name": "Groceries"}, {"id": 12, "name": "Dining out"}]},
+    {"id": 2, "name": "Transportation", "subcategories": [
+        {"id": 21, "name": "Taxi"}, {"id": 22, "name": "Parking"}]},
+    {"id": 3, "name": "Uncategorized", "subcategories": [
+        {"id": 31, "name": "General"}]},
+]
+SW_GROUP_ID = 5
+SW_GROUPS = [
+    {"id": id, "name": name, "updated_at": "", "created_at": "", "simplify_by_default": False,
+     "members": [], "original_debts": [], "simplified_debts": [], "whiteboard": None,
+     "group_type": "home", "invite_link": ""}
+    for id, name in ((0, "Non-group expenses"), (SW_GROUP_ID, "Home"))
+]
+SW_CURRENCIES = [{"currency_code": code, "unit": code} for code in ("PHP", "USD")]
+
+
+class FakeTelegram:
+    """
+    Answers the Bot API requests of TeleBot and AsyncTeleBot after `latency`
+    seconds and counts them by method
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._originals = None
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def install(self):
+        self._originals = (apihelper.CUSTOM_REQUEST_SENDER,
+                           asyncio_helper._process_request)
+        apihelper.CUSTOM_REQUEST_SENDER = self._send
+        asyncio_helper._process_request = self._async_process_request
+
+    def uninstall(self):
+        apihelper.CUSTOM_REQUEST_SENDER, asyncio_helper._process_request = self._originals
+
+    def result(self, url: str, params: dict):
+        method = url.rsplit("/", 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._message_ids)
+        params = params or {}
+        if method in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": int(params.get("message_id") or message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def _send(self, method, url, params=None, **kwargs):
+        time.sleep(self.latency)
+        return _Response({"ok": True, "result": self.result(url, params)})
+
+    async def _async_process_request(self, token, url, method="get", params=None, files=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self.result(url, params)
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.text = json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class FakeWorksheet:
+    """
+    Transactions sheet with the date column in B from row 9, rows are kept in memory
+    """
+
+    first_row = 9
+    last_row = 5000
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.rows: dict[int, list] = {}
+        self._lock = threading.Lock()
+
+    def range(self, name):
+        time.sleep(self.latency)
+        with self._lock:
+            return [Cell(row, 2, self.rows[row][0] if row in self.rows else "")
+                    for row in range(self.first_row, self.last_row + 1)]
+
+    def get(self, range_name):
+        time.sleep(self.latency)
+        grid = utils.a1_range_to_grid_range(range_name)
+        # rows are kept from column B on
+        columns = slice(grid["startColumnIndex"] - 1, grid["endColumnIndex"] - 1)
+        with self._lock:
+            values = [self.rows.get(row, [])[columns]
+                      for row in range(grid["startRowIndex"] + 1, grid["endRowIndex"] + 1)]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def append_rows(self, values, table_range, value_input_option=None, insert_data_option=None):
+        time.sleep(self.latency)
+        start = utils.a1_to_rowcol(table_range.split(":")[0])[0]
+        with self._lock:
+            # like the Sheets API, append after the table when the range is taken
+            while start in self.rows:
+                start += 1
+            for i, row in enumerate(values):
+                self.rows[start + i] = [str(value) for value in row]
+        return {"updates": {"updatedRange": f"Transactions!B{start}:H{start + len(values) - 1}"}}
+
+
+class FakeSpreadsheet:
+    """
+    Aspire budget with the categories and accounts above and an empty Transactions sheet
+    """
+
+    def __init__(self, latency=0.0, id="benchmark"):
+        self.latency = latency
+        self.id = id
+        self.transactions = FakeWorksheet(latency)
+
+    def worksheet(self, name):
+        time.sleep(self.latency)
+        return self.transactions
+
+    def values_batch_get(self, ranges):
+        time.sleep(self.latency)
+        configuration = []
+        for group, categories in CATEGORY_GROUPS.items():
+            configuration.append(["✦", group])
+            configuration.extend(["", category] for category in categories)
+        listed = [[category] for categories in CATEGORY_GROUPS.values()
+                  for category in categories]
+        return {"valueRanges": [
+            {"values": configuration},
+            {"values": listed},
+            {"values": [[account] for account in ACCOUNTS]},
+            {"values": [[card] for card in CARDS]},
+        ]}
+
+
+class FakeClient:
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        time.sleep(self.spreadsheet.latency)
+        return self.spreadsheet
+
+
+class _CurrentUser:
+    def getId(self):
+        return 1
+
+
+class FakeSplitwise:
+    """
+    Splitwise client returning fixed groups, categories and currencies and
+    accepting every expense
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.expenses = []
+        self._ids = itertools.count(1000)
+
+    def getCurrentUser(self):
+        time.sleep(self.latency)
+        return _CurrentUser()
+
+    def getCategories(self):
+        time.sleep(self.latency)
+        return [Category(category) for category in SW_CATEGORIES]
+
+    def getGroups(self):
+        time.sleep(self.latency)
+        return [Group(group) for group in SW_GROUPS]
+
+    def getCurrencies(self):
+        time.sleep(self.latency)
+        return [Currency(currency) for currency in SW_CURRENCIES]
+
+    def getFriends(self):
+        time.sleep(self.latency)
+        return []
+
+    def getExpenses(self, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+    def createExpense(self, expense):
+        time.sleep(self.latency)
+        expense.id = next(self._ids)
+        self.expenses.append(expense)
+        return expense, None
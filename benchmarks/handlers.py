@@ -0,0 +1,289 @@
+"""
+Offline benchmark of the bot handlers. Telegram, Google Sheets and Splitwise are
+replaced by the stand-ins of benchmarks.fakes, so no credentials or network are
+needed. Every step of a scenario is one update; its latency and the memory it
+allocates are measured and written as JSON.
+
+    python -m benchmarks.handlers [--mode sync|async] [--iterations 200]
+        [--telegram-latency 0] [--sheets-latency 0] [--splitwise-latency 0]
+        [--output results.json] [--baseline previous.json --tolerance 0.25]
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from kink import di
+from telebot import types
+from telebot.callback_data import CallbackData
+
+from benchmarks.fakes import (SW_GROUP_ID, FakeClient, FakeSpreadsheet,
+                              FakeSplitwise, FakeTelegram)
+
+USER_ID = 1
+
+# configuration read by startup.configure_services, nothing is written to disk
+ENVIRONMENT = {
+    "TOKEN": "1:benchmark",
+    "RESTRICT_ACCESS": "True",
+    "USER_IDS": str(USER_ID),
+    "CREDENTIALS": base64.b64encode(b"{}").decode(),
+    "WORKSHEET_ID": "benchmark",
+    "GROUP_ID": str(SW_GROUP_ID),
+    "FRIEND_ID": "2",
+    "SNAPSHOT_PATH": "",
+    "OUTBOX_PATH": "",
+    "SESSION_STORE": "memory://",
+    "TRX_BATCH_DELAY": "0.05",
+}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def message(text: str):
+    def build() -> types.Update:
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] \
+            if text.startswith("/") else []
+        return types.Update.de_json({"update_id": next(_update_ids), "message": {
+            "message_id": next(_message_ids), "date": int(time.time()), "text": text, "entities": entities,
+            "chat": {"id": USER_ID, "type": "private"},
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "benchmark"},
+        }})
+    return build
+
+
+def callback(data):
+    """
+    Callback query update, `data` is the callback data or a function returning it
+    """
+    def build() -> types.Update:
+        return types.Update.de_json({"update_id": next(_update_ids), "callback_query": {
+            "id": str(next(_message_ids)), "chat_instance": "benchmark",
+            "data": data() if callable(data) else data,
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "benchmark"},
+            "message": {"message_id": 1, "date": int(time.time()), "text": "",
+                        "chat": {"id": USER_ID, "type": "private"}},
+        }})
+    return build
+
+
+def action(action_id: int):
+    return lambda: di[CallbackData].new(action_id=action_id)
+
+
+# (step, update) pairs sent in order by every iteration of a scenario
+SCENARIOS = {
+    "start_flow": [
+        ("/start", message("/start")),
+        ("select_outflow", callback(action(2))),
+        ("enter_amount", message("120")),
+        ("save_field", callback("save")),
+        ("done", callback(action(11))),
+    ],
+    "quick_add": [
+        ("AddExp", message('AddExp 1,250 "Groceries run" #Groc @Cash')),
+        ("quick_save", callback("quick_save")),
+    ],
+    "category_navigation": [
+        ("/start", message("/start")),
+        ("select_category", callback(action(4))),
+        ("group_sel", callback("group_sel;Living")),
+        ("back", callback("back;category")),
+        ("group_sel_again", callback("group_sel;Fun")),
+        ("category_sel", callback("save;Games")),
+    ],
+    "batch_add": [
+        ("batch", message('AddExp 120 "Lunch"\nAddInc 500 "Refund"\nAddSplit 300 "Taxi" #Taxi')),
+        ("batch_save", callback("batch_save")),
+    ],
+    "add_split": [
+        ("AddSplit", message('AddSplit 350 "Grab home"')),
+        ("sw_cat", callback("sw_cat;2")),
+        ("sw_sub", callback("sw_sub;21")),
+    ],
+}
+
+# the Splitwise handlers are plain functions, AsyncTeleBot cannot await them
+SKIPPED = {"async": {"add_split": "splitwiseSdk handlers are not coroutines"}}
+
+
+def configure(run_async: bool, telegram_latency=0.0, sheets_latency=0.0, splitwise_latency=0.0):
+    """
+    Configure the container like app.py does, with stand-ins for the remote services.
+    Returns the Telegram stand-in and a function processing one update.
+    """
+    import startup
+    from aspire.async_bot import async_bot_functions
+    from aspire.sync_bot import sync_bot_functions
+    from shared.metrics import instrument_handlers
+    from shared.services import EventLoopThread
+    from splitwiseSdk.bot import bot_functions
+
+    os.environ.update(ENVIRONMENT, RUN_ASYNC=str(run_async))
+    telegram = FakeTelegram(telegram_latency)
+    telegram.install()
+    startup.configure_services(
+        client=FakeClient(FakeSpreadsheet(sheets_latency)),
+        splitwise=FakeSplitwise(splitwise_latency),
+    )
+    bot = di["bot_instance"]
+    if run_async:
+        async_bot_functions(bot)
+    else:
+        sync_bot_functions(bot)
+    bot_functions(bot)
+    instrument_handlers(bot, *di["observers"])
+
+    if run_async:
+        def process(update):
+            di[EventLoopThread].run(bot.process_new_updates([update]))
+    else:
+        def process(update):
+            bot.process_new_updates([update])
+    return telegram, process
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure(telegram: FakeTelegram, process, steps, iterations: int, warmup: int) -> dict:
+    """
+    Latency of each step over `iterations` runs, then the memory it allocates over
+    a tenth as many runs with tracemalloc, which slows everything down
+    """
+    latencies = {name: [] for name, _ in steps}
+    calls = {name: [] for name, _ in steps}
+    for i in range(warmup + iterations):
+        for name, build in steps:
+            update = build()
+            sent = telegram.total
+            started = time.perf_counter()
+            process(update)
+            elapsed = time.perf_counter() - started
+            if i >= warmup:
+                latencies[name].append(elapsed)
+                calls[name].append(telegram.total - sent)
+
+    peaks = {name: [] for name, _ in steps}
+    retained = {name: [] for name, _ in steps}
+    tracemalloc.start()
+    try:
+        for _ in range(max(1, iterations // 10)):
+            for name, build in steps:
+                update = build()
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                process(update)
+                current, peak = tracemalloc.get_traced_memory()
+                peaks[name].append(peak - before)
+                retained[name].append(current - before)
+    finally:
+        tracemalloc.stop()
+
+    results = {}
+    for name, _ in steps:
+        if not any(calls[name]):
+            raise RuntimeError(f"No handler answered {name}")
+        values = latencies[name]
+        results[name] = {
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "mean_ms": sum(values) / len(values) * 1000,
+            "max_ms": max(values) * 1000,
+            "peak_alloc_kib": percentile(peaks[name], 0.5) / 1024,
+            "retained_kib": percentile(retained[name], 0.5) / 1024,
+            "telegram_calls": sum(calls[name]) / len(calls[name]),
+        }
+    return results
+
+
+def run(mode="sync", iterations=200, warmup=20, scenarios=None,
+        telegram_latency=0.0, sheets_latency=0.0, splitwise_latency=0.0) -> dict:
+    telegram, process = configure(
+        mode == "async", telegram_latency, sheets_latency, splitwise_latency)
+    skipped = SKIPPED.get(mode, {})
+    results = {}
+    for scenario in scenarios or SCENARIOS:
+        if scenario not in skipped:
+            results[scenario] = measure(
+                telegram, process, SCENARIOS[scenario], iterations, warmup)
+    return {
+        "benchmark": "handlers",
+        "mode": mode,
+        "python": platform.python_version(),
+        "iterations": iterations,
+        "latency_ms": {
+            "telegram": telegram_latency * 1000,
+            "sheets": sheets_latency * 1000,
+            "splitwise": splitwise_latency * 1000,
+        },
+        "scenarios": results,
+        "skipped": {name: reason for name, reason in skipped.items()
+                    if name in (scenarios or SCENARIOS)},
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Steps whose median latency grew by more than `tolerance` since the baseline
+    """
+    found = []
+    for scenario, steps in results["scenarios"].items():
+        for step, stats in steps.items():
+            before = baseline.get("scenarios", {}).get(scenario, {}).get(step)
+            if before and stats["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+                found.append(f"{scenario}/{step}: p50 {before['p50_ms']:.3f}ms -> {stats['p50_ms']:.3f}ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="run only this scenario, can be repeated")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="seconds added to every Bot API call")
+    parser.add_argument("--sheets-latency", type=float, default=0.0,
+                        help="seconds added to every Google Sheets call")
+    parser.add_argument("--splitwise-latency", type=float, default=0.0,
+                        help="seconds added to every Splitwise call")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed growth of the median latency over the baseline")
+    args = parser.parse_args()
+
+    results = run(args.mode, args.iterations, args.warmup, args.scenario,
+                  args.telegram_latency, args.sheets_latency, args.splitwise_latency)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        for scenario, steps in results["scenarios"].items():
+            for step, stats in steps.items():
+                print(f"{scenario:20} {step:16} p50 {stats['p50_ms']:8.3f}ms "
+                      f"p95 {stats['p95_ms']:8.3f}ms alloc {stats['peak_alloc_kib']:8.1f}KiB")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Regression {line}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
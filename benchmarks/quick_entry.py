@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of quick add parsing: the shlex splitter the handlers used before
+against the precompiled quick entry parser.
+
+    python -m benchmarks.quick_entry [--number 20000]
+"""
+import argparse
+import timeit
+
+from shared.services import TextUtil
+
+MESSAGES = [
+    'AddExp 120 "Lunch"',
+    'AddInc 15000 "Salary for the first half of the month"',
+    'AddSplit 350 "Grab home"',
+]
+
+
+def shlex_path(text: str):
+    """
+    What the AddExp handler did before: split with shlex, then convert the amount
+    """
+    result = TextUtil.text_splitter(text)
+    del result[0]
+    amount, memo = result
+    return float(amount), memo
+
+
+def parser_path(text: str):
+    return TextUtil.parse_quick_entry(text)
+
+
+def run(number: int) -> dict[str, float]:
+    """
+    Microseconds per message of each path
+    """
+    results = {}
+    for name, parse in (("shlex", shlex_path), ("parser", parser_path)):
+        seconds = min(timeit.repeat(
+            lambda: [parse(text) for text in MESSAGES], number=number, repeat=5))
+        results[name] = seconds / (number * len(MESSAGES)) * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000,
+                        help="iterations over the sample messages")
+    args = parser.parse_args()
+    results = run(args.number)
+    for name, micros in results.items():
+        print(f"{name:8} {micros:8.2f} us/message")
+    print(f"speedup  {results['shlex'] / results['parser']:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
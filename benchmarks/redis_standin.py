@@ -0,0 +1,129 @@
+"""
+In-process stand-in for a Redis server, enough for RedisStore: PING, AUTH,
+SELECT, GET, SET with EX/PX/NX/XX and DEL, with key expiry. Lets
+SESSION_STORE=redis:// and UPDATE_DEDUP_STORE=redis:// run without a server.
+
+    python -m benchmarks.redis_standin [PORT] [--password PASSWORD]
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class RedisStandin(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0), password: str = None):
+        super().__init__(address, RedisHandler)
+        self.password = password
+        # (db, key) -> (value, expires_at or None)
+        self.data: dict[tuple[int, bytes], tuple[bytes, float]] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}{self.server_address[0]}:{self.server_address[1]}/0"
+
+    def start(self) -> "RedisStandin":
+        threading.Thread(target=self.serve_forever, name="redis-standin", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def lookup(self, db: int, key: bytes):
+        entry = self.data.get((db, key))
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self.data[(db, key)]
+            return None
+        return value
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.db = 0
+        self.authenticated = not self.server.password
+        while True:
+            try:
+                args = self.read_command()
+                if args is None:
+                    return
+                self.wfile.write(self.run(args))
+            except (ConnectionError, ValueError):
+                return
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("Inline commands are not supported")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def run(self, args: list[bytes]) -> bytes:
+        command = args[0].upper().decode()
+        if command == "AUTH":
+            if args[-1].decode() != self.server.password:
+                return b"-WRONGPASS invalid password\r\n"
+            self.authenticated = True
+            return b"+OK\r\n"
+        if not self.authenticated:
+            return b"-NOAUTH Authentication required.\r\n"
+        if command == "PING":
+            return b"+PONG\r\n"
+        if command == "SELECT":
+            self.db = int(args[1])
+            return b"+OK\r\n"
+        with self.server.lock:
+            if command == "GET":
+                return bulk(self.server.lookup(self.db, args[1]))
+            if command == "DEL":
+                deleted = sum(self.server.data.pop((self.db, key), None) is not None
+                              for key in args[1:])
+                return b":%d\r\n" % deleted
+            if command == "SET":
+                return self.set(args[1], args[2], [arg.upper() for arg in args[3:]], args[3:])
+        return b"-ERR unknown command '%s'\r\n" % args[0]
+
+    def set(self, key: bytes, value: bytes, options: list[bytes], raw: list[bytes]) -> bytes:
+        expires_at = None
+        if b"EX" in options:
+            expires_at = time.time() + int(raw[options.index(b"EX") + 1])
+        if b"PX" in options:
+            expires_at = time.time() + int(raw[options.index(b"PX") + 1]) / 1000
+        exists = self.server.lookup(self.db, key) is not None
+        if b"NX" in options and exists or b"XX" in options and not exists:
+            return b"$-1\r\n"
+        self.server.data[(self.db, key)] = (value, expires_at)
+        return b"+OK\r\n"
+
+
+def bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("port", type=int, nargs="?", default=6379)
+    parser.add_argument("--password")
+    args = parser.parse_args()
+    server = RedisStandin(("127.0.0.1", args.port), args.password)
+    print(f"Listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
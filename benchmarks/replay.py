@@ -0,0 +1,447 @@
+"""
+Replays recorded webhook traffic (see UPDATE_RECORD_PATH) against app.py. The bot
+runs in its own process, under gunicorn when it is installed, and talks to local
+stand-in servers for the Telegram Bot API, Google Sheets and Splitwise. Reports
+end-to-end latency, throughput, error rate and duplicate writes as JSON.
+
+    python -m benchmarks.replay updates.jsonl [--mode sync|async|both]
+        [--rate 20 | --speed 1] [--redeliver 0.05] [--workers 1 --threads 8]
+        [--telegram-latency 0] [--sheets-latency 0] [--splitwise-latency 0]
+        [--output results.json]
+"""
+import argparse
+import base64
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, unquote, urlsplit
+
+from benchmarks.fakes import (SW_CATEGORIES, SW_CURRENCIES, SW_GROUP_ID,
+                              SW_GROUPS, FakeSpreadsheet, FakeTelegram)
+from benchmarks.handlers import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "replay"
+
+# configuration of the bot process, the environment may override these
+APP_DEFAULTS = {
+    "RESTRICT_ACCESS": "True",
+    "SESSION_STORE": "memory://",
+}
+# and these it may not
+APP_ENVIRONMENT = {
+    "TOKEN": "1:replay",
+    "SECRET": SECRET,
+    "UPDATE_MODE": "webhook",
+    "CREDENTIALS": base64.b64encode(b"{}").decode(),
+    "WORKSHEET_ID": "replay",
+    "GROUP_ID": str(SW_GROUP_ID),
+    "FRIEND_ID": "2",
+    "SNAPSHOT_PATH": "",
+    "UPDATE_RECORD_PATH": "",
+}
+
+SW_USER = {"id": 1, "first_name": "Replay", "last_name": "", "email": "",
+           "registration_status": "confirmed", "default_currency": "PHP", "locale": "en",
+           "date_format": "MM/DD/YYYY", "default_group_id": -1}
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    Answers the Bot API under /telegram, the Sheets API under /sheets and the
+    Splitwise API under /splitwise, keeping every sheet row and expense written.
+    The bot reports processed updates to /replay/done.
+    """
+
+    daemon_threads = True
+    services = ("telegram", "sheets", "splitwise", "replay")
+
+    def __init__(self, telegram_latency=0.0, sheets_latency=0.0, splitwise_latency=0.0):
+        super().__init__(("127.0.0.1", 0), StandinHandler)
+        self.latency = {"telegram": telegram_latency, "sheets": sheets_latency,
+                        "splitwise": splitwise_latency}
+        self.bot_api = FakeTelegram()
+        self.spreadsheet = FakeSpreadsheet()
+        self.writes: dict[str, list] = defaultdict(list)
+        self.done: dict[int, list] = defaultdict(list)
+        self.logged_errors: dict[int, int] = {}
+        self._expense_ids = itertools.count(1000)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://%s:%d" % self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="standin", daemon=True).start()
+
+    def telegram(self, method: str, path: str, params: dict, body: bytes):
+        if path.endswith("/getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        else:
+            result = self.bot_api.result(path, params)
+        return 200, {"ok": True, "result": result}
+
+    def sheets(self, method: str, path: str, params: dict, body: bytes):
+        spreadsheet_id, _, path = path.removeprefix("v4/spreadsheets/").partition("/")
+        worksheet = self.spreadsheet.transactions
+        if not path:
+            return 200, {"spreadsheetId": spreadsheet_id, "properties": {"title": "Aspire Budget"},
+                         "sheets": [{"properties": {
+                             "sheetId": 1, "title": "Transactions", "index": 0, "sheetType": "GRID",
+                             "gridProperties": {"rowCount": worksheet.last_row, "columnCount": 10},
+                         }}]}
+        if path == "values:batchGet":
+            ranges = params["ranges"]
+            return 200, self.spreadsheet.values_batch_get(ranges if isinstance(ranges, list) else [ranges])
+        if not path.startswith("values/"):
+            return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+        range_name = path.removeprefix("values/")
+        append = range_name.endswith(":append")
+        a1 = unquote(range_name.removesuffix(":append")).split("!")[-1]
+        if a1 == "trx_Dates":
+            a1 = f"B{worksheet.first_row}:B{worksheet.last_row}"
+        if append:
+            rows = json.loads(body)["values"]
+            response = worksheet.append_rows(rows, a1)
+            with self._lock:
+                self.writes["sheets"].extend(tuple(str(value) for value in row) for row in rows)
+            return 200, {"spreadsheetId": spreadsheet_id, "tableRange": a1, **response}
+        return 200, {"range": f"Transactions!{a1}", "majorDimension": "ROWS",
+                     "values": worksheet.get(a1)}
+
+    def splitwise(self, method: str, path: str, params: dict, body: bytes):
+        endpoint = path.rsplit("/", 1)[-1]
+        if endpoint == "create_expense":
+            form = dict(parse_qsl(body.decode()))
+            with self._lock:
+                self.writes["splitwise"].append(tuple(sorted(form.items())))
+                id = next(self._expense_ids)
+            return 200, {"expenses": [expense_data(id, form)], "errors": {}}
+        responses = {
+            "get_current_user": {"user": SW_USER},
+            "get_categories": {"categories": SW_CATEGORIES},
+            "get_groups": {"groups": SW_GROUPS},
+            "get_currencies": {"currencies": SW_CURRENCIES},
+            "get_friends": {"friends": []},
+            "get_expenses": {"expenses": []},
+        }
+        if endpoint not in responses:
+            return 404, {"errors": {"base": [f"Unknown endpoint {endpoint}"]}}
+        return 200, responses[endpoint]
+
+    def replay(self, method: str, path: str, params: dict, body: bytes):
+        report = json.loads(body)
+        with self._lock:
+            self.done[report["update_id"]].append((time.perf_counter(), report["ok"]))
+            self.logged_errors[report["pid"]] = max(
+                report["errors"], self.logged_errors.get(report["pid"], 0))
+        return 200, {}
+
+
+def expense_data(id: int, form: dict) -> dict:
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return {
+        "id": id, "group_id": int(form.get("group_id") or 0), "description": form.get("description", ""),
+        "repeats": False, "repeat_interval": "never", "email_reminder": False,
+        "email_reminder_in_advance": -1, "next_repeat": None, "details": form.get("details"),
+        "comments_count": 0, "payment": False, "creation_method": "equal",
+        "transaction_method": "offline", "transaction_confirmed": False,
+        "cost": form.get("cost", "0"), "currency_code": form.get("currency_code", "PHP"),
+        "created_by": SW_USER, "date": form.get("date", now), "created_at": now, "updated_at": now,
+        "deleted_at": None, "receipt": {"original": None, "large": None},
+        "category": {"id": int(form.get("category_id") or 0), "name": ""},
+        "updated_by": None, "deleted_by": None, "repayments": [], "users": [],
+    }
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StandinServer
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        params = {key: values[-1] if len(values) == 1 else values
+                  for key, values in parse_qs(url.query).items()}
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode()))
+        elif content_type.startswith("application/json") and body:
+            params.update(json.loads(body))
+
+        service, _, path = url.path.lstrip("/").partition("/")
+        if service not in self.server.services:
+            return self.respond(404, {"error": f"Unknown service {service}"})
+        time.sleep(self.server.latency.get(service, 0))
+        try:
+            status, data = getattr(self.server, service)(self.command, path, params, body)
+        except Exception as e:
+            status, data = 500, {"error": repr(e)}
+        self.respond(status, data)
+
+    def respond(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_recording(path: str) -> list[tuple[float, dict]]:
+    """
+    (received_at, update) pairs of an UpdateRecorder file, lines holding a bare
+    update are accepted too and spaced one second apart
+    """
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(filter(str.strip, f)):
+            record = json.loads(line)
+            if "update" in record:
+                records.append((record["received_at"], record["update"]))
+            else:
+                records.append((float(i), record))
+    return records
+
+
+def user_ids(updates) -> set[int]:
+    ids = set()
+    for update in updates:
+        for value in update.values():
+            if isinstance(value, dict) and isinstance(value.get("from"), dict):
+                ids.add(value["from"]["id"])
+    return ids
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(server: str, port: int, env: dict, workers: int, threads: int) -> subprocess.Popen:
+    if server == "gunicorn":
+        command = [sys.executable, "-m", "gunicorn", "--workers", str(workers),
+                   "--threads", str(threads), "--bind", f"127.0.0.1:{port}",
+                   "--log-level", "warning", "benchmarks.standin_app:app"]
+    else:
+        command = [sys.executable, "-m", "benchmarks.standin_app", str(port)]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The bot exited with {process.returncode} while starting")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).close()
+            return process
+        except urllib.error.HTTPError:
+            # any answer means it is serving
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The bot did not start within 2 minutes")
+
+
+def post(url: str, update: dict) -> int:
+    request = urllib.request.Request(
+        url, json.dumps(update).encode(), {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return 0
+
+
+def replay(records, mode="sync", rate=0.0, speed=1.0, redeliver=0.0, server="auto",
+           workers=1, threads=8, connections=16, telegram_latency=0.0, sheets_latency=0.0,
+           splitwise_latency=0.0, drain=5.0, timeout=60.0, seed=0) -> dict:
+    """
+    Send the recorded updates to a fresh bot process and collect what happened
+    """
+    if server == "auto":
+        server = "gunicorn" if importlib.util.find_spec("gunicorn") else "flask"
+    standin = StandinServer(telegram_latency, sheets_latency, splitwise_latency)
+    standin.start()
+    updates = [update for _, update in records]
+    port = free_port()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **APP_DEFAULTS, **os.environ, **APP_ENVIRONMENT,
+            "RUN_ASYNC": str(mode == "async"),
+            "USER_IDS": ",".join(str(id) for id in sorted(user_ids(updates))),
+            "OUTBOX_PATH": os.path.join(directory, "outbox.db"),
+            "STANDIN_URL": standin.url,
+            "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])),
+        }
+        process = start_app(server, port, env, workers, threads)
+        try:
+            webhook = f"http://127.0.0.1:{port}/{SECRET}/"
+            if rate:
+                offsets = [i / rate for i in range(len(records))]
+            else:
+                offsets = [(received_at - records[0][0]) / speed for received_at, _ in records]
+            rng = random.Random(seed)
+            sent: dict[int, float] = {}
+            statuses: dict[int, list[int]] = defaultdict(list)
+            lock = threading.Lock()
+
+            def send(update):
+                copies = 2 if rng.random() < redeliver else 1
+                for _ in range(copies):
+                    started = time.perf_counter()
+                    with lock:
+                        sent.setdefault(update["update_id"], started)
+                    status = post(webhook, update)
+                    with lock:
+                        statuses[update["update_id"]].append(status)
+
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                for offset, update in zip(offsets, updates):
+                    delay = began + offset - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(send, update)
+            finished_sending = time.perf_counter()
+
+            accepted = {id for id, codes in statuses.items() if 200 in codes}
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and not accepted <= standin.done.keys():
+                time.sleep(0.05)
+            # let the transaction batches and expense workers finish writing
+            time.sleep(drain)
+        finally:
+            process.terminate()
+            process.wait()
+    standin.shutdown()
+
+    done = {id: events for id, events in standin.done.items() if id in sent}
+    latencies = [events[0][0] - sent[id] for id, events in done.items()]
+    failed = {id for id, events in done.items() if not events[0][1]}
+    lost = accepted - done.keys()
+    refused = set(sent) - accepted
+    completed_at = max((events[0][0] for events in done.values()), default=finished_sending)
+    writes = {name: {"total": len(rows), "duplicates": len(rows) - len(set(rows))}
+              for name, rows in (("sheets", standin.writes["sheets"]),
+                                 ("splitwise", standin.writes["splitwise"]))}
+    return {
+        "mode": mode,
+        "server": server,
+        "updates": len(sent),
+        "deliveries": sum(len(codes) for codes in statuses.values()),
+        "http_status": dict(Counter(str(code) for codes in statuses.values() for code in codes)),
+        "completed": len(done),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5) * 1000 if latencies else None,
+            "p95": percentile(latencies, 0.95) * 1000 if latencies else None,
+            "p99": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "max": max(latencies) * 1000 if latencies else None,
+        },
+        "throughput_per_s": len(done) / max(completed_at - began, 1e-9),
+        "error_rate": len(failed | lost | refused) / max(len(sent), 1),
+        "errors": {"refused": len(refused), "lost": len(lost), "failed": len(failed),
+                   "logged": sum(standin.logged_errors.values())},
+        "processed_twice": sum(len(events) > 1 for events in done.values()),
+        "writes": writes,
+        "duplicate_writes": sum(counts["duplicates"] for counts in writes.values()),
+        "bot_api_calls": dict(standin.bot_api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", help="JSONL file written with UPDATE_RECORD_PATH")
+    parser.add_argument("--mode", choices=("sync", "async", "both"), default="both")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="updates per second, keep the recorded pacing when 0")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="speed up the recorded pacing by this factor")
+    parser.add_argument("--redeliver", type=float, default=0.0,
+                        help="fraction of updates sent twice, like Telegram retries")
+    parser.add_argument("--server", choices=("auto", "gunicorn", "flask"), default="auto")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--connections", type=int, default=16,
+                        help="webhook requests in flight at most")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="seconds added to every Bot API call")
+    parser.add_argument("--sheets-latency", type=float, default=0.0,
+                        help="seconds added to every Google Sheets call")
+    parser.add_argument("--splitwise-latency", type=float, default=0.0,
+                        help="seconds added to every Splitwise call")
+    parser.add_argument("--drain", type=float, default=5.0,
+                        help="seconds to wait for queued writes after the last update")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="seconds to wait for accepted updates to be processed")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    records = load_recording(args.recording)
+    if not records:
+        parser.error(f"{args.recording} holds no updates")
+    modes = ("sync", "async") if args.mode == "both" else (args.mode,)
+    results = {
+        "benchmark": "replay",
+        "recording": args.recording,
+        "python": platform.python_version(),
+        "rate": args.rate or None,
+        "speed": None if args.rate else args.speed,
+        "redeliver": args.redeliver,
+        "latency_ms": {
+            "telegram": args.telegram_latency * 1000,
+            "sheets": args.sheets_latency * 1000,
+            "splitwise": args.splitwise_latency * 1000,
+        },
+        "runs": {
+            mode: replay(records, mode, args.rate, args.speed, args.redeliver, args.server,
+                         args.workers, args.threads, args.connections, args.telegram_latency,
+                         args.sheets_latency, args.splitwise_latency, args.drain, args.timeout)
+            for mode in modes
+        },
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        for mode, run in results["runs"].items():
+            latency = run["latency_ms"]
+            print(f"{mode:6} p50 {latency['p50'] or 0:8.1f}ms p95 {latency['p95'] or 0:8.1f}ms "
+                  f"p99 {latency['p99'] or 0:8.1f}ms {run['throughput_per_s']:7.1f}/s "
+                  f"errors {run['error_rate']:.1%} duplicate writes {run['duplicate_writes']}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+app.py pointed at the stand-in servers of benchmarks.replay. The Bot API, Google
+Sheets and Splitwise urls are rewritten to STANDIN_URL before app.py is imported,
+and every processed update is reported back so its end-to-end latency is known.
+
+    gunicorn benchmarks.standin_app:app
+    python -m benchmarks.standin_app PORT
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import urllib.request
+
+import requests
+from google.auth.credentials import AnonymousCredentials
+from gspread import Client
+from splitwise import Splitwise
+from telebot import apihelper, asyncio_helper
+
+import startup
+
+STANDIN_URL = os.environ["STANDIN_URL"].rstrip("/")
+
+SHEETS_URL = "https://sheets.googleapis.com/"
+SPLITWISE_URL = Splitwise.SPLITWISE_BASE_URL
+
+
+class RedirectSession(requests.Session):
+    """
+    Session sending requests for `prefix` to `target` instead
+    """
+
+    def __init__(self, prefix: str, target: str):
+        super().__init__()
+        self.prefix = prefix
+        self.target = target
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(self.prefix):
+            url = self.target + url[len(self.prefix):]
+        return super().request(method, url, *args, **kwargs)
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def redirect():
+    apihelper.API_URL = STANDIN_URL + "/telegram/bot{0}/{1}"
+    asyncio_helper.API_URL = STANDIN_URL + "/telegram/bot{0}/{1}"
+    for name, value in vars(Splitwise).items():
+        if name.endswith("_URL") and isinstance(value, str) and value.startswith(SPLITWISE_URL):
+            setattr(Splitwise, name, STANDIN_URL + "/splitwise/" + value[len(SPLITWISE_URL):])
+    client = Client(AnonymousCredentials(),
+                    session=RedirectSession(SHEETS_URL, STANDIN_URL + "/sheets/"))
+    startup.configure_services = functools.partial(startup.configure_services, client=client)
+
+
+def report(process, errors: ErrorCounter):
+    """
+    Wrap the update processing of the dispatcher to tell the replay when it is done
+    """
+    done_url = STANDIN_URL + "/replay/done"
+
+    def wrapper(update):
+        ok = True
+        try:
+            process(update)
+        except Exception:
+            ok = False
+            raise
+        finally:
+            body = json.dumps({"update_id": update.update_id, "ok": ok,
+                               "pid": os.getpid(), "errors": errors.count}).encode()
+            request = urllib.request.Request(
+                done_url, body, {"Content-Type": "application/json"})
+            urllib.request.urlopen(request).close()
+    return wrapper
+
+
+redirect()
+
+from kink import di  # noqa: E402
+from telebot import logger  # noqa: E402
+
+from app import app  # noqa: E402
+from shared.services import UpdateDispatcher  # noqa: E402
+
+_errors = ErrorCounter()
+logger.addHandler(_errors)
+di[UpdateDispatcher].process = report(di[UpdateDispatcher].process, _errors)
+
+if __name__ == "__main__":
+    # the werkzeug logger is chatty, one line per webhook call
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
@@ -0,0 +1,277 @@
+import inspect
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from typing import Iterable
+from urllib.parse import urlsplit
+
+from telebot import apihelper, asyncio_helper
+
+# seconds, the default buckets of the Prometheus clients
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# handler lists of TeleBot and AsyncTeleBot that are instrumented
+HANDLER_LISTS = ("message_handlers", "callback_query_handlers")
+
+# Splitwise client methods the bot calls
+SPLITWISE_CALLS = ("getCurrentUser", "getCategories", "getGroups", "getCurrencies",
+                   "getFriends", "getExpenses", "createExpense")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric family with one series per combination of label values
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for values, value in series:
+            lines.extend(self.render_series(values, value))
+        return lines
+
+    def render_series(self, values: tuple, value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, *values, value: float):
+        with self._lock:
+            counts, total = self._series.get(values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[values] = (counts, total + value)
+
+    def render_series(self, values: tuple, value) -> list[str]:
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total!r}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {counts[-1]}")
+        return lines
+
+
+class Metrics:
+    """
+    Latency histograms, call and error counts and in-flight gauges of the bot
+    handlers and of the calls to Telegram, Google Sheets and Splitwise
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.handler_seconds = Histogram(
+            "bot_handler_duration_seconds", "Time spent in message and callback handlers.",
+            ("handler",), buckets)
+        self.handler_errors = Counter(
+            "bot_handler_errors_total", "Handlers that raised an exception.", ("handler",))
+        self.handler_in_flight = Gauge(
+            "bot_handler_in_flight", "Handlers running right now.", ("handler",))
+        self.backend_seconds = Histogram(
+            "bot_backend_request_duration_seconds",
+            "Time spent in calls to the Bot API, Google Sheets and Splitwise.",
+            ("backend", "operation"), buckets)
+        self.backend_errors = Counter(
+            "bot_backend_request_errors_total", "Backend calls that raised an exception.",
+            ("backend", "operation"))
+        self.backend_in_flight = Gauge(
+            "bot_backend_requests_in_flight", "Backend calls waiting for an answer.",
+            ("backend", "operation"))
+
+    @contextmanager
+    def track(self, seconds: Histogram, errors: Counter, in_flight: Gauge, *labels):
+        in_flight.inc(*labels)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            errors.inc(*labels)
+            raise
+        finally:
+            seconds.observe(*labels, value=time.perf_counter() - started)
+            in_flight.dec(*labels)
+
+    def handler(self, name: str):
+        return self.track(self.handler_seconds, self.handler_errors, self.handler_in_flight, name)
+
+    def backend(self, backend: str, operation: str):
+        return self.track(self.backend_seconds, self.backend_errors, self.backend_in_flight,
+                          backend, operation)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.handler_seconds, self.handler_errors, self.handler_in_flight,
+                       self.backend_seconds, self.backend_errors, self.backend_in_flight):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def observe(observers, kind: str, *labels):
+    """
+    Enter the `kind` context manager, handler or backend, of every observer
+    """
+    with ExitStack() as stack:
+        for observer in observers:
+            stack.enter_context(getattr(observer, kind)(*labels))
+        yield
+
+
+def _wrap(func, track):
+    """
+    Run func, a plain or a coroutine function, inside the context manager returned by track()
+    """
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with track():
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with track():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def handler_name(func) -> str:
+    return f"{func.__module__}.{func.__name__}"
+
+
+def instrument_handlers(bot, *observers):
+    """
+    Observe every message and callback handler registered on the bot so far.
+    Observers are Metrics or anything else with handler() and backend() context managers.
+    """
+    for attribute in HANDLER_LISTS:
+        for handler in getattr(bot, attribute, []):
+            func = handler["function"]
+            name = handler_name(func)
+            handler["function"] = _wrap(
+                func, lambda name=name: observe(observers, "handler", name))
+
+
+def instrument_telegram(*observers):
+    """
+    Observe the Bot API requests of TeleBot and AsyncTeleBot, named after the API method
+    """
+    make_request = apihelper._make_request
+    process_request = asyncio_helper._process_request
+    if hasattr(make_request, "__wrapped__"):
+        return
+
+    @wraps(make_request)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        with observe(observers, "backend", "telegram", method_name):
+            return make_request(token, method_name, *args, **kwargs)
+
+    @wraps(process_request)
+    async def timed_process_request(token, url, *args, **kwargs):
+        with observe(observers, "backend", "telegram", url):
+            return await process_request(token, url, *args, **kwargs)
+
+    apihelper._make_request = timed_make_request
+    asyncio_helper._process_request = timed_process_request
+
+
+def sheets_operation(method: str, url: str) -> str:
+    """
+    Sheets API method of a request url, e.g. values.append or spreadsheets.get
+    """
+    path = urlsplit(url).path.split("/spreadsheets/", 1)[-1]
+    spreadsheet, _, rest = path.partition("/")
+    if ":" in spreadsheet:
+        return spreadsheet.split(":", 1)[1]
+    if not rest:
+        return f"spreadsheets.{method.lower()}"
+    resource, _, rest = rest.partition("/")
+    if ":" in resource:
+        resource, action = resource.split(":", 1)
+    elif ":" in rest:
+        action = rest.rsplit(":", 1)[1]
+    else:
+        action = method.lower()
+    return f"{resource}.{action}"
+
+
+def instrument_sheets(client, *observers):
+    """
+    Observe the requests of a gspread client, clients without an HTTP client are left as is
+    """
+    http_client = getattr(client, "http_client", None)
+    if http_client is None:
+        return
+    request = http_client.request
+
+    @wraps(request)
+    def timed_request(method, endpoint, *args, **kwargs):
+        with observe(observers, "backend", "sheets", sheets_operation(method, endpoint)):
+            return request(method, endpoint, *args, **kwargs)
+
+    http_client.request = timed_request
+
+
+def instrument_splitwise(splitwise, *observers):
+    """
+    Observe the Splitwise client methods the bot calls
+    """
+    for name in SPLITWISE_CALLS:
+        method = getattr(splitwise, name, None)
+        if method is not None:
+            setattr(splitwise, name, _wrap(
+                method, lambda name=name: observe(observers, "backend", "splitwise", name)))
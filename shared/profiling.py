@@ -0,0 +1,254 @@
+import asyncio
+import bisect
+import cProfile
+import inspect
+import itertools
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from logging import Logger
+from typing import NamedTuple, Optional
+
+from telebot import types
+
+from shared.tracing import update_chat_id, update_type
+
+PROFILE_MODES = ("cprofile", "sample")
+
+
+def frame_name(code) -> str:
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads processing updates every `interval` seconds.
+    Sleeps while no update is being profiled.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active: dict[int, tuple[int, Counter]] = {}
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> int:
+        """
+        Sample the calling thread until stop() is called with the returned token
+        """
+        with self._lock:
+            token = next(self._tokens)
+            self._active[token] = (threading.get_ident(), Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return token
+
+    def stop(self, token: int) -> Counter:
+        """
+        Collapsed stacks sampled since start(), root first and separated by ;
+        """
+        with self._lock:
+            return self._active.pop(token)[1]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in active:
+                frame = frames.get(thread_id)
+                names = []
+                while frame is not None:
+                    names.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                if names:
+                    stacks[";".join(reversed(names))] += 1
+            time.sleep(self.interval)
+
+
+class ProfileRecord(NamedTuple):
+    duration: float
+    finished_at: float
+    update_id: int
+    update_type: str
+    chat_id: Optional[int]
+    path: str
+    # functions with the most own time and their share of it
+    hot_spots: tuple[tuple[str, float], ...]
+
+
+class UpdateProfiler:
+    """
+    Profiles every update, with cProfile or by sampling stacks, and keeps the
+    profiles of the `keep` slowest updates of the last `window` seconds in
+    `directory`, as pstats or collapsed stack files for flame graph tools.
+    With AsyncTeleBot the profile of an update includes whatever else ran on the
+    event loop meanwhile.
+    """
+
+    def __init__(self, mode: str, directory: str, keep=10, window=3600.0, interval=0.005,
+                 logger: Logger = None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unsupported profile mode: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.keep = keep
+        self.window = window
+        self.logger = logger
+        self.sampler = StackSampler(interval) if mode == "sample" else None
+        self._records: list[ProfileRecord] = []
+        self._lock = threading.Lock()
+        # only one cProfile profiler can be active at a time since Python 3.12
+        self._cprofile_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if self.sampler is not None:
+            return self.sampler.start()
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active, e.g. a debugger
+            self._cprofile_lock.release()
+            return None
+        return profile
+
+    def stop(self, handle):
+        if self.sampler is not None:
+            return self.sampler.stop(handle)
+        if handle is not None:
+            handle.disable()
+            self._cprofile_lock.release()
+        return handle
+
+    def finish(self, update: types.Update, duration: float, profile):
+        """
+        Keep the profile if the update is among the slowest of the window
+        """
+        if not profile:
+            return
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if len(self._records) >= self.keep and duration <= self._records[0].duration:
+                return
+            path = os.path.join(
+                self.directory,
+                f"{int(now)}-{update.update_id}-{int(duration * 1000)}ms."
+                + ("pstats" if self.mode == "cprofile" else "collapsed"))
+            try:
+                hot_spots = self.save(profile, path)
+            except OSError as e:
+                if self.logger is not None:
+                    self.logger.warning(f"Could not save profile {path}: {e}")
+                return
+            bisect.insort(self._records, ProfileRecord(
+                duration, now, update.update_id, update_type(update), update_chat_id(update),
+                path, hot_spots), key=lambda record: record.duration)
+            while len(self._records) > self.keep:
+                self._remove(self._records.pop(0))
+
+    def save(self, profile, path: str) -> tuple[tuple[str, float], ...]:
+        """
+        Write the profile and return its hot spots
+        """
+        if isinstance(profile, cProfile.Profile):
+            profile.dump_stats(path)
+            stats = pstats.Stats(profile)
+            total = stats.total_tt or 1
+            own = sorted(((tt, f"{func} ({os.path.basename(file)}:{line})")
+                          for (file, line, func), (_, _, tt, _, _) in stats.stats.items()),
+                         reverse=True)
+            return tuple((name, tt / total) for tt, name in own[:3])
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in profile.items())
+        leaves = Counter()
+        for stack, count in profile.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values())
+        return tuple((name, count / total) for name, count in leaves.most_common(3))
+
+    def _expire(self, now: float):
+        expired = [record for record in self._records if record.finished_at < now - self.window]
+        for record in expired:
+            self._records.remove(record)
+            self._remove(record)
+
+    def _remove(self, record: ProfileRecord):
+        try:
+            os.remove(record.path)
+        except OSError:
+            pass
+
+    def slowest(self) -> list[ProfileRecord]:
+        with self._lock:
+            self._expire(time.time())
+            return sorted(self._records, key=lambda record: -record.duration)
+
+    def summary(self) -> str:
+        records = self.slowest()
+        minutes = int(self.window // 60)
+        if not records:
+            return f"No updates profiled in the last {minutes} min ({self.mode})"
+        lines = [f"Slowest {len(records)} updates in the last {minutes} min ({self.mode}, "
+                 f"profiles in {self.directory}):"]
+        for i, record in enumerate(records, 1):
+            lines.append(f"{i}. {record.duration * 1000:,.0f} ms, update {record.update_id} "
+                         f"({record.update_type}), chat {record.chat_id}")
+            lines.extend(f"   {share:.0%} {name}" for name, share in record.hot_spots)
+            lines.append(f"   {os.path.basename(record.path)}")
+        return "\n".join(lines)
+
+
+def profile_updates(bot, profiler: UpdateProfiler):
+    """
+    Profile each update TeleBot or AsyncTeleBot processes, for webhook and polling alike
+    """
+    process_new_updates = bot.process_new_updates
+    if inspect.iscoroutinefunction(process_new_updates):
+        async def process_one(update):
+            handle = profiler.start()
+            started = time.perf_counter()
+            try:
+                await process_new_updates([update])
+            finally:
+                duration = time.perf_counter() - started
+                profiler.finish(update, duration, profiler.stop(handle))
+
+        @wraps(process_new_updates)
+        async def async_profiled(updates):
+            await asyncio.gather(*(process_one(update) for update in updates))
+
+        bot.process_new_updates = async_profiled
+        return
+
+    @wraps(process_new_updates)
+    def profiled(updates):
+        for update in updates:
+            handle = profiler.start()
+            started = time.perf_counter()
+            try:
+                process_new_updates([update])
+            finally:
+                duration = time.perf_counter() - started
+                profiler.finish(update, duration, profiler.stop(handle))
+
+    bot.process_new_updates = profiled
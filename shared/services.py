@@ -1,11 +1,22 @@
+import asyncio
+import hashlib
+import hmac
+import inspect
+import json
 import platform
+import queue
+import re
 import shlex
+import threading
+import time
+import weakref
 from asyncio.proactor_events import _ProactorBasePipeTransport
+from collections import OrderedDict
 from datetime import datetime
 from enum import IntEnum
 from functools import wraps
 from logging import Logger
-from typing import Any, Dict
+from typing import Any, Callable, Dict, NamedTuple, Optional
 from zoneinfo import ZoneInfo
 
 import pytz
@@ -18,12 +29,12 @@ from telebot.asyncio_filters import \
 from telebot.asyncio_filters import IsDigitFilter as AsyncIsDigitFilter
 from telebot.asyncio_filters import \
     SimpleCustomFilter as AsyncSimpleCustomFilter
-from telebot.asyncio_filters import StateFilter as AsyncStateFilter
 from telebot.callback_data import CallbackData, CallbackDataFilter
 from telebot.custom_filters import (AdvancedCustomFilter, IsDigitFilter,
-                                    SimpleCustomFilter, StateFilter)
+                                    SimpleCustomFilter)
 
 from app_config import Configuration
+from shared.storage import MemoryStore, StateStore
 from shared.utils import *
 
 
@@ -42,6 +53,13 @@ class AsyncRestrictAccessFilter(AsyncSimpleCustomFilter):
         )
 
 
+class AsyncAdminFilter(AsyncSimpleCustomFilter):
+    key = "admin"
+
+    async def check(self, message: types.Message):
+        return message.from_user.id in di[Configuration]["admin_ids"]
+
+
 class AsyncActionsCallbackFilter(AsyncAdvancedCustomFilter):
     key = "config"
 
@@ -49,6 +67,20 @@ class AsyncActionsCallbackFilter(AsyncAdvancedCustomFilter):
         return config.check(query=call)
 
 
+class AsyncSessionStateFilter(AsyncAdvancedCustomFilter):
+    key = "state"
+
+    async def check(self, update, states):
+        return state_matches(await di[SessionManager].async_state(update), states)
+
+
+class SessionStateFilter(AdvancedCustomFilter):
+    key = "state"
+
+    def check(self, update, states):
+        return state_matches(di[SessionManager].state(update), states)
+
+
 class ActionsCallbackFilter(AdvancedCustomFilter):
     key = "config"
 
@@ -56,6 +88,20 @@ class ActionsCallbackFilter(AdvancedCustomFilter):
         return config.check(query=call)
 
 
+class AsyncCallbackRouteFilter(AsyncAdvancedCustomFilter):
+    key = "route"
+
+    async def check(self, call: types.CallbackQuery, routes):
+        return route_matches(di[CallbackRouter].resolve(call), routes)
+
+
+class CallbackRouteFilter(AdvancedCustomFilter):
+    key = "route"
+
+    def check(self, call: types.CallbackQuery, routes):
+        return route_matches(di[CallbackRouter].resolve(call), routes)
+
+
 class RestrictAccessFilter(SimpleCustomFilter):
     key = "restrict"
 
@@ -66,19 +112,30 @@ class RestrictAccessFilter(SimpleCustomFilter):
         )
 
 
+class AdminFilter(SimpleCustomFilter):
+    key = "admin"
+
+    def check(self, message: types.Message):
+        return message.from_user.id in di[Configuration]["admin_ids"]
+
+
 class BotFactory:
     def __init__(
         self,
         restrict_access_filter,
+        admin_filter,
         state_filter,
         is_digit_filter,
         actions_callback_filter,
+        callback_route_filter,
         bot_instance,
     ):
         bot_instance.add_custom_filter(restrict_access_filter)
+        bot_instance.add_custom_filter(admin_filter)
         bot_instance.add_custom_filter(state_filter)
         bot_instance.add_custom_filter(is_digit_filter)
         bot_instance.add_custom_filter(actions_callback_filter)
+        bot_instance.add_custom_filter(callback_route_filter)
         self._instance = bot_instance
 
     def create_bot(self):
@@ -96,11 +153,46 @@ class Action(IntEnum):
     done = 11
     start = 100
     quick_end = 200
+    batch_end = 201
     category_list = 300
     category_end = 301
     sw_category_list = 400
     sw_set_group = 401
     sw_set_currency = 402
+    import_file = 500
+
+
+# first word of a quick entry line and the kind of entry it adds
+QUICK_ENTRY_KINDS = {"addexp": "outflow", "addinc": "inflow", "addsplit": "split"}
+QUICK_ENTRY_LABELS = {"outflow": "Expense", "inflow": "Income", "split": "Split"}
+
+# messages with quick entries on more than one line, matched case-insensitively
+QUICK_BATCH_REGEXP = r"^add(exp|inc|split)\b.*\n\s*\S"
+
+_QUICK_NUMBER = r"(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+# command, amount with an optional currency code or symbol, then the remaining tokens
+QUICK_ENTRY_PATTERN = re.compile(
+    rf"""\s*add(?P<kind>exp|inc|split)\s+
+    (?:(?P<code>[a-z]{{3}})\s*|[^\w\s"\#@+-]\s*)?
+    (?P<amount>{_QUICK_NUMBER}(?:\s*[+-]\s*{_QUICK_NUMBER})*)
+    (?P<rest>(?:\s.*)?)$""",
+    re.IGNORECASE | re.VERBOSE | re.DOTALL,
+)
+QUICK_AMOUNT_TERM = re.compile(rf"([+-]?)\s*({_QUICK_NUMBER})")
+# a word or a quoted text, prefixed by # for a category or @ for an account
+QUICK_ENTRY_TOKEN = re.compile(
+    r'\s*(?P<hint>[#@]?)(?:"(?P<quoted>[^"]*)"|(?P<word>[^\s"]+))')
+QUICK_ENTRY_DATE = re.compile(r"(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?")
+
+
+class QuickEntry(NamedTuple):
+    kind: str  # outflow, inflow or split
+    amount: float
+    memo: str
+    date: Optional[str] = None  # mm/dd/yy, today when missing
+    category: Optional[str] = None
+    account: Optional[str] = None
+    currency: Optional[str] = None  # ISO code, the selected currency when missing
 
 
 class TextUtil:
@@ -111,12 +203,17 @@ class TextUtil:
             if key in ("Outflow", "Inflow") and value != "":
                 data.append(
                     f"*{key}* : " +
-                    di[Configuration]["currency"] + f" {int(value):,}"
+                    di[Configuration]["currency"] + f" {TextUtil.format_amount(value)}"
                 )
             else:
                 data.append(f"*{key}* : {value}")
         return "\n".join(data).join(["\n", "\n"])
 
+    def format_amount(amount) -> str:
+        """Format an amount with thousand separators, with cents only when it has some."""
+        amount = float(amount)
+        return f"{amount:,.0f}" if amount.is_integer() else f"{amount:,.2f}"
+
     def text_splitter(text):
         lex = shlex.shlex(text)
         lex.quotes = '"'
@@ -124,6 +221,105 @@ class TextUtil:
         lex.commenters = ""
         return list(lex)
 
+    def parse_quick_entry(text: str) -> QuickEntry:
+        """
+        Parse an AddExp, AddInc or AddSplit line in one pass of precompiled patterns.
+        The amount may carry a currency symbol or code, thousand separators and sums
+        like 120+35; the memo is a word or quoted text. A date, #category and @account
+        may follow, a plain word after the memo is taken as the category.
+        Raises ValueError with the reason the line could not be parsed.
+        """
+        match = QUICK_ENTRY_PATTERN.match(text)
+        if match is None:
+            words = text.split()
+            if not words or words[0].lower() not in QUICK_ENTRY_KINDS:
+                raise ValueError(f"unknown entry {words[0] if words else text}")
+            raise ValueError(f"invalid amount {words[1]}" if len(words) > 1 else "missing amount")
+
+        amount = 0.0
+        for sign, number in QUICK_AMOUNT_TERM.findall(match["amount"]):
+            number = float(number.replace(",", ""))
+            amount += -number if sign == "-" else number
+        if amount <= 0:
+            raise ValueError(f"amount must be positive, got {match['amount']}")
+        amount = round(amount, 2)
+        # whole amounts stay ints so the sheet row gets 120 as typed rather than 120.0
+        if amount.is_integer():
+            amount = int(amount)
+
+        rest = match["rest"]
+        fields = {}
+        position = 0
+        while token := QUICK_ENTRY_TOKEN.match(rest, position):
+            position = token.end()
+            value = token["quoted"] if token["quoted"] is not None else token["word"]
+            if token["hint"]:
+                field = "category" if token["hint"] == "#" else "account"
+            elif "memo" not in fields:
+                field = "memo"
+            elif "date" not in fields and (date := DateUtil.parse_date(value)) is not None:
+                field, value = "date", date
+            else:
+                field = "category"
+            if field in fields:
+                raise ValueError(f"unexpected {value}")
+            fields[field] = value
+        if rest[position:].strip():
+            raise ValueError(f"unterminated quote in {rest[position:].strip()}")
+        if "memo" not in fields:
+            raise ValueError("missing memo")
+        if not fields["memo"].strip():
+            raise ValueError("empty memo")
+        return QuickEntry(
+            kind=QUICK_ENTRY_KINDS["add" + match["kind"].lower()],
+            amount=amount,
+            currency=match["code"].upper() if match["code"] else None,
+            **fields,
+        )
+
+    def parse_quick_entries(text: str) -> tuple[list[dict], list[str]]:
+        """
+        Parse a message with one AddExp, AddInc or AddSplit entry per line, splits
+        without a category go to General. Returns the entries and an error for every
+        line that could not be parsed.
+        """
+        entries = []
+        errors = []
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = TextUtil.parse_quick_entry(line)
+                if entry.kind == "split" and entry.category is None:
+                    entry = entry._replace(category="General")
+                entry = resolve_quick_entry(entry)
+            except ValueError as e:
+                errors.append(f"line {line_number}: {e}")
+                continue
+            entries.append(entry._asdict())
+        return entries, errors
+
+    def describe_entry(entry: dict) -> str:
+        amount = TextUtil.format_amount(entry["amount"])
+        if entry.get("currency"):
+            amount = f"{entry['currency']} {amount}"
+        text = f"{QUICK_ENTRY_LABELS[entry['kind']]} {amount} {entry['memo']}"
+        if entry.get("date"):
+            text += f" on {entry['date']}"
+        if entry.get("category"):
+            text += f" ({entry['category']})"
+        if entry.get("account"):
+            text += f" @{entry['account']}"
+        return text
+
+    def format_batch(entries: list[dict], errors: list[str]) -> str:
+        lines = [f"{i}. {TextUtil.describe_entry(entry)}" for i,
+                 entry in enumerate(entries, start=1)]
+        if errors:
+            lines.append(f"Skipped {len(errors)}:")
+            lines.extend(errors)
+        return "\n".join(lines)
+
 
 class DateUtil:
     def date_today() -> str:
@@ -132,9 +328,90 @@ class DateUtil:
         today = str(today.strftime("%m/%d/%y"))
         return today
 
+    def parse_date(value: str) -> Optional[str]:
+        """
+        Date of a quick entry written as today, yesterday, mm/dd or mm/dd/yy,
+        formatted like date_today. A mm/dd date later than today is taken from
+        last year. None if value is not a date, ValueError if it is not a valid one.
+        """
+        today = datetime.datetime.now(tz=pytz.timezone('Asia/Manila')).date()
+        if value.lower() == "today":
+            return today.strftime("%m/%d/%y")
+        if value.lower() == "yesterday":
+            return (today - datetime.timedelta(days=1)).strftime("%m/%d/%y")
+        match = QUICK_ENTRY_DATE.fullmatch(value)
+        if match is None:
+            return None
+        month, day, year = match.groups()
+        try:
+            if year:
+                date = datetime.date(int(year) + 2000 if len(year) == 2 else int(year),
+                                     int(month), int(day))
+            else:
+                date = datetime.date(today.year, int(month), int(day))
+                if date > today:
+                    date = date.replace(year=today.year - 1)
+        except ValueError:
+            raise ValueError(f"invalid date {value}") from None
+        return date.strftime("%m/%d/%y")
+
+
+def resolve_quick_entry(entry: QuickEntry) -> QuickEntry:
+    """
+    Replace the category and account hints of an entry with the names they match:
+    Aspire categories and accounts, or Splitwise subcategories for splits.
+    Raises ValueError for hints and currencies that match nothing.
+    """
+    if entry.kind == "split":
+        if entry.account is not None:
+            raise ValueError("splits do not take an account")
+        if entry.currency is not None and di[SplitwiseCache].currency(entry.currency) is None:
+            raise ValueError(f"unknown currency {entry.currency}")
+        names = di[SplitwiseCache].subcategory_names()
+    else:
+        if entry.currency is not None:
+            raise ValueError("currencies are only supported for AddSplit")
+        names = [category for group in di["trx_categories"].values()
+                 for category in group]
+    category = account = None
+    if entry.category is not None:
+        category = match_name(entry.category, names)
+        if category is None:
+            raise ValueError(f"unknown category {entry.category}")
+    if entry.account is not None:
+        account = match_name(entry.account, di["trx_accounts"])
+        if account is None:
+            raise ValueError(f"unknown account {entry.account}")
+    return entry._replace(category=category, account=account)
+
+
+def quick_entry_row(entry: dict) -> list:
+    """
+    Transactions row of a parsed AddExp or AddInc entry, dated today unless it has a date
+    """
+    return [
+        entry.get("date") or DateUtil.date_today(),
+        entry["amount"] if entry["kind"] == "outflow" else "",
+        entry["amount"] if entry["kind"] == "inflow" else "",
+        entry.get("category") or "",
+        entry.get("account") or "",
+        entry["memo"],
+    ]
+
+
+def quick_entry_expense(entry: dict):
+    """
+    Splitwise expense of a parsed AddSplit entry in the selected group, in the
+    selected currency unless the entry has one
+    """
+    return create_expense_object(
+        di["self_id"], di["friend_id"], di["group_id"], entry["category"], entry["amount"], entry["memo"],
+        currency=entry.get("currency"), date=entry.get("date"))
+
 
 class TransactionData(dict[str, Any]):
     def reset(self):
+        self.clear()
         self["Date"] = ""
         self["Outflow"] = ""
         self["Inflow"] = ""
@@ -143,6 +420,408 @@ class TransactionData(dict[str, Any]):
         self["Memo"] = ""
 
 
+class Session:
+    """
+    Conversation of one user in one chat: the transaction draft, the current
+    Action and the id of the message the bot keeps editing
+    """
+
+    def __init__(self, chat_id: int, user_id: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.trx = TransactionData()
+        self.trx.reset()
+        self.state: Optional[Action] = None
+        self.message_id: Optional[int] = None
+        self.batch: list[dict] = []
+
+    def reset(self):
+        self.trx.reset()
+        self.state = None
+        self.message_id = None
+        self.batch = []
+
+    def is_empty(self) -> bool:
+        return (
+            self.state is None
+            and self.message_id is None
+            and not self.batch
+            and not any(self.trx.values())
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "trx": dict(self.trx),
+            "state": int(self.state) if self.state is not None else None,
+            "message_id": self.message_id,
+            "batch": self.batch,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        session = cls(data["chat_id"], data["user_id"])
+        session.trx.update(data["trx"])
+        session.state = Action(data["state"]) if data["state"] is not None else None
+        session.message_id = data["message_id"]
+        session.batch = data.get("batch", [])
+        return session
+
+
+class SessionManager:
+    """
+    Sessions keyed by (chat_id, user_id) so concurrent users do not overwrite each
+    other. Sessions live in a StateStore and expire `ttl` seconds after their last update.
+    """
+
+    def __init__(self, store: StateStore = None, ttl: float = 86400):
+        self.store = store if store is not None else MemoryStore()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._locks = weakref.WeakValueDictionary()
+        self._async_locks = weakref.WeakValueDictionary()
+        # saves per session, tells whether a session loaded by the state filter is stale
+        self._versions: dict[tuple[int, int], int] = {}
+
+    @staticmethod
+    def key(update) -> tuple[int, int]:
+        if isinstance(update, types.CallbackQuery):
+            return update.message.chat.id, update.from_user.id
+        return update.chat.id, update.from_user.id
+
+    @staticmethod
+    def store_key(chat_id: int, user_id: int) -> str:
+        return f"session:{chat_id}:{user_id}"
+
+    def get(self, update) -> Session:
+        """
+        Session of the sender, reuses the one the state filter loaded for this update
+        unless a handler saved the session since
+        """
+        key = self.key(update)
+        loaded = update.__dict__.pop("loaded_session", None)
+        if loaded is not None and loaded[0] == self._versions.get(key, 0):
+            return loaded[1]
+        return self._load(key)
+
+    def _load(self, key: tuple[int, int]) -> Session:
+        data = self.store.get(self.store_key(*key))
+        return Session.from_dict(data) if data else Session(*key)
+
+    def _load_state(self, update) -> Optional[Action]:
+        key = self.key(update)
+        session = self._load(key)
+        update.loaded_session = (self._versions.get(key, 0), session)
+        update.session_state = session.state
+        return session.state
+
+    def state(self, update) -> Optional[Action]:
+        """
+        State seen by handler filters, read from the store once per update under the
+        session lock, so it is never read while a handler is changing the session
+        """
+        if not hasattr(update, "session_state"):
+            with self.lock(update):
+                return self._load_state(update)
+        return update.session_state
+
+    async def async_state(self, update) -> Optional[Action]:
+        """
+        State seen by async handler filters, see state
+        """
+        if not hasattr(update, "session_state"):
+            async with self.async_lock(update):
+                return self._load_state(update)
+        return update.session_state
+
+    def save(self, session: Session):
+        key = (session.chat_id, session.user_id)
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+        store_key = self.store_key(*key)
+        if session.is_empty():
+            self.store.delete(store_key)
+        else:
+            self.store.set(store_key, session.to_dict(), self.ttl)
+
+    def lock(self, update) -> threading.RLock:
+        """
+        Lock held by sync handlers while they work on a session
+        """
+        key = self.key(update)
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.RLock()
+            return lock
+
+    def async_lock(self, update) -> asyncio.Lock:
+        """
+        Lock held by async handlers while they work on a session
+        """
+        key = self.key(update)
+        with self._lock:
+            lock = self._async_locks.get(key)
+            if lock is None:
+                lock = self._async_locks[key] = asyncio.Lock()
+            return lock
+
+
+def with_session(func):
+    """
+    Decorator for handlers, passes the session of the sender as second argument,
+    serializes updates of the same session and saves the session afterwards.
+    Handlers calling each other can pass the session along explicitly.
+    """
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(update, session: Session = None):
+            if session is not None:
+                return await func(update, session)
+            async with di[SessionManager].async_lock(update):
+                session = di[SessionManager].get(update)
+                try:
+                    return await func(update, session)
+                finally:
+                    di[SessionManager].save(session)
+
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(update, session: Session = None):
+        if session is not None:
+            return func(update, session)
+        with di[SessionManager].lock(update):
+            session = di[SessionManager].get(update)
+            try:
+                return func(update, session)
+            finally:
+                di[SessionManager].save(session)
+
+    return wrapper
+
+
+def state_matches(state: Optional[Action], states) -> bool:
+    if states == "*":
+        return state is not None
+    if isinstance(states, list):
+        return state in states
+    return state == states
+
+
+class UpdateDeduplicator:
+    """
+    Remembers update_ids seen in the last `window` seconds so webhook retries from
+    Telegram are not processed twice. The optional store shares them between workers.
+    """
+
+    def __init__(self, store: StateStore = None, window: float = 300, max_entries=10000):
+        self.store = store
+        self.window = window
+        self.max_entries = max_entries
+        self._seen: OrderedDict[int, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, update_id: Optional[int]) -> bool:
+        """
+        Whether the update was seen already, records it otherwise
+        """
+        if update_id is None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._seen and (
+                    len(self._seen) >= self.max_entries
+                    or next(iter(self._seen.values())) < now - self.window):
+                self._seen.popitem(last=False)
+            if update_id in self._seen:
+                return True
+            self._seen[update_id] = now
+        if self.store is not None:
+            try:
+                return not self.store.add(f"update:{update_id}", {}, self.window)
+            except (ConnectionError, OSError) as e:
+                # better to process a redelivery twice than to drop a new update
+                di[Logger].warning(f"Could not check update {update_id} in the store: {e}")
+        return False
+
+    def forget(self, update_id: Optional[int]):
+        """
+        Accept the update again, e.g. after it was refused and will be resent
+        """
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.store is not None:
+            try:
+                self.store.delete(f"update:{update_id}")
+            except (ConnectionError, OSError) as e:
+                # the resent update is dropped as a duplicate until the claim expires
+                di[Logger].warning(f"Could not release update {update_id} in the store: {e}")
+
+
+class UpdateRecorder:
+    """
+    Appends raw webhook updates to a JSONL file so production traffic can be
+    replayed with benchmarks.replay. User and chat ids are replaced by a keyed
+    hash and names are dropped, the same user always gets the same pseudonym.
+    """
+
+    # objects of an update that describe a user or a chat
+    PEOPLE = ("from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat",
+              "via_bot", "contact", "left_chat_member", "new_chat_members")
+    PERSONAL = ("last_name", "username", "phone_number", "bio", "title", "vcard")
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key.encode()
+        self._lock = threading.Lock()
+
+    def pseudonym(self, id: int) -> int:
+        digest = hmac.new(self.key, str(abs(id)).encode(), hashlib.sha256).digest()
+        pseudonym = int.from_bytes(digest[:6], "big") or 1
+        return -pseudonym if id < 0 else pseudonym
+
+    def anonymize(self, value):
+        if isinstance(value, list):
+            return [self.anonymize(i) for i in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in self.PEOPLE:
+                people = item if isinstance(item, list) else [item]
+                people = [self.person(i) for i in people]
+                item = people if isinstance(item, list) else people[0]
+            result[key] = self.anonymize(item)
+        return result
+
+    def person(self, data: dict) -> dict:
+        data = {key: value for key, value in data.items() if key not in self.PERSONAL}
+        if isinstance(data.get("id"), int):
+            data["id"] = self.pseudonym(data["id"])
+        if "user_id" in data:
+            data["user_id"] = self.pseudonym(data["user_id"])
+        if "first_name" in data:
+            data["first_name"] = "user"
+        return data
+
+    def record(self, data: dict):
+        line = json.dumps({"received_at": time.time(), "update": self.anonymize(data)},
+                          ensure_ascii=False)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            di[Logger].warning(f"Could not record update {data.get('update_id')}: {e}")
+
+
+class UpdateDispatcher:
+    """
+    Processes webhook updates on a pool of worker threads so the webhook can answer
+    right away. Updates of a chat always go to the same worker and keep their order.
+    Each worker has a bounded queue, updates that do not fit are refused.
+    """
+
+    def __init__(self, process, workers=4, max_pending=100):
+        self.process = process
+        self._queues = [queue.Queue(maxsize=max(1, max_pending // workers))
+                        for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,),
+                             name=f"updates-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @staticmethod
+    def chat_id(data: dict) -> int:
+        for key, value in data.items():
+            if not isinstance(value, dict):
+                continue
+            message = value.get("message", value)
+            if isinstance(message, dict) and "chat" in message:
+                return message["chat"]["id"]
+            if "from" in value:
+                return value["from"]["id"]
+        return 0
+
+    def submit(self, data: dict) -> bool:
+        """
+        Queue a raw update, returns False when the worker of its chat is full
+        """
+        chat_id = self.chat_id(data)
+        worker = self._queues[hash(chat_id) % len(self._queues)]
+        try:
+            worker.put_nowait(data)
+        except queue.Full:
+            di[Logger].warning(
+                f"Shedding update {data.get('update_id')} for chat {chat_id}: "
+                f"{worker.qsize()} updates already waiting")
+            return False
+        return True
+
+    def close(self):
+        """
+        Process what is queued and stop the workers
+        """
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, updates: queue.Queue):
+        while True:
+            data = updates.get()
+            if data is None:
+                return
+            try:
+                self.process(types.Update.de_json(data))
+            except Exception as e:
+                di[Logger].error(
+                    f"Failed to process update {data.get('update_id')}: {e}")
+
+
+class CallbackRouter:
+    """
+    Resolves callback data of the form "<prefix>;<payload>" with one dict lookup for
+    the prefix and one for the payload, however many categories or accounts there are.
+    Each prefix is registered with a lookup returning the value behind a payload, or
+    None when the payload is unknown.
+    """
+
+    def __init__(self):
+        self._routes: dict[str, Callable[[str], Any]] = {}
+
+    def register(self, prefix: str, lookup: Callable[[str], Any]):
+        self._routes[prefix] = lookup
+
+    def resolve(self, call: types.CallbackQuery) -> Optional[tuple[str, Any]]:
+        """
+        Route and value of a callback query, resolved once per update
+        """
+        if not hasattr(call, "route"):
+            call.route = self.match(call.data)
+        return call.route
+
+    def match(self, data: str) -> Optional[tuple[str, Any]]:
+        prefix, separator, payload = (data or "").partition(";")
+        lookup = self._routes.get(prefix) if separator else None
+        if lookup is None:
+            return None
+        value = lookup(payload)
+        return (prefix, value) if value is not None else None
+
+
+def route_matches(route: Optional[tuple[str, Any]], routes) -> bool:
+    if route is None:
+        return False
+    if isinstance(routes, str):
+        return route[0] == routes
+    return route[0] in routes
+
+
 class KeyboardUtil:
     def create_save_keyboard(callback_data: str):
         return types.InlineKeyboardMarkup(
@@ -152,6 +831,18 @@ class KeyboardUtil:
             ]
         )
 
+    def create_batch_keyboard():
+        return types.InlineKeyboardMarkup(
+            keyboard=[
+                [
+                    types.InlineKeyboardButton(
+                        text="💾 Save all", callback_data="batch_save"),
+                    types.InlineKeyboardButton(
+                        text="Cancel", callback_data="batch_cancel"),
+                ]
+            ]
+        )
+
     def create_default_options_keyboard():
         """
         Menu keyboard for start command
@@ -169,7 +860,7 @@ class KeyboardUtil:
                 )
         return types.InlineKeyboardMarkup(keyboard)
 
-    def create_options_keyboard():
+    def create_options_keyboard(trx: TransactionData):
         """
         Menu keyboard for updating transaction data
         """
@@ -184,7 +875,7 @@ class KeyboardUtil:
                     )
                 ]
             else:
-                data = di[TransactionData][action.name.capitalize()]
+                data = trx[action.name.capitalize()]
                 if action == Action.outflow or action == Action.inflow:
                     displayData = (
                         f"{action.name.capitalize()}: "
@@ -221,21 +912,98 @@ class KeyboardUtil:
         keyboard.append(row)
         return types.InlineKeyboardMarkup(keyboard)
 
-    def create_sw_keyboard(categories, column_size=2):
+    def create_sw_keyboard(categories, prefix, column_size=2):
+        """
+        categories are (text, key) pairs, buttons send "<prefix>;<key>"
+        """
         keyboard = []
         row = []
-        for category in categories:
+        for text, key in categories:
             row.append(types.InlineKeyboardButton(
-                category, callback_data=category))
+                text, callback_data=f"{prefix};{key}"))
             if len(row) == column_size:
                 keyboard.append(row)
                 row = []
         keyboard.append(row)
         return types.InlineKeyboardMarkup(keyboard)
 
-    def create_subcategory_keyboard(category_name, column_size=3):
-        subcategories = get_subcategories(di["sw_categories"], category_name)
-        return KeyboardUtil.create_sw_keyboard(subcategories, column_size)
+    def create_subcategory_keyboard(category, column_size=3):
+        return di[KeyboardCache].get(
+            ("sw_sub", category.id),
+            lambda: KeyboardUtil.create_sw_keyboard(
+                [(subcategory.name, subcategory.id) for subcategory in category.subcategories], "sw_sub", column_size))
+
+    def create_sw_category_keyboard():
+        categories = di[SplitwiseCache].categories()
+        return di[KeyboardCache].get(
+            ("sw_cat",),
+            lambda: KeyboardUtil.create_sw_keyboard([(category.name, category.id) for category in categories], "sw_cat"))
+
+    def create_sw_group_keyboard():
+        groups = di[SplitwiseCache].groups()
+        return di[KeyboardCache].get(
+            ("sw_group",),
+            lambda: KeyboardUtil.create_sw_keyboard([(group.name, group.id) for group in groups], "sw_group", column_size=3))
+
+    def create_sw_currency_keyboard():
+        currencies = di[SplitwiseCache].currencies()
+        return di[KeyboardCache].get(
+            ("sw_cur",),
+            lambda: KeyboardUtil.create_sw_keyboard([(currency.code, currency.code) for currency in currencies], "sw_cur", column_size=4))
+
+    def create_category_group_keyboard():
+        return di[KeyboardCache].get(
+            ("group_sel",),
+            lambda: create_category_inline(di["trx_categories"].keys(), "group_sel"))
+
+    def create_category_keyboard(group_name):
+        return di[KeyboardCache].get(
+            ("save", group_name),
+            lambda: create_category_inline(di["trx_categories"][group_name], "save"))
+
+    def create_account_keyboard():
+        return di[KeyboardCache].get(
+            ("acc_sel",),
+            lambda: create_account_inline(di["trx_accounts"], "acc_sel"))
+
+    def create_calendar_keyboard(year=None, month=None):
+        return di[KeyboardCache].calendar(year, month)
+
+
+class EventLoopThread:
+    """
+    Long-lived event loop running on its own thread. AsyncTeleBot calls are
+    submitted to it so aiohttp sessions and connection pools survive between
+    webhook requests instead of being torn down by asyncio.run every time.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="bot-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the loop, returns a concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the loop and block until it is done
+        """
+        return self.submit(coro).result(timeout)
+
+    def stop(self, bot_instance: AsyncTeleBot = None):
+        if bot_instance is not None:
+            try:
+                self.run(bot_instance.close_session(), timeout=5)
+            except Exception as e:
+                di[Logger].warning(f"Could not close bot session: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
 
 
 def silence_event_loop_closed(func):
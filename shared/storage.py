@@ -0,0 +1,383 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Iterable, NamedTuple, Optional
+from urllib.parse import unquote, urlparse
+
+
+class StateStore:
+    """
+    Key value storage for bot state. Values are JSON serializable dicts that
+    expire `ttl` seconds after they were last written.
+    """
+
+    def get(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: dict, ttl: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def add(self, key: str, value: dict, ttl: float) -> bool:
+        """
+        Store value only if key is missing or expired, returns whether it was stored
+        """
+        raise NotImplementedError
+
+
+class MemoryStore(StateStore):
+    """
+    In-process LRU store, only suitable for a single worker
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return json.loads(value)
+
+    def set(self, key: str, value: dict, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, json.dumps(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def add(self, key: str, value: dict, ttl: float) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return False
+        self.set(key, value, ttl)
+        return True
+
+
+class SQLiteStore(StateStore):
+    """
+    SQLite file in WAL mode, shared by workers on the same host and kept across restarts
+    """
+
+    purge_interval = 300
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS state "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._purged_at = 0.0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM state WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: dict, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl),
+            )
+            if now - self._purged_at > self.purge_interval:
+                self._connection.execute(
+                    "DELETE FROM state WHERE expires_at < ?", (now,))
+                self._purged_at = now
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def add(self, key: str, value: dict, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE state.expires_at < ?",
+                (key, json.dumps(value), now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+
+class OutboxEntry(NamedTuple):
+    key: str
+    kind: str
+    payload: dict
+    status: str
+    result: Any
+    attempts: int
+    created_at: float
+
+
+class Outbox:
+    """
+    Append-only journal of writes to Sheets and Splitwise in a SQLite file (WAL).
+    Entries are recorded before they are sent and confirmed once the remote side
+    accepted them, so writes cut short by a restart or an outage can be replayed.
+    A journal file belongs to a single process.
+    """
+
+    pending = "pending"  # recorded, not sent yet
+    sending = "sending"  # sent, the outcome is unknown until confirmed
+    retry = "retry"  # failed with a transient error, replayed later
+    done = "done"
+    failed = "failed"
+
+    purge_interval = 3600
+
+    def __init__(self, path: str, retention=7 * 86400):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # entries must survive a crash right after they are recorded
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox "
+            "(key TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, created_at)")
+        self._purged_at = 0.0
+
+    def record(self, kind: str, payload: dict, key: str = None) -> str:
+        """
+        Journal a write before sending it. An existing key, e.g. when replaying,
+        is left as it is.
+        """
+        return self.record_many(kind, [payload], [key])[0]
+
+    def record_many(self, kind: str, payloads: list[dict], keys: list[str] = None) -> list[str]:
+        """
+        Journal several writes with a single commit, returns their keys
+        """
+        keys = [key or uuid.uuid4().hex for key in keys or [None] * len(payloads)]
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "INSERT INTO outbox (key, kind, payload, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                    [(key, kind, json.dumps(payload), self.pending, now, now)
+                     for key, payload in zip(keys, payloads)],
+                )
+                if now - self._purged_at > self.purge_interval:
+                    self._connection.execute(
+                        "DELETE FROM outbox WHERE status IN (?, ?) AND updated_at < ?",
+                        (self.done, self.failed, now - self.retention),
+                    )
+                    self._purged_at = now
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return keys
+
+    def mark(self, keys: Iterable[str], status: str, results: Iterable = None):
+        """
+        Move entries to `status`, optionally storing a result per entry. Entries
+        marked as sending count one more attempt.
+        """
+        keys = list(keys)
+        results = [json.dumps(result) for result in results] if results is not None \
+            else [None] * len(keys)
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE outbox SET status = ?, result = COALESCE(?, result), "
+                "attempts = attempts + ?, updated_at = ? WHERE key = ?",
+                [(status, result, int(status == self.sending), now, key)
+                 for key, result in zip(keys, results)],
+            )
+
+    def entries(self, statuses: Iterable[str], kind: str = None) -> list[OutboxEntry]:
+        statuses = list(statuses)
+        query = (f"SELECT key, kind, payload, status, result, attempts, created_at FROM outbox "
+                 f"WHERE status IN ({', '.join('?' * len(statuses))})")
+        params = statuses
+        if kind is not None:
+            query += " AND kind = ?"
+            params = statuses + [kind]
+        with self._lock:
+            rows = self._connection.execute(
+                query + " ORDER BY created_at", params).fetchall()
+        return [
+            OutboxEntry(key, kind, json.loads(payload), status,
+                        json.loads(result) if result is not None else None, attempts, created_at)
+            for key, kind, payload, status, result, attempts, created_at in rows
+        ]
+
+
+class RedisClient:
+    """
+    Minimal client for the Redis protocol (RESP), enough for GET/SET/DEL
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._reader = None
+
+    def execute(self, *args):
+        with self._lock:
+            sent = []
+            try:
+                return self._execute(args, sent)
+            except (ConnectionError, OSError):
+                self._close()
+                # a command that reached the server may have run already
+                if sent and not self.idempotent(args):
+                    raise
+                # the server may have dropped an idle connection, retry once
+                return self._execute(args, [])
+
+    def _execute(self, args, sent: list):
+        if self._socket is None:
+            self._connect()
+        self._socket.sendall(self._encode(args))
+        sent.append(True)
+        return self._read()
+
+    @staticmethod
+    def idempotent(args) -> bool:
+        """
+        Whether running the command twice has the same outcome as running it once
+        """
+        command = str(args[0]).upper()
+        if command == "SET":
+            return not {"NX", "XX"} & {str(arg).upper() for arg in args[3:]}
+        return command in ("GET", "DEL", "PING", "SELECT", "AUTH")
+
+    def _connect(self):
+        self._socket = socket.create_connection(
+            (self.host, self.port), timeout=self.timeout)
+        self._reader = self._socket.makefile("rb")
+        if self.password:
+            self._socket.sendall(self._encode(("AUTH", self.password)))
+            self._read()
+        if self.db:
+            self._socket.sendall(self._encode(("SELECT", self.db)))
+            self._read()
+
+    def _close(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by Redis server")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode("utf-8")
+        if prefix == b"-":
+            raise RuntimeError(payload.decode("utf-8"))
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read() for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+
+class RedisStore(StateStore):
+    """
+    Store backed by any server speaking the Redis protocol, shared by all workers
+    """
+
+    def __init__(self, client: RedisClient, prefix="aspire-bot:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.client.execute("GET", self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: dict, ttl: float):
+        self.client.execute("SET", self.prefix + key,
+                            json.dumps(value), "PX", int(ttl * 1000))
+
+    def delete(self, key: str):
+        self.client.execute("DEL", self.prefix + key)
+
+    def add(self, key: str, value: dict, ttl: float) -> bool:
+        return self.client.execute("SET", self.prefix + key,
+                                   json.dumps(value), "PX", int(ttl * 1000), "NX") is not None
+
+
+def create_store(url: str) -> StateStore:
+    """
+    Create a store from a url: memory://, sqlite:///path/to/file.db or redis://[:password@]host:port/db
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "memory"):
+        return MemoryStore()
+    if parsed.scheme == "sqlite":
+        path = parsed.netloc + parsed.path
+        return SQLiteStore(unquote(path[1:] if path.startswith("/") else path))
+    if parsed.scheme == "redis":
+        client = RedisClient(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(parsed.path[1:] or 0),
+            password=unquote(parsed.password) if parsed.password else None,
+        )
+        return RedisStore(client)
+    raise ValueError(f"Unsupported state store: {url}")
@@ -0,0 +1,270 @@
+import asyncio
+import inspect
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from logging import INFO, Logger
+from typing import Iterable, Optional
+
+from telebot import types
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional["Span"]:
+    """
+    Span of the code running right now, None outside of traced updates
+    """
+    return _current_span.get()
+
+
+def update_chat_id(update: types.Update) -> Optional[int]:
+    message = update.message or update.edited_message or update.channel_post
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    return None
+
+
+def update_type(update: types.Update) -> str:
+    return next((name for name, value in vars(update).items()
+                 if name != "update_id" and value is not None), "unknown")
+
+
+class Span:
+    """
+    One timed operation of a trace. Spans of an update carry its update_id and chat.
+    """
+
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "update_id", "chat_id",
+                 "attributes", "links", "start", "end", "error")
+
+    def __init__(self, name: str, kind=INTERNAL, parent: "Span" = None,
+                 links: Iterable["Span"] = (), attributes: dict = None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.update_id = parent.update_id if parent else None
+        self.chat_id = parent.chat_id if parent else None
+        self.attributes = attributes or {}
+        self.links = list(links)
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_log(self) -> dict:
+        data = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "update_id": self.update_id,
+            "chat_id": self.chat_id,
+            "start": self.start / 1e9,
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.links:
+            data["links"] = [{"trace_id": span.trace_id, "span_id": span.span_id}
+                             for span in self.links]
+        if self.error:
+            data["error"] = self.error
+        return data
+
+    def to_otlp(self) -> dict:
+        attributes = dict(self.attributes)
+        if self.update_id is not None:
+            attributes["telegram.update_id"] = self.update_id
+        if self.chat_id is not None:
+            attributes["telegram.chat_id"] = self.chat_id
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        if self.links:
+            data["links"] = [{"traceId": span.trace_id, "spanId": span.span_id}
+                             for span in self.links]
+        return data
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(i) for i in value]}}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """
+    Spans for each update, its handlers and the calls they make to the Bot API,
+    Google Sheets and Splitwise. Spans of a trace are kept until its root span
+    ends and dropped when it took less than `min_duration` seconds. The others are
+    logged as JSON lines and appended to `export_path` in the OTLP JSON format.
+    """
+
+    def __init__(self, logger: Logger, log_spans=False, export_path="", min_duration=0.0,
+                 service_name="aspire-budget-bot", max_traces=1000):
+        self.logger = logger
+        # spans are logged at INFO, whatever the level of the bot logger
+        self.span_logger = logger.getChild("trace") if log_spans else None
+        if self.span_logger is not None:
+            self.span_logger.setLevel(INFO)
+        self.export_path = export_path
+        self.min_duration = min_duration
+        self.service_name = service_name
+        self.max_traces = max_traces
+        self._pending: OrderedDict[str, list[Span]] = OrderedDict()
+        self._finished: OrderedDict[str, bool] = OrderedDict()
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.span_logger is not None or bool(self.export_path)
+
+    @contextmanager
+    def span(self, name: str, kind=INTERNAL, links: Iterable[Span] = (), **attributes):
+        """
+        Child of the current span, or the root of a new trace
+        """
+        span = Span(name, kind, _current_span.get(), links, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time_ns()
+            self._finish(span)
+
+    def handler(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self.span(f"handler {name}", handler=name)
+
+    def backend(self, backend: str, operation: str):
+        if not self.enabled:
+            return nullcontext()
+        return self.span(f"{backend} {operation}", CLIENT, backend=backend, operation=operation)
+
+    def batch(self, name: str, links: Iterable[Optional[Span]], **attributes):
+        """
+        Root span of work done for several updates at once, linked to their spans
+        """
+        if not self.enabled:
+            return nullcontext()
+        links = [span for span in links if span is not None]
+        update_ids = sorted({span.update_id for span in links if span.update_id is not None})
+        return self.span(name, links=links, update_ids=update_ids, **attributes)
+
+    @contextmanager
+    def update(self, update: types.Update):
+        """
+        Root span of an update, its update_id and chat are passed on to every child
+        """
+        with self.span("update", SERVER, update_type=update_type(update)) as span:
+            span.update_id = update.update_id
+            span.chat_id = update_chat_id(update)
+            yield span
+
+    def _finish(self, span: Span):
+        with self._lock:
+            if span.parent_id is None:
+                spans = self._pending.pop(span.trace_id, [])
+                spans.append(span)
+                keep = span.duration >= self.min_duration
+                self._finished[span.trace_id] = keep
+                while len(self._finished) > self.max_traces:
+                    self._finished.popitem(last=False)
+                if not keep:
+                    return
+            elif span.trace_id in self._finished:
+                # e.g. a background write that outlived its update
+                if not self._finished[span.trace_id]:
+                    return
+                spans = [span]
+            else:
+                self._pending.setdefault(span.trace_id, []).append(span)
+                while len(self._pending) > self.max_traces:
+                    self._pending.popitem(last=False)
+                return
+        self.emit(spans)
+
+    def emit(self, spans: list[Span]):
+        if self.span_logger is not None:
+            for span in spans:
+                self.span_logger.info(json.dumps(span.to_log(), default=str))
+        if self.export_path:
+            line = json.dumps({"resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "shared.tracing"},
+                                "spans": [span.to_otlp() for span in spans]}],
+            }]}, default=str)
+            try:
+                with self._export_lock, open(self.export_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                self.logger.warning(f"Could not export spans: {e}")
+
+
+def trace_updates(bot, tracer: Tracer):
+    """
+    Process each update of TeleBot or AsyncTeleBot in its own root span, for
+    webhook and polling alike
+    """
+    process_new_updates = bot.process_new_updates
+    if inspect.iscoroutinefunction(process_new_updates):
+        async def process_one(update):
+            with tracer.update(update):
+                await process_new_updates([update])
+
+        @wraps(process_new_updates)
+        async def async_traced(updates):
+            await asyncio.gather(*(process_one(update) for update in updates))
+
+        bot.process_new_updates = async_traced
+        return
+
+    @wraps(process_new_updates)
+    def traced(updates):
+        for update in updates:
+            with tracer.update(update):
+                process_new_updates([update])
+
+    bot.process_new_updates = traced
@@ -1,19 +1,83 @@
+import asyncio
 import calendar
+import contextvars
+import csv
 import datetime
+import functools
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
 from itertools import groupby
+from logging import Logger
+from typing import NamedTuple, Optional
 
-from gspread import utils
+from gspread import Spreadsheet, utils
 from kink import di
+import requests
+from requests import RequestException
 from splitwise import Splitwise
+from splitwise.exception import SplitwiseException
+from splitwise.category import Category
 from splitwise.expense import Expense
 from splitwise.user import ExpenseUser
 from telebot import types
 
+from shared.storage import Outbox, OutboxEntry
+from shared.tracing import Tracer, current_span
+
+
+def timed(timings: dict[str, float], name: str, func, *args):
+    """
+    Call func and record how long it took under `name`
+    """
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.perf_counter() - started
+
+
+# named ranges of the Configuration sheet, fetched with a single batchGet
+CONFIGURATION_RANGES = [
+    "r_ConfigurationData",
+    "TransactionCategories",
+    "cfg_Accounts",
+    "cfg_Cards",
+]
+
+
+class CategoryGroup(NamedTuple):
+    name: str
+    categories: tuple[str, ...]
+
+
+class AspireConfig(NamedTuple):
+    """
+    Category groups (including "Others") and accounts of an Aspire budget
+    """
+    groups: tuple[CategoryGroup, ...]
+    accounts: tuple[str, ...]
+
+    @property
+    def categories(self) -> dict[str, list]:
+        return {group.name: list(group.categories) for group in self.groups}
 
-def get_all_categories(spreadsheet) -> dict[str, list]:
-    worksheet = spreadsheet.worksheet("Configuration")
-    values = worksheet.get("r_ConfigurationData")
 
+def load_aspire_config(spreadsheet) -> AspireConfig:
+    response = spreadsheet.values_batch_get(CONFIGURATION_RANGES)
+    values, category, accounts, cards = (
+        value_range.get("values", []) for value_range in response["valueRanges"]
+    )
+    return AspireConfig(
+        groups=parse_category_groups(values, category),
+        accounts=tuple(sorted(i for row in accounts + cards for i in row)),
+    )
+
+
+def parse_category_groups(values, category) -> tuple[CategoryGroup, ...]:
     # Find groups and exclude credit card payments
     groups = [i[1]
               for i in values if i[0] == "✦" and "Credit Card" not in i[1]]
@@ -25,35 +89,743 @@ def get_all_categories(spreadsheet) -> dict[str, list]:
             categories.append(list(g))
     categories_titles = [[k[1] for k in i] for i in categories]
 
-    grouped_cats = dict(zip(groups, categories_titles))
-    # Add missing options
-    category = worksheet.get("TransactionCategories")
-    grouped_cats["Others"] = list(
-        set([i for j in category for i in j])
-        ^ set([i for j in categories_titles for i in j])
+    grouped_cats = [CategoryGroup(name, tuple(titles))
+                    for name, titles in zip(groups, categories_titles)]
+    # Add missing options, keeping sheet order so reloads compare equal
+    transaction_categories = [i for j in category for i in j]
+    configured = [i for j in categories_titles for i in j]
+    known, listed = set(configured), set(transaction_categories)
+    others = dict.fromkeys(
+        [i for i in transaction_categories if i not in known]
+        + [i for i in configured if i not in listed]
     )
+    grouped_cats.append(CategoryGroup("Others", tuple(others)))
+
+    return tuple(grouped_cats)
+
+
+def get_all_categories(spreadsheet) -> dict[str, list]:
+    return load_aspire_config(spreadsheet).categories
+
+
+def get_accounts(spreadsheet) -> list[str]:
+    return list(load_aspire_config(spreadsheet).accounts)
+
+
+class RowCursor:
+    """
+    Keeps the first empty row of the Transactions sheet in memory so saves
+    do not have to download the whole `trx_Dates` column every time
+    """
+
+    def __init__(self, worksheet, range_name="trx_Dates", last_column="H", window=10, max_age=60):
+        self.worksheet = worksheet
+        self.range_name = range_name
+        self.last_column = last_column
+        self.window = window
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self._row = None
+        self._first_row = None
+        self._column = ""
+        self._checked_at = 0.0
+
+    def scan(self) -> int:
+        """
+        Full scan of the date range for the first empty cell
+        """
+        cells = self.worksheet.range(self.range_name)
+        next_cell = next(n for n in cells if n.value == "")
+        self._column = utils.rowcol_to_a1(1, next_cell.col)[:-1]
+        self._first_row = cells[0].row
+        self._row = next_cell.row
+        self._checked_at = time.monotonic()
+        return self._row
+
+    def verify(self) -> int:
+        """
+        Re-check the cursor by reading a small window of the date column around it.
+        Falls back to a full scan when the window does not look like the end of the table.
+        """
+        start = self._row - 1 if self._row > self._first_row else self._row
+        end = self._row + self.window - 1
+        values = self.worksheet.get(f"{self._column}{start}:{self._column}{end}")
+        dates = [row[0] if row else "" for row in values]
+        dates.extend([""] * (end - start + 1 - len(dates)))
+
+        offset = self._row - start
+        if offset and dates[0] == "":
+            # rows above the cursor were cleared by another writer
+            return self.scan()
+        free = next((i for i, date in enumerate(dates[offset:]) if date == ""), None)
+        if free is None:
+            return self.scan()
+        self._row += free
+        self._checked_at = time.monotonic()
+        return self._row
+
+    def claim(self, count=1) -> int:
+        """
+        Reserve `count` rows starting at the cursor and move the cursor past them
+        """
+        if self._row is None:
+            self.scan()
+        elif time.monotonic() - self._checked_at > self.max_age:
+            self.verify()
+        row = self._row
+        self._row += count
+        return row
+
+    def invalidate(self):
+        self._row = None
+
+    def read_rows(self, first: int, last: int) -> dict[int, list[str]]:
+        """
+        Values of the rows `first` to `last` of the table by row number, header
+        rows left out
+        """
+        if not self._column:
+            self.scan()
+        first = max(first, self._first_row)
+        values = self.worksheet.get(
+            f"{self._column}{first}:{self.last_column}{last}")
+        return {row: values[row - first] if row - first < len(values) else []
+                for row in range(first, last + 1)}
+
+    def append(self, rows: list[list[str]], on_claim=None):
+        """
+        Write rows at the cursor with a single append call. `on_claim` is called
+        with the target row before writing.
+        """
+        with self.lock:
+            row = self.claim(len(rows))
+            if on_claim is not None:
+                on_claim(row)
+            table_range = f"{self._column}{row}:{self.last_column}{row + len(rows) - 1}"
+            try:
+                response = self.worksheet.append_rows(
+                    values=rows,
+                    table_range=table_range,
+                    value_input_option=utils.ValueInputOption.user_entered,
+                    insert_data_option=0,
+                )
+            except Exception:
+                self.invalidate()
+                raise
+
+            written_row = _updated_row(response)
+            if written_row != row:
+                # another writer got there first, resync with a full scan
+                di[Logger].warning(
+                    f"Expected to write at row {row} but wrote at {written_row}, rescanning {self.range_name}")
+                self.scan()
+            return response
+
+
+def _updated_row(response) -> int:
+    updated_range = response.get("updates", {}).get("updatedRange", "")
+    first_cell = updated_range.split("!")[-1].split(":")[0]
+    return utils.a1_to_rowcol(first_cell)[0] if first_cell else None
+
 
-    return grouped_cats
+_row_cursors: dict[str, RowCursor] = {}
+_row_cursors_lock = threading.Lock()
 
 
-def get_accounts(spreadsheet):
-    worksheet = spreadsheet.worksheet("Configuration")
-    accounts = worksheet.get("cfg_Accounts")
-    cards = worksheet.get("cfg_Cards")
-    accounts.extend(cards)
-    return sorted(accounts)
+def get_row_cursor(spreadsheet) -> RowCursor:
+    with _row_cursors_lock:
+        if spreadsheet.id not in _row_cursors:
+            _row_cursors[spreadsheet.id] = RowCursor(
+                spreadsheet.worksheet("Transactions"))
+        return _row_cursors[spreadsheet.id]
 
 
 def append_trx(spreadsheet, data: list[str]):
-    worksheet = spreadsheet.worksheet("Transactions")
-    next_row = next(n for n in worksheet.range("trx_Dates") if n.value == "")
-    rowRange = next_row.address + ":H" + str(next_row.row)
-    worksheet.append_row(
-        values=data,
-        table_range=rowRange,
-        value_input_option=utils.ValueInputOption.user_entered,
-        insert_data_option=0,
-    )
+    get_row_cursor(spreadsheet).append([data])
+
+
+def append_trx_rows(spreadsheet, rows: list[list[str]], on_claim=None):
+    get_row_cursor(spreadsheet).append(rows, on_claim)
+
+
+def find_written_row(spreadsheet, row_number: int, data: list[str], known_rows: set,
+                     window=20) -> Optional[int]:
+    """
+    Row holding a journaled row that was never confirmed, searched up to `window` rows
+    around the row it was sent to, closest first: an append that timed out may have
+    landed further down when another writer got there first. Dated rows not in
+    `known_rows` are compared on category, account and memo, since they are stored
+    as entered. None if there is none.
+    """
+    rows = get_row_cursor(spreadsheet).read_rows(row_number - window, row_number + window)
+    for number in sorted(rows, key=lambda number: abs(number - row_number)):
+        values = rows[number] + [""] * (len(data) - len(rows[number]))
+        if (number not in known_rows and str(values[0]) != ""
+                and all(str(values[i]) == str(data[i]) for i in (3, 4, 5))):
+            return number
+    return None
+
+
+# CSV header names accepted for each Transactions column
+IMPORT_COLUMNS = {
+    "Date": ("date", "transaction date", "posted date"),
+    "Outflow": ("outflow", "debit", "withdrawal"),
+    "Inflow": ("inflow", "credit", "deposit"),
+    "Amount": ("amount",),
+    "Category": ("category",),
+    "Account": ("account",),
+    "Memo": ("memo", "description", "payee", "details"),
+}
+
+
+# date formats accepted in CSV files, written to the sheet as mm/dd/yy
+IMPORT_DATE_FORMATS = ("%m/%d/%y", "%m/%d/%Y", "%Y-%m-%d")
+
+
+class ImportResult(NamedTuple):
+    imported: int
+    skipped: list[str]
+
+
+class DownloadError(Exception):
+    """
+    A remote file could not be downloaded. The message leaves out the url, which
+    holds the bot token for Telegram files.
+    """
+
+
+def stream_lines(url: str, timeout=30):
+    """
+    Lines of a remote text file, downloaded as they are read
+    """
+    try:
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8-sig"
+            yield from response.iter_lines(decode_unicode=True)
+    except requests.HTTPError as e:
+        raise DownloadError(f"HTTP {e.response.status_code}") from None
+    except RequestException as e:
+        raise DownloadError(type(e).__name__) from None
+
+
+def parse_amount(value: str) -> float:
+    cleaned = "".join(c for c in value if c.isdigit() or c in ".-")
+    if value.strip().startswith("(") and value.strip().endswith(")"):
+        cleaned = "-" + cleaned
+    return float(cleaned)
+
+
+def parse_import_date(value: str) -> str:
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).strftime("%m/%d/%y")
+        except ValueError:
+            pass
+    raise ValueError(f"invalid date {value}")
+
+
+def import_trx_rows(lines, categories: dict[str, list], accounts: list[str], writer,
+                    default_account: str = None, batch_size=500, progress=None,
+                    progress_interval=3.0) -> ImportResult:
+    """
+    Read transactions from CSV lines and write them with `writer(rows)` in batches.
+    Columns are matched by header name, a signed Amount column can replace Outflow
+    and Inflow. Rows with a bad date or amount or an unknown category or account are
+    skipped. A batch is written once it has `batch_size` rows or `progress_interval`
+    seconds after the previous one, then `progress(imported, skipped)` is called.
+    """
+    reader = csv.reader(lines)
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {field: next((header.index(name) for name in names if name in header), None)
+               for field, names in IMPORT_COLUMNS.items()}
+    if columns["Date"] is None or (columns["Amount"] is None
+                                   and columns["Outflow"] is None and columns["Inflow"] is None):
+        raise ValueError("The CSV needs a Date column and an Amount, Outflow or Inflow column")
+
+    known_categories = {category for group in categories.values()
+                        for category in group}
+    known_accounts = set(accounts)
+    imported = 0
+    skipped = []
+    batch = []
+    written_at = time.monotonic()
+    for line_number, values in enumerate(reader, start=2):
+        if not any(value.strip() for value in values):
+            continue
+
+        def value(field):
+            index = columns[field]
+            return values[index].strip() if index is not None and index < len(values) else ""
+
+        category = value("Category")
+        account = value("Account") or default_account or ""
+        try:
+            date = parse_import_date(value("Date"))
+        except ValueError:
+            skipped.append(f"line {line_number}: invalid date {value('Date')}".rstrip())
+            continue
+        try:
+            if columns["Amount"] is not None:
+                amount = parse_amount(value("Amount"))
+                outflow, inflow = (-amount, "") if amount < 0 else ("", amount)
+            else:
+                outflow = parse_amount(value("Outflow")) if value("Outflow") else ""
+                inflow = parse_amount(value("Inflow")) if value("Inflow") else ""
+        except ValueError:
+            skipped.append(f"line {line_number}: invalid amount")
+            continue
+        if outflow == "" and inflow == "":
+            skipped.append(f"line {line_number}: no amount")
+            continue
+        if category and category not in known_categories:
+            skipped.append(f"line {line_number}: unknown category {category}")
+            continue
+        if account and account not in known_accounts:
+            skipped.append(f"line {line_number}: unknown account {account}")
+            continue
+
+        batch.append([date, outflow, inflow,
+                     category, account, value("Memo")])
+        if len(batch) == batch_size or time.monotonic() - written_at >= progress_interval:
+            writer(batch)
+            imported += len(batch)
+            batch = []
+            written_at = time.monotonic()
+            if progress is not None:
+                progress(imported, len(skipped))
+    if batch:
+        writer(batch)
+        imported += len(batch)
+    return ImportResult(imported, skipped)
+
+
+def import_summary(result: ImportResult, max_lines=10) -> str:
+    lines = [f"✅ Imported {result.imported} transactions"]
+    if result.skipped:
+        lines.append(f"Skipped {len(result.skipped)}:")
+        lines.extend(result.skipped[:max_lines])
+        if len(result.skipped) > max_lines:
+            lines.append(f"... and {len(result.skipped) - max_lines} more")
+    return "\n".join(lines)
+
+
+def when_all(futures: list[Future]) -> Future:
+    """
+    Future resolving with `futures` once every one of them is done
+    """
+    combined = Future()
+    remaining = len(futures)
+    lock = threading.Lock()
+
+    def done(_):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            last = remaining == 0
+        if last:
+            combined.set_result(futures)
+
+    if not futures:
+        combined.set_result(futures)
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+class ReplyEditor:
+    """
+    Runs the callbacks that edit a reply once a queued write is done on threads of
+    its own. Done callbacks run on the thread resolving the future, the Sheets writer
+    or a Splitwise worker, which would otherwise wait on the Bot API.
+    """
+
+    def __init__(self, workers=2):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="reply-edit")
+
+    def when_done(self, future: Future, callback):
+        """
+        Call `callback(future)` on a reply thread once `future` is done
+        """
+        future.add_done_callback(lambda f: self._submit(callback, f))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, callback, future: Future):
+        try:
+            self._executor.submit(self._edit, callback, future)
+        except RuntimeError:
+            # closed at exit, edit from the calling thread
+            self._edit(callback, future)
+
+    @staticmethod
+    def _edit(callback, future: Future):
+        try:
+            callback(future)
+        except Exception as e:
+            di[Logger].error(f"Could not edit reply: {e}")
+
+
+def batch_summary(outcomes: list[tuple[str, Optional[BaseException]]]) -> str:
+    """
+    Summary of a saved batch from (description, error) pairs, error is None when saved
+    """
+    saved = sum(1 for _, error in outcomes if error is None)
+    lines = [f"✅ Saved {saved} of {len(outcomes)} transactions"]
+    for description, error in outcomes:
+        if isinstance(error, WriteDeferred):
+            lines.append(f"⚠️ {description}: not saved yet, it will be retried automatically")
+        elif error is not None:
+            lines.append(f"❌ {description}: not saved, please try again")
+    return "\n".join(lines)
+
+
+class WriteDeferred(Exception):
+    """
+    A write failed but is kept in the outbox and will be sent again
+    """
+
+
+class TransactionQueue:
+    """
+    Write-behind queue for Transactions rows. Pending rows are written together
+    with a single append call once `max_size` rows are waiting or the oldest one
+    has waited `max_delay` seconds. With an outbox every row is journaled when queued.
+    """
+
+    def __init__(self, writer, max_size=20, max_delay=2.0, outbox: Outbox = None):
+        self.writer = writer
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.outbox = outbox
+        self._pending: list[tuple[list[str], Future, str]] = []
+        # spans of the updates that queued the pending rows
+        self._spans = []
+        self._oldest = 0.0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="trx-queue", daemon=True)
+        self._thread.start()
+
+    def put(self, row: list[str], key: str = None) -> Future:
+        """
+        Queue a row, the returned future resolves once the row is written.
+        `key` is the outbox key of a row being replayed.
+        """
+        return self.put_many([row], [key])
+
+    def put_many(self, rows: list[list[str]], keys: list[str] = None) -> Future:
+        """
+        Queue rows to be written by the same append call, the returned future
+        resolves once all of them are written
+        """
+        future = Future()
+        if self._closed:
+            raise RuntimeError("Transaction queue is closed")
+        keys = keys or [None] * len(rows)
+        if self.outbox is not None:
+            # journaled outside the lock, the commit waits for the disk
+            keys = self.outbox.record_many("trx", [{"row": row} for row in rows], keys)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Transaction queue is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            for row, key in zip(rows, keys):
+                self._pending.append((row, future, key))
+            self._spans.append(current_span())
+            self._condition.notify()
+        return future
+
+    def close(self):
+        """
+        Flush whatever is pending and stop the writer thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                while len(self._pending) < self.max_size and not self._closed:
+                    remaining = self._oldest + self.max_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, []
+                spans, self._spans = self._spans, []
+                closed = self._closed
+            if batch:
+                with di[Tracer].batch("sheets write_batch", spans, rows=len(batch)):
+                    self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch: list[tuple[list[str], Future, str]]):
+        rows = [row for row, _, _ in batch]
+        keys = [key for _, _, key in batch]
+
+        def on_claim(first_row: int):
+            # remember where each row goes to check it after a crash
+            if self.outbox is not None:
+                self.outbox.mark(keys, Outbox.sending, [
+                    {"row": first_row + i} for i in range(len(keys))])
+
+        try:
+            self.writer(rows, on_claim)
+        except Exception as e:
+            di[Logger].error(f"Failed to write {len(rows)} transaction(s): {e}")
+            if self.outbox is not None:
+                self.outbox.mark(keys, Outbox.retry)
+                e = WriteDeferred(e)
+            for future in {future for _, future, _ in batch}:
+                future.set_exception(e)
+        else:
+            if self.outbox is not None:
+                self.outbox.mark(keys, Outbox.done)
+            for future in {future for _, future, _ in batch}:
+                future.set_result(len(rows))
+
+
+class ExpenseQueue:
+    """
+    Submits Splitwise expenses from a fixed number of background workers. Rate limits
+    (429), server errors and network failures are retried with exponential backoff,
+    anything else fails the returned future right away. With an outbox every expense
+    is journaled when queued.
+    """
+
+    def __init__(self, submit, workers=2, max_attempts=5, backoff=1.0, max_backoff=60.0,
+                 outbox: Outbox = None):
+        self.submit = submit
+        self.outbox = outbox
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run,
+                             name=f"expense-queue-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, expense: Expense, key: str = None) -> Future:
+        """
+        Queue an expense, the returned future resolves with the created expense.
+        `key` is the outbox key of an expense being replayed.
+        """
+        if self._closed:
+            raise RuntimeError("Expense queue is closed")
+        if self.outbox is not None:
+            key = self.outbox.record("expense", expense_to_dict(expense), key)
+        future = Future()
+        # submitted in the context of the caller so it is traced with its update
+        self._queue.put((expense, future, key, contextvars.copy_context()))
+        return future
+
+    def close(self):
+        """
+        Submit whatever is queued and stop the workers
+        """
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            expense, future, key, context = job
+            context.run(self._submit, expense, future, key)
+
+    def _mark(self, key: str, status: str, result=None):
+        if self.outbox is not None:
+            self.outbox.mark(
+                [key], status, [result] if result is not None else None)
+
+    def _submit(self, expense: Expense, future: Future, key: str = None):
+        for attempt in range(1, self.max_attempts + 1):
+            self._mark(key, Outbox.sending)
+            try:
+                result = self.submit(expense)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt == self.max_attempts:
+                    di[Logger].error(
+                        f"Failed to submit expense after {attempt} attempt(s): {e!r}")
+                    if delay is not None and self.outbox is not None:
+                        self._mark(key, Outbox.retry)
+                        e = WriteDeferred(e)
+                    else:
+                        self._mark(key, Outbox.failed)
+                    future.set_exception(e)
+                    return
+                di[Logger].warning(
+                    f"Submitting expense failed ({e!r}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                self._mark(key, Outbox.done, {"id": result.getId()})
+                future.set_result(result)
+                return
+
+    def retry_delay(self, error: Exception, attempt: int):
+        """
+        Seconds to wait before the next attempt, None when the error is not transient
+        """
+        if isinstance(error, SplitwiseException):
+            status = error.http_status
+            # the SDK stores the status as a one element tuple
+            if isinstance(status, tuple):
+                status = status[0]
+            status = status or 0
+            if status != 429 and status < 500:
+                return None
+            retry_after = error.http_headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        elif not isinstance(error, RequestException):
+            return None
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+
+class OutboxReplayer:
+    """
+    Sends journaled writes again: everything unconfirmed once at startup, then writes
+    deferred by an outage every `interval` seconds. Entries that were sent before are
+    first looked up in Sheets or Splitwise so they are not written twice.
+    """
+
+    def __init__(self, outbox: Outbox, trx_queue: TransactionQueue, expense_queue: ExpenseQueue,
+                 interval=60.0, max_attempts=10):
+        self.outbox = outbox
+        self.trx_queue = trx_queue
+        self.expense_queue = expense_queue
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start replaying, entries left unconfirmed by the previous process are read
+        before returning so they are not confused with the writes queued from now on
+        """
+        entries = self.outbox.entries(
+            [Outbox.pending, Outbox.sending, Outbox.retry])
+        self._thread = threading.Thread(
+            target=self._run, args=(entries,), name="outbox-replay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, entries: list[OutboxEntry]):
+        while not self._stopped.is_set():
+            try:
+                self.replay(entries)
+            except Exception as e:
+                di[Logger].error(f"Outbox replay failed: {e}")
+            self._stopped.wait(self.interval)
+            entries = self.outbox.entries([Outbox.retry])
+
+    def replay(self, entries: list[OutboxEntry]):
+        if not entries:
+            return
+        known_ids = {result["id"] for result in
+                     (entry.result for entry in self.outbox.entries([Outbox.done], "expense"))
+                     if result}
+        known_rows = {result["row"] for result in
+                      (entry.result for entry in self.outbox.entries([Outbox.done], "trx"))
+                      if result}
+        for entry in entries:
+            if entry.attempts >= self.max_attempts:
+                di[Logger].error(
+                    f"Giving up on {entry.kind} {entry.key} after {entry.attempts} attempts: {entry.payload}")
+                self.outbox.mark([entry.key], Outbox.failed)
+            elif entry.kind == "trx":
+                self._replay_trx(entry, known_rows)
+            elif entry.kind == "expense":
+                self._replay_expense(entry, known_ids)
+
+    def _replay_trx(self, entry: OutboxEntry, known_rows: set):
+        row = entry.payload["row"]
+        if entry.result:
+            written_row = find_written_row(
+                di[Spreadsheet], entry.result["row"], row, known_rows)
+            if written_row is not None:
+                known_rows.add(written_row)
+                self.outbox.mark([entry.key], Outbox.done, [{"row": written_row}])
+                return
+        di[Logger].info(f"Replaying transaction {entry.key}")
+        self.outbox.mark([entry.key], Outbox.pending)
+        self.trx_queue.put(row, entry.key)
+
+    def _replay_expense(self, entry: OutboxEntry, known_ids: set):
+        if entry.attempts:
+            expense_id = find_written_expense(
+                di["splitwise"], entry, known_ids)
+            if expense_id is not None:
+                known_ids.add(expense_id)
+                self.outbox.mark([entry.key], Outbox.done, [{"id": expense_id}])
+                return
+        di[Logger].info(f"Replaying expense {entry.key}")
+        self.outbox.mark([entry.key], Outbox.pending)
+        self.expense_queue.put(expense_from_dict(entry.payload), entry.key)
+
+
+class AsyncSheets:
+    """
+    Awaitable access to the Aspire spreadsheet for AsyncTeleBot handlers.
+    gspread calls run on a bounded thread pool so they never block the event loop.
+    """
+
+    def __init__(self, spreadsheet=None, queue: TransactionQueue = None, max_workers=4):
+        self._spreadsheet = spreadsheet
+        self.queue = queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sheets")
+
+    @property
+    def spreadsheet(self):
+        return self._spreadsheet if self._spreadsheet is not None else di[Spreadsheet]
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def append_trx(self, data: list[str]):
+        if self.queue is not None:
+            return await asyncio.wrap_future(self.queue.put(data))
+        return await self.run(append_trx, self.spreadsheet, data)
+
+    async def append_trx_rows(self, rows: list[list[str]]):
+        if self.queue is not None:
+            return await asyncio.wrap_future(self.queue.put_many(rows))
+        return await self.run(append_trx_rows, self.spreadsheet, rows)
+
+    async def load_aspire_config(self) -> AspireConfig:
+        return await self.run(load_aspire_config, self.spreadsheet)
+
+    async def get_accounts(self) -> list[str]:
+        return list((await self.load_aspire_config()).accounts)
+
+    async def get_all_categories(self) -> dict[str, list]:
+        return (await self.load_aspire_config()).categories
 
 
 def separate_callback_data(data):
@@ -126,6 +898,68 @@ def create_calendar(year=None, month=None):
     return types.InlineKeyboardMarkup(keyboard)
 
 
+class CachedMarkup(types.JsonSerializable):
+    """
+    Reply markup serialized once, telebot sends the stored JSON as is
+    """
+
+    def __init__(self, markup: types.InlineKeyboardMarkup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+
+class KeyboardCache:
+    """
+    Inline keyboards built from reference data, serialized once and reused until
+    the reference data changes. Calendars only depend on the month and are kept in an LRU.
+    """
+
+    def __init__(self, calendar_size=24):
+        self.calendar_size = calendar_size
+        self._keyboards: dict[tuple, CachedMarkup] = {}
+        self._calendars: OrderedDict[tuple[int, int],
+                                     CachedMarkup] = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, build) -> CachedMarkup:
+        """
+        Keyboard stored under key, `build` creates the InlineKeyboardMarkup on a miss
+        """
+        markup = self._keyboards.get(key)
+        if markup is not None:
+            return markup
+        generation = self._generation
+        markup = CachedMarkup(build())
+        with self._lock:
+            # skip keyboards built from data replaced while building
+            if generation == self._generation:
+                self._keyboards[key] = markup
+        return markup
+
+    def calendar(self, year=None, month=None) -> CachedMarkup:
+        now = datetime.datetime.now()
+        key = (year or now.year, month or now.month)
+        with self._lock:
+            markup = self._calendars.get(key)
+            if markup is not None:
+                self._calendars.move_to_end(key)
+                return markup
+        markup = CachedMarkup(create_calendar(*key))
+        with self._lock:
+            self._calendars[key] = markup
+            while len(self._calendars) > self.calendar_size:
+                self._calendars.popitem(last=False)
+        return markup
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._keyboards.clear()
+
+
 async def async_process_calendar_selection(call, bot_instance):
     """
     Process the callback_query. This method generates a new calendar if forward or
@@ -144,7 +978,8 @@ async def async_process_calendar_selection(call, bot_instance):
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(pre.year), int(pre.month)),
+            reply_markup=di[KeyboardCache].calendar(
+                int(pre.year), int(pre.month)),
         )
     elif action == "NEXT-MONTH":
         ne = curr + datetime.timedelta(days=31)
@@ -152,7 +987,8 @@ async def async_process_calendar_selection(call, bot_instance):
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(ne.year), int(ne.month)),
+            reply_markup=di[KeyboardCache].calendar(
+                int(ne.year), int(ne.month)),
         )
     else:
         await bot_instance.answer_callback_query(
@@ -179,7 +1015,8 @@ def process_calendar_selection(call, bot_instance):
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(pre.year), int(pre.month)),
+            reply_markup=di[KeyboardCache].calendar(
+                int(pre.year), int(pre.month)),
         )
     elif action == "NEXT-MONTH":
         ne = curr + datetime.timedelta(days=31)
@@ -187,7 +1024,8 @@ def process_calendar_selection(call, bot_instance):
             text=call.message.text,
             chat_id=call.message.chat.id,
             message_id=call.message.id,
-            reply_markup=create_calendar(int(ne.year), int(ne.month)),
+            reply_markup=di[KeyboardCache].calendar(
+                int(ne.year), int(ne.month)),
         )
     else:
         bot_instance.answer_callback_query(
@@ -232,19 +1070,180 @@ def create_account_inline(trx_accounts, action):
     return types.InlineKeyboardMarkup(accs_keyboard)
 
 
-def get_subcategories(categories, name):
-    subcategories = []
-    for category in categories:
-        if category.name == name:
-            subcategories = [
+# currencies offered in the Splitwise currency keyboard
+SW_CURRENCIES = ["USD", "PHP", "KRW", "HKD", "SGD", "IDR", "THB"]
+
+
+class CategoryIndex(NamedTuple):
+    """
+    Lookups over Splitwise categories, built once per refresh. Callback data refers
+    to categories by id so it stays short and unambiguous.
+    """
+    # parent name -> names of its subcategories
+    subcategory_names: dict[str, list[str]]
+    # subcategory name -> Category, the first wins when parents share a name like "Other"
+    subcategories: dict
+    # str(id) -> Category, for callback data
+    parents_by_key: dict
+    subcategories_by_key: dict
+
+    @classmethod
+    def build(cls, categories: list) -> "CategoryIndex":
+        index = cls({}, {}, {}, {})
+        for category in categories:
+            index.parents_by_key[str(category.id)] = category
+            index.subcategory_names[category.name] = [
                 subcategory.name for subcategory in category.subcategories]
-            break
-    return subcategories
+            for subcategory in category.subcategories:
+                index.subcategories.setdefault(subcategory.name, subcategory)
+                index.subcategories_by_key[str(subcategory.id)] = subcategory
+        return index
+
+
+class CacheEntry(NamedTuple):
+    loaded_at: float
+    items: list
+    by_id: dict
+    by_name: dict
+    # only built for categories
+    index: CategoryIndex = None
+
+
+def match_name(hint: str, names) -> Optional[str]:
+    """
+    Name a user typed hint stands for: the name equal to it ignoring case, otherwise
+    the only name starting with it. None if there is no such name.
+    """
+    hint = hint.casefold()
+    names = list(names)
+    for name in names:
+        if name.casefold() == hint:
+            return name
+    matches = [name for name in names if name.casefold().startswith(hint)]
+    return matches[0] if len(matches) == 1 else None
+
+
+class SplitwiseCache:
+    """
+    Splitwise groups, friends, categories and currencies indexed by id and name.
+    Each entity is fetched again once its TTL runs out, a failed fetch keeps serving
+    the stale entry.
+    """
+
+    ttls = {"groups": 600, "friends": 600,
+            "categories": 86400, "currencies": 86400}
+    fetchers = {"groups": "getGroups", "friends": "getFriends",
+                "categories": "getCategories", "currencies": "getCurrencies"}
+
+    def __init__(self, splitwise: Splitwise, ttls: dict[str, float] = None, on_change=None):
+        self.splitwise = splitwise
+        self.ttls = {**self.ttls, **(ttls or {})}
+        # called after an entity is replaced, e.g. to drop keyboards built from it
+        self.on_change = on_change
+        self._entries: dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _index(entity: str, items: list) -> CacheEntry:
+        if entity == "categories":
+            items = sorted(items, key=lambda x: x.name)
+        elif entity == "currencies":
+            items = sorted(
+                (c for c in items if c.code in SW_CURRENCIES), key=lambda x: x.code)
+
+        if entity == "currencies":
+            by_id = {currency.code: currency for currency in items}
+            by_name = by_id
+        elif entity == "friends":
+            by_id = {friend.getId(): friend for friend in items}
+            by_name = {get_friend_full_name(
+                friend): friend for friend in items}
+        else:
+            by_id = {item.id: item for item in items}
+            by_name = {item.name: item for item in items}
+        index = CategoryIndex.build(items) if entity == "categories" else None
+        return CacheEntry(time.monotonic(), items, by_id, by_name, index)
+
+    def seed(self, entity: str, items: list):
+        """
+        Store already fetched items, e.g. from startup or a snapshot
+        """
+        entry = self._index(entity, items)
+        with self._lock:
+            self._entries[entity] = entry
+        if self.on_change is not None:
+            self.on_change()
+
+    def invalidate(self, entity: str = None):
+        with self._lock:
+            if entity is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(entity, None)
+        if self.on_change is not None:
+            self.on_change()
+
+    def refresh(self, entity: str = None):
+        """
+        Fetch entities again right away
+        """
+        for name in [entity] if entity else self.fetchers:
+            self.seed(name, getattr(self.splitwise, self.fetchers[name])())
+
+    def entry(self, entity: str) -> CacheEntry:
+        entry = self._entries.get(entity)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttls[entity]:
+            return entry
+        try:
+            self.refresh(entity)
+        except Exception as e:
+            if entry is None:
+                raise
+            di[Logger].warning(
+                f"Could not refresh Splitwise {entity}, using cached data: {e}")
+            return entry
+        return self._entries[entity]
+
+    def categories(self) -> list:
+        return self.entry("categories").items
+
+    def category(self, name: str = None, key: str = None):
+        entry = self.entry("categories")
+        return entry.index.parents_by_key.get(key) if name is None else entry.by_name.get(name)
 
+    def subcategory(self, name: str = None, key: str = None):
+        index = self.entry("categories").index
+        return index.subcategories_by_key.get(key) if name is None else index.subcategories.get(name)
 
-def get_id_name_mapping(splitwise: Splitwise):
-    friends = splitwise.getFriends()
-    return {friend.getId(): f'{get_friend_full_name(friend)}' for friend in friends}
+    def subcategory_names(self, parent: str = None) -> list[str]:
+        index = self.entry("categories").index
+        return list(index.subcategories) if parent is None else index.subcategory_names.get(parent, [])
+
+    def groups(self) -> list:
+        return [group for group in self.entry("groups").items if group.name != "Non-group expenses"]
+
+    def group(self, id: int = None, name: str = None, key: str = None):
+        entry = self.entry("groups")
+        if key is not None:
+            return entry.by_id.get(int(key)) if key.isdigit() else None
+        return entry.by_id.get(id) if name is None else entry.by_name.get(name)
+
+    def currencies(self) -> list:
+        return self.entry("currencies").items
+
+    def currency(self, code: str):
+        return self.entry("currencies").by_id.get(code)
+
+    def friends(self) -> list:
+        return self.entry("friends").items
+
+
+def get_subcategories(name):
+    return di[SplitwiseCache].subcategory_names(name)
+
+
+def get_id_name_mapping(cache: SplitwiseCache):
+    return {friend.getId(): f'{get_friend_full_name(friend)}' for friend in cache.friends()}
 
 
 def get_friend_full_name(friend):
@@ -252,17 +1251,26 @@ def get_friend_full_name(friend):
     return f'{first_name} {friend.getLastName()}' if friend.getLastName() is not None else first_name
 
 
-def create_expense_object(splitwise: Splitwise, payer_id, payee_id, group_id, categoryName, amount, description):
+def create_expense_object(payer_id, payee_id, group_id, category, amount, description,
+                          currency: str = None, date: str = None):
+    """
+    Build an expense split equally in the selected group, category is a subcategory
+    or the name of one. The currency code defaults to the selected currency, date is
+    mm/dd/yy and defaults to today. The expense is submitted with submit_expense.
+    """
     expense = Expense()
     expense.setCost(amount)
     expense.setDescription(description)
     expense.setGroupId(group_id)
-    category = next(
-        (subcat for c in di["sw_categories"] for subcat in c.subcategories if subcat.name == categoryName), None)
+    if isinstance(category, str):
+        category = di[SplitwiseCache].subcategory(category)
     expense.setCategory(category)
     expense.setGroupId(di["sw_group"].id)
     expense.setSplitEqually(True)
-    expense.setCurrencyCode(di["sw_currency"].code)
+    expense.setCurrencyCode(currency or di["sw_currency"].code)
+    if date:
+        expense.setDate(datetime.datetime.strptime(
+            date, "%m/%d/%y").strftime("%Y-%m-%dT12:00:00Z"))
 
     # payer = ExpenseUser()
     # payer.setId(payer_id)
@@ -276,6 +1284,62 @@ def create_expense_object(splitwise: Splitwise, payer_id, payee_id, group_id, ca
 
     # users = [payer, payee]
     # expense.setUsers(users)
-    expense = splitwise.createExpense(expense)
 
     return expense
+
+
+def expense_to_dict(expense: Expense) -> dict:
+    category = expense.getCategory()
+    return {
+        "cost": expense.getCost(),
+        "description": expense.getDescription(),
+        "group_id": expense.getGroupId(),
+        "category_id": category.getId() if category else None,
+        "currency_code": expense.getCurrencyCode(),
+        "date": expense.getDate(),
+    }
+
+
+def expense_from_dict(data: dict) -> Expense:
+    expense = Expense()
+    expense.setCost(data["cost"])
+    expense.setDescription(data["description"])
+    expense.setGroupId(data["group_id"])
+    if data["category_id"] is not None:
+        category = Category()
+        category.setId(data["category_id"])
+        expense.setCategory(category)
+    expense.setSplitEqually(True)
+    expense.setCurrencyCode(data["currency_code"])
+    if data.get("date"):
+        expense.setDate(data["date"])
+    return expense
+
+
+def find_written_expense(splitwise: Splitwise, entry: OutboxEntry, known_ids: set):
+    """
+    Id of an expense created for a journaled entry that was never confirmed, found by
+    description and cost among the group's expenses created since. None if there is none.
+    """
+    since = datetime.datetime.fromtimestamp(
+        entry.created_at - 300, tz=datetime.timezone.utc)
+    expenses = splitwise.getExpenses(
+        group_id=entry.payload["group_id"],
+        updated_after=since.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        limit=100,
+    )
+    return next(
+        (expense.getId() for expense in expenses
+         if expense.getId() not in known_ids
+         and expense.getDeletedAt() is None
+         and expense.getDescription() == entry.payload["description"]
+         and float(expense.getCost()) == float(entry.payload["cost"])),
+        None
+    )
+
+
+def submit_expense(splitwise: Splitwise, expense: Expense) -> Expense:
+    created, errors = splitwise.createExpense(expense)
+    if errors is not None:
+        raise ValueError(f"Splitwise rejected the expense: {errors.getErrors()}")
+    return created
@@ -1,181 +1,197 @@
+from concurrent.futures import Future
+
 from kink import di
-from kink.errors.service_error import ServiceError
-from splitwise import Splitwise
 from telebot import TeleBot, types
 
-from shared.services import (Action, DateUtil, KeyboardUtil, TextUtil,
-                             TransactionData)
+from shared.services import (Action, CallbackRouter, DateUtil, KeyboardUtil,
+                             Session, TextUtil, resolve_quick_entry, with_session)
 from shared.utils import *
 
 
 def bot_functions(bot_instance: TeleBot):
-    splitwise: Splitwise = di["splitwise"]
-    sw_categories = [category.name for category in di["sw_categories"]]
-    sw_groups = [group.name for group in di["sw_groups"]]
-    sw_currencies = [currency.code for currency in di["sw_currencies"]]
-    sw_subcategories = [subcategory.name for category in di["sw_categories"]
-                        for subcategory in category.subcategories]
+    cache: SplitwiseCache = di[SplitwiseCache]
 
     @bot_instance.message_handler(state="*", commands=["cancel", "q"])
-    def cancel_trx(message: types.Message):
+    @with_session
+    def cancel_trx(message: types.Message, session: Session):
         """
         Clears state and cancel current transaction
         """
-        di[TransactionData].reset()
-        message = di["current_trx_message"]
-        if bot_instance.get_state(di["state"]):
-            bot_instance.delete_state(di["state"])
-        bot_instance.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.id,
-            text="Transaction cancelled.",
-        )
+        cancel_current(session)
+
+    def cancel_current(session: Session):
+        """
+        Clears the session and marks its transaction message as cancelled
+        """
+        message_id = session.message_id
+        session.reset()
+        if message_id is not None:
+            bot_instance.edit_message_text(
+                chat_id=session.chat_id,
+                message_id=message_id,
+                text="Transaction cancelled.",
+            )
+
+    def cancel_previous(session: Session):
+        try:
+            cancel_current(session)
+        except Exception as e:
+            error_msg = getattr(e, "message", repr(e))
+            if "Bad Request: message is not modified" in error_msg:
+                di[Logger].info("Previous transaction was already cancelled.")
 
     # TODO - apply state filtering
-    @bot_instance.callback_query_handler(func=lambda c: c.data in sw_categories)
-    def get_sw_subcategories(call: types.CallbackQuery):
+    @bot_instance.callback_query_handler(func=None, route="sw_cat")
+    @with_session
+    def get_sw_subcategories(call: types.CallbackQuery, session: Session):
+        route, category = di[CallbackRouter].resolve(call)
+        currency = cache.currency(session.trx["Currency"]) if session.trx.get(
+            "Currency") else di["sw_currency"]
         current_group = "<b>{}</b>".format(di["sw_group"].name)
-        currency_used = "<b>{}</b>".format(di["sw_currency"].unit)
-        di["current_trx_message"] = bot_instance.edit_message_text(
+        currency_used = "<b>{}</b>".format(currency.unit)
+        session.message_id = call.message.id
+        bot_instance.edit_message_text(
             chat_id=call.message.chat.id,
             message_id=call.message.id,
             text=f'[{currency_used} in {current_group}] Select subcategory:',
-            reply_markup=KeyboardUtil.create_subcategory_keyboard(call.data),
+            reply_markup=KeyboardUtil.create_subcategory_keyboard(category),
             parse_mode="HTML"
         )
 
     # TODO - apply state filtering
-    @bot_instance.callback_query_handler(func=lambda c: c.data in sw_subcategories)
-    def selected_sw_category(call: types.CallbackQuery):
-        save(call.message, call.data)
+    @bot_instance.callback_query_handler(func=None, route="sw_sub")
+    @with_session
+    def selected_sw_category(call: types.CallbackQuery, session: Session):
+        route, subcategory = di[CallbackRouter].resolve(call)
+        save(call.message, subcategory, session)
 
     # TODO - apply state filtering
-    @bot_instance.callback_query_handler(func=lambda c: c.data in sw_groups)
+    @bot_instance.callback_query_handler(func=None, route="sw_group")
     def selected_sw_group(call: types.CallbackQuery):
-        sw_group = next(
-            (group for group in di["splitwise"].getGroups()
-             if group.name == call.data),
-            None
-        )
+        route, sw_group = di[CallbackRouter].resolve(call)
         di["sw_group"] = sw_group
         bot_instance.reply_to(
-            call.message, f'✅ Transactions will now save to {call.data} group')
+            call.message, f'✅ Transactions will now save to {sw_group.name} group')
 
     # TODO - apply state filtering
-    @bot_instance.callback_query_handler(func=lambda c: c.data in sw_currencies)
+    @bot_instance.callback_query_handler(func=None, route="sw_cur")
     def selected_sw_currency(call: types.CallbackQuery):
-        sw_currency = next(
-            (currency for currency in di["sw_currencies"]
-             if currency.code == call.data),
-            None
-        )
+        route, sw_currency = di[CallbackRouter].resolve(call)
         di["sw_currency"] = sw_currency
         bot_instance.reply_to(
-            call.message, f'✅ Transactions will use {call.data} currency')
+            call.message, f'✅ Transactions will use {sw_currency.code} currency')
 
     @bot_instance.message_handler(state=[Action.outflow, Action.inflow], is_digit=False)
     def invalid_amt(message: types.Message):
         bot_instance.reply_to(message, "Please enter a number")
 
-    def save(message: types.Message, category):
-        bot_instance.set_state(di["state"], Action.quick_end)
-        create_expense_object(splitwise,
-                              di["self_id"], di["friend_id"], di["group_id"], category, di[TransactionData]["Outflow"], di[TransactionData]["Memo"])
-        bot_instance.reply_to(message, "✅ Transaction Saved\n")
+    def save(message: types.Message, category, session: Session):
+        session.state = Action.quick_end
+        expense = create_expense_object(
+            di["self_id"], di["friend_id"], di["group_id"], category, session.trx["Outflow"], session.trx["Memo"],
+            currency=session.trx.get("Currency"), date=session.trx["Date"])
+        future = di[ExpenseQueue].put(expense)
+        reply = bot_instance.reply_to(message, "⏳ Transaction Queued\n")
+        di[ReplyEditor].when_done(future, lambda f: save_done(reply, expense, f))
+
+    def save_done(reply: types.Message, expense, future: Future):
+        """
+        Edit the queued reply once Splitwise confirmed or gave up on the expense
+        """
+        error = future.exception()
+        if error is None:
+            text = "✅ Transaction Saved\n"
+        elif isinstance(error, WriteDeferred):
+            text = "⚠️ Transaction not saved yet, it will be retried automatically\n"
+        else:
+            text = (f"❌ Transaction not saved, please try again\n"
+                    f"{expense.getDescription()}: {expense.getCost()}\n")
+        # the description is user input, send it without markdown parsing
+        bot_instance.edit_message_text(
+            chat_id=reply.chat.id,
+            message_id=reply.id,
+            text=text,
+            parse_mode="",
+        )
 
     @bot_instance.message_handler(commands=["swgroup", "swg"], restrict=True)
-    def set_sw_group(message: types.Message):
+    @with_session
+    def set_sw_group(message: types.Message, session: Session):
         """
         Sets the group where transactions belong to
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
+        cancel_previous(session)
 
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
-
-        bot_instance.set_state(di["state"], Action.sw_set_group)
-        di["current_trx_message"] = bot_instance.send_message(
+        session.state = Action.sw_set_group
+        session.message_id = bot_instance.send_message(
             chat_id=message.chat.id,
             text="Select group:",
-            reply_markup=KeyboardUtil.create_sw_keyboard(
-                sw_groups, column_size=3),
-        )
+            reply_markup=KeyboardUtil.create_sw_group_keyboard(),
+        ).id
 
     @bot_instance.message_handler(commands=["swcurrency", "swc"], restrict=True)
-    def set_sw_currency(message: types.Message):
+    @with_session
+    def set_sw_currency(message: types.Message, session: Session):
         """
         Set which currency to use for transactions
         """
-        try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
-        except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
-
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+        cancel_previous(session)
 
-        bot_instance.set_state(di["state"], Action.sw_set_currency)
-        di["current_trx_message"] = bot_instance.send_message(
+        session.state = Action.sw_set_currency
+        session.message_id = bot_instance.send_message(
             chat_id=message.chat.id,
             text="Select currency:",
-            reply_markup=KeyboardUtil.create_sw_keyboard(
-                sw_currencies, column_size=4),
-        )
+            reply_markup=KeyboardUtil.create_sw_currency_keyboard(),
+        ).id
 
-    @bot_instance.message_handler(regexp="^(A|a)dd(S|s)plit.+$", restrict=True)
-    def expense_trx(message: types.Message):
+    @bot_instance.message_handler(commands=["swrefresh"], restrict=True)
+    def refresh_sw_data(message: types.Message):
         """
-        Add expense transaction using Today's date, Amount and Description
+        Fetch Splitwise groups, friends, categories and currencies again, replacing the cached ones
         """
         try:
-            cancel_trx(di["current_trx_message"])
-        except ServiceError as e:
-            print("No current transaction.")
+            cache.refresh()
         except Exception as e:
-            error_msg = getattr(e, "message", repr(e))
-            if "Bad Request: message is not modified" in error_msg:
-                print("Previous transaction was already cancelled.")
+            di[Logger].error(f"Could not refresh Splitwise data: {e}")
+            bot_instance.reply_to(
+                message, "❌ Could not refresh Splitwise data, please try again")
+            return
+        di["sw_group"] = cache.group(di["sw_group"].id) or di["sw_group"]
+        di["sw_currency"] = cache.currency(
+            di["sw_currency"].code) or di["sw_currency"]
+        bot_instance.reply_to(message, "✅ Splitwise data refreshed")
 
-        di["state"] = message.from_user.id
-        di[TransactionData].reset()
+    @bot_instance.message_handler(regexp="^(A|a)dd(S|s)plit.+$", restrict=True)
+    @with_session
+    def expense_trx(message: types.Message, session: Session):
+        """
+        Add expense transaction from Amount and Description, optionally a date,
+        a currency code before the amount and a subcategory to skip the keyboard
+        """
+        cancel_previous(session)
 
-        result = TextUtil.text_splitter(message.text)
-        del result[0]
-        paramCount = len(result)
-        if paramCount != 2:
-            bot_instance.reply_to(
-                message, f"Expected 2 parameters, received {paramCount}: [{result}]"
-            )
+        try:
+            entry = resolve_quick_entry(TextUtil.parse_quick_entry(message.text))
+        except ValueError as e:
+            bot_instance.reply_to(message, f"❌ {e}", parse_mode="")
             return
-        else:
-            amount, description = result
-            try:
-                amount = float(amount)
-            except ValueError:
-                invalid_amt(message)
-            else:
-                bot_instance.set_state(di["state"], Action.sw_category_list)
-                di[TransactionData]["Date"] = DateUtil.date_today()
-                di[TransactionData]["Outflow"] = amount
-                di[TransactionData]["Memo"] = description
-
-                current_group = "<b>{}</b>".format(di["sw_group"].name)
-                currency_used = "<b>{}</b>".format(di["sw_currency"].unit)
-                di["current_trx_message"] = bot_instance.send_message(
-                    chat_id=message.chat.id,
-                    text=f'[{currency_used} in {current_group}] Select category:',
-                    reply_markup=KeyboardUtil.create_sw_keyboard(
-                        sw_categories),
-                    parse_mode="HTML"
-                )
+        session.trx["Date"] = entry.date or DateUtil.date_today()
+        session.trx["Outflow"] = entry.amount
+        session.trx["Memo"] = entry.memo
+        if entry.currency is not None:
+            session.trx["Currency"] = entry.currency
+        if entry.category is not None:
+            save(message, cache.subcategory(entry.category), session)
+            return
+
+        session.state = Action.sw_category_list
+        currency = cache.currency(session.trx["Currency"]) if session.trx.get(
+            "Currency") else di["sw_currency"]
+        current_group = "<b>{}</b>".format(di["sw_group"].name)
+        currency_used = "<b>{}</b>".format(currency.unit)
+        session.message_id = bot_instance.send_message(
+            chat_id=message.chat.id,
+            text=f'[{currency_used} in {current_group}] Select category:',
+            reply_markup=KeyboardUtil.create_sw_category_keyboard(),
+            parse_mode="HTML"
+        ).id
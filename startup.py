@@ -1,35 +1,54 @@
+import atexit
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
+from typing import Optional
 
 import telebot
 from gspread import Client, Spreadsheet, auth
 from kink import di
 from splitwise import Splitwise
+from splitwise.category import Category
+from splitwise.currency import Currency
+from splitwise.group import Group
 from telebot import TeleBot
 from telebot.async_telebot import AsyncTeleBot
 from telebot.callback_data import CallbackData
 
 import shared.utils
 from app_config import Configuration
-from shared.services import (ActionsCallbackFilter, AsyncActionsCallbackFilter,
-                             AsyncIsDigitFilter, AsyncRestrictAccessFilter,
-                             AsyncStateFilter, BotFactory, ExceptionHandler,
-                             IsDigitFilter, KeyboardUtil, RestrictAccessFilter,
-                             StateFilter, TransactionData)
+from shared.metrics import (Metrics, instrument_sheets, instrument_splitwise,
+                            instrument_telegram)
+from shared.services import (ActionsCallbackFilter, AdminFilter,
+                             AsyncActionsCallbackFilter, AsyncAdminFilter,
+                             AsyncCallbackRouteFilter, AsyncIsDigitFilter,
+                             AsyncRestrictAccessFilter,
+                             AsyncSessionStateFilter, BotFactory,
+                             CallbackRouteFilter, CallbackRouter,
+                             EventLoopThread, ExceptionHandler, IsDigitFilter,
+                             KeyboardUtil, RestrictAccessFilter,
+                             SessionManager, SessionStateFilter,
+                             UpdateDeduplicator, UpdateDispatcher,
+                             UpdateRecorder)
+from shared.profiling import UpdateProfiler, profile_updates
+from shared.storage import Outbox, create_store
+from shared.tracing import Tracer, trace_updates
+from shared.utils import (AsyncSheets, ExpenseQueue, KeyboardCache,
+                          OutboxReplayer, ReplyEditor, SplitwiseCache, TransactionQueue)
 
+# bump when the shape of the reference data changes
+SNAPSHOT_VERSION = 3
 
-def configure_services() -> None:
+
+def configure_services(client: Client = None, splitwise: Splitwise = None) -> None:
     """
-    Setup services into the container for dependency injection
+    Setup services into the container for dependency injection. The Google Sheets
+    and Splitwise clients are created from the configuration unless given, e.g.
+    stand-ins for offline benchmarks.
     """
-    trx_data = {
-        "Date": "",
-        "Outflow": "",
-        "Inflow": "",
-        "Category": "",
-        "Account": "",
-        "Memo": "",
-    }
-
     scope = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/spreadsheets",
@@ -39,6 +58,16 @@ def configure_services() -> None:
 
     di[Logger] = telebot.logger
     di[Configuration] = Configuration().values
+    di[Metrics] = Metrics()
+    di[Tracer] = Tracer(
+        di[Logger],
+        log_spans=di[Configuration]["trace_log"],
+        export_path=di[Configuration]["trace_export_path"],
+        min_duration=di[Configuration]["trace_min_duration"],
+    )
+    observers = [di[Metrics], di[Tracer]] if di[Tracer].enabled else [di[Metrics]]
+    di["observers"] = observers
+    instrument_telegram(*observers)
 
     if di[Configuration]["run_async"]:
         bot_instance = AsyncTeleBot(
@@ -49,10 +78,14 @@ def configure_services() -> None:
         di["bot_instance"] = BotFactory(
             bot_instance=bot_instance,
             restrict_access_filter=AsyncRestrictAccessFilter(),
-            state_filter=AsyncStateFilter(bot_instance),
+            admin_filter=AsyncAdminFilter(),
+            state_filter=AsyncSessionStateFilter(),
             is_digit_filter=AsyncIsDigitFilter(),
             actions_callback_filter=AsyncActionsCallbackFilter(),
+            callback_route_filter=AsyncCallbackRouteFilter(),
         ).create_bot()
+        di[EventLoopThread] = EventLoopThread()
+        atexit.register(di[EventLoopThread].stop, bot_instance)
     else:
         bot_instance = TeleBot(
             token=di[Configuration]["token"],
@@ -63,56 +96,277 @@ def configure_services() -> None:
         di["bot_instance"] = BotFactory(
             bot_instance=bot_instance,
             restrict_access_filter=RestrictAccessFilter(),
-            state_filter=StateFilter(bot_instance),
+            admin_filter=AdminFilter(),
+            state_filter=SessionStateFilter(),
             is_digit_filter=IsDigitFilter(),
             actions_callback_filter=ActionsCallbackFilter(),
+            callback_route_filter=CallbackRouteFilter(),
         ).create_bot()
+    if di[Tracer].enabled:
+        trace_updates(di["bot_instance"], di[Tracer])
+    profile_mode = di[Configuration]["profile_mode"]
+    di[UpdateProfiler] = UpdateProfiler(
+        profile_mode,
+        di[Configuration]["profile_dir"],
+        keep=di[Configuration]["profile_keep"],
+        window=di[Configuration]["profile_window"],
+        interval=di[Configuration]["profile_interval"],
+        logger=di[Logger],
+    ) if profile_mode else None
+    if di[UpdateProfiler] is not None:
+        profile_updates(di["bot_instance"], di[UpdateProfiler])
 
-    di[TransactionData] = TransactionData(trx_data)
+    di[SessionManager] = SessionManager(
+        create_store(di[Configuration]["session_store"]),
+        ttl=di[Configuration]["session_ttl"],
+    )
+    if di[Configuration]["run_async"]:
+        def process_update(update):
+            di[EventLoopThread].run(
+                di["bot_instance"].process_new_updates([update]))
+    else:
+        def process_update(update):
+            di["bot_instance"].process_new_updates([update])
+    di[UpdateDispatcher] = UpdateDispatcher(
+        process_update,
+        workers=di[Configuration]["update_workers"],
+        max_pending=di[Configuration]["update_queue_size"],
+    )
+    atexit.register(di[UpdateDispatcher].close)
+    dedup_store = di[Configuration]["update_dedup_store"]
+    di[UpdateDeduplicator] = UpdateDeduplicator(
+        create_store(dedup_store) if dedup_store else None)
+    record_path = di[Configuration]["update_record_path"]
+    di[UpdateRecorder] = UpdateRecorder(
+        record_path, di[Configuration]["secret"]) if record_path else None
     di[CallbackData] = CallbackData("action_id", prefix="Action")
+    di[CallbackRouter] = CallbackRouter()
     di[KeyboardUtil] = KeyboardUtil()
-    di[Client] = auth.service_account_from_dict(
+    di[KeyboardCache] = KeyboardCache()
+    di[Client] = client or auth.service_account_from_dict(
         di[Configuration]["credentials_json"], scopes=scope
     )
+    instrument_sheets(di[Client], *observers)
 
     di["WEBHOOK_URL_BASE"] = di[Configuration]["webhook_base_url"]
-    spreadsheet = di[Client].open_by_key(di[Configuration]["worksheet_id"])
-    di[Spreadsheet] = spreadsheet
-    trx_categories = shared.utils.get_all_categories(spreadsheet)
-    di["trx_categories"] = trx_categories
-    trx_accounts = [i for s in shared.utils.get_accounts(
-        spreadsheet) for i in s]
-    di["trx_accounts"] = trx_accounts
-    di["groups"] = ["group_sel;" + s for s in trx_categories.keys()]
-    di["categories"] = ["save;" + s for l in trx_categories.values()
-                        for s in l]
-    di["accounts"] = ["acc_sel;" + s for s in trx_accounts]
+    # opened lazily so a snapshot boot does not wait for the spreadsheet metadata
+    di[Spreadsheet] = lambda di: di[Client].open_by_key(
+        di[Configuration]["worksheet_id"])
+    # registered before the queues so it is closed after they are flushed
+    di[ReplyEditor] = ReplyEditor()
+    atexit.register(di[ReplyEditor].close)
+    outbox_path = di[Configuration]["outbox_path"]
+    outbox = Outbox(outbox_path) if outbox_path else None
+    di[TransactionQueue] = TransactionQueue(
+        lambda rows, on_claim: shared.utils.append_trx_rows(
+            di[Spreadsheet], rows, on_claim),
+        max_size=di[Configuration]["trx_batch_size"],
+        max_delay=di[Configuration]["trx_batch_delay"],
+        outbox=outbox,
+    )
+    atexit.register(di[TransactionQueue].close)
+    if di[Configuration]["run_async"]:
+        di[AsyncSheets] = AsyncSheets(queue=di[TransactionQueue])
 
-    di["splitwise"] = Splitwise(
+    di["splitwise"] = splitwise or Splitwise(
         di[Configuration]["splitwise_key"],
         di[Configuration]["splitwise_secret"],
         api_key=di[Configuration]["splitwise_token"],
     )
-    di["self_id"] = di["splitwise"].getCurrentUser().getId()
+    instrument_splitwise(di["splitwise"], *observers)
+    di[SplitwiseCache] = SplitwiseCache(
+        di["splitwise"], on_change=di[KeyboardCache].invalidate)
+    cache = di[SplitwiseCache]
+    di[CallbackRouter].register("sw_cat", lambda key: cache.category(key=key))
+    di[CallbackRouter].register(
+        "sw_sub", lambda key: cache.subcategory(key=key))
+    di[CallbackRouter].register("sw_group", lambda key: cache.group(key=key))
+    di[CallbackRouter].register("sw_cur", cache.currency)
+    di[ExpenseQueue] = ExpenseQueue(
+        lambda expense: shared.utils.submit_expense(di["splitwise"], expense),
+        workers=di[Configuration]["expense_workers"],
+        max_attempts=di[Configuration]["expense_max_attempts"],
+        outbox=outbox,
+    )
+    atexit.register(di[ExpenseQueue].close)
+    if outbox is not None:
+        di[OutboxReplayer] = OutboxReplayer(
+            outbox, di[TransactionQueue], di[ExpenseQueue])
     di["friend_id"] = di[Configuration]["friend_id"]
     di["group_id"] = di[Configuration]["group_id"]
-    sw_categories = di["splitwise"].getCategories()
-    di["sw_categories"] = sorted(sw_categories, key=lambda x: x.name)
-    sw_groups = di["splitwise"].getGroups()
-    di["sw_groups"] = [
-        group for group in sw_groups if group.name != "Non-group expenses"]
-    sw_group = next(
-        (group for group in di["splitwise"].getGroups()
-         if group.id == int(di["group_id"])),
-        None
-    )
-    di["sw_group"] = sw_group
-    sw_currencies = di["splitwise"].getCurrencies()
-    filtered_currencies = [
-        currency for currency in sw_currencies if currency.code in ["USD", "PHP", "KRW", "HKD", "SGD", "IDR", "THB"]]
-    di["sw_currencies"] = sorted(filtered_currencies, key=lambda x: x.code)
-    di["sw_currency"] = next(
-        (currency for currency in sw_currencies
-         if currency.code == "PHP"),
-        None
+
+    snapshot_path = di[Configuration]["snapshot_path"]
+    data = load_snapshot(snapshot_path) if snapshot_path else None
+    if data is not None:
+        apply_reference_data(data)
+        threading.Thread(
+            target=refresh_reference_data, name="reference-refresh", daemon=True
+        ).start()
+    else:
+        data = load_reference_data(di["splitwise"])
+        apply_reference_data(data)
+        if snapshot_path:
+            save_snapshot(snapshot_path, data)
+
+    if outbox is not None:
+        di[OutboxReplayer].start()
+        atexit.register(di[OutboxReplayer].stop)
+
+
+def apply_reference_data(data: dict) -> None:
+    """
+    Publish reference data into the container, keeping the selected Splitwise group and currency
+    """
+    di["reference_data"] = data
+    trx_categories = data["aspire"].categories
+    di["trx_categories"] = trx_categories
+    trx_accounts = list(data["aspire"].accounts)
+    di["trx_accounts"] = trx_accounts
+    router = di[CallbackRouter]
+    router.register("group_sel", {s: s for s in trx_categories.keys()}.get)
+    router.register("save", {s: s for l in trx_categories.values()
+                             for s in l}.get)
+    router.register("acc_sel", {s: s for s in trx_accounts}.get)
+    di[KeyboardCache].invalidate()
+
+    di["self_id"] = data["self_id"]
+    cache = di[SplitwiseCache]
+    cache.seed("categories", data["sw_categories"])
+    cache.seed("groups", data["sw_groups"])
+    cache.seed("currencies", data["sw_currencies"])
+    select_sw_defaults()
+
+
+def select_sw_defaults() -> None:
+    """
+    Resolve the selected Splitwise group and currency against the cache, falling back to the configured group and PHP
+    """
+    cache = di[SplitwiseCache]
+    selected_group = di["sw_group"] if "sw_group" in di else None
+    group_id = selected_group.id if selected_group is not None else int(
+        di["group_id"])
+    di["sw_group"] = cache.group(group_id)
+    selected_currency = di["sw_currency"] if "sw_currency" in di else None
+    currency_code = selected_currency.code if selected_currency is not None else "PHP"
+    di["sw_currency"] = cache.currency(currency_code)
+
+
+def load_reference_data(splitwise: Splitwise) -> dict:
+    """
+    Fetch categories, accounts and Splitwise data concurrently and log how long each source took
+    """
+    timings = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8, thread_name_prefix="startup") as executor:
+        def submit(name, func, *args):
+            return executor.submit(shared.utils.timed, timings, name, func, *args)
+
+        futures = {
+            "self_id": submit("getCurrentUser", lambda: splitwise.getCurrentUser().getId()),
+            "sw_categories": submit("getCategories", splitwise.getCategories),
+            "sw_groups": submit("getGroups", splitwise.getGroups),
+            "sw_currencies": submit("getCurrencies", splitwise.getCurrencies),
+        }
+        # the configuration read needs the spreadsheet metadata first
+        spreadsheet = submit("open_by_key", lambda: di[Spreadsheet]).result()
+        futures["aspire"] = submit(
+            "load_aspire_config", shared.utils.load_aspire_config, spreadsheet)
+        data = {name: future.result() for name, future in futures.items()}
+
+    breakdown = ", ".join(
+        f"{name} {elapsed:.2f}s" for name, elapsed in sorted(timings.items(), key=lambda x: -x[1]))
+    di[Logger].info(
+        f"Reference data loaded in {time.perf_counter() - started:.2f}s ({breakdown})")
+    return data
+
+
+def refresh_reference_data() -> None:
+    """
+    Reload reference data in the background and swap it in only if something changed
+    """
+    try:
+        data = load_reference_data(di["splitwise"])
+    except Exception as e:
+        di[Logger].error(f"Could not refresh reference data: {e}")
+        return
+    if reference_data_to_dict(data) == reference_data_to_dict(di["reference_data"]):
+        di[Logger].info("Reference data snapshot is up to date")
+        return
+    apply_reference_data(data)
+    save_snapshot(di[Configuration]["snapshot_path"], data)
+    di[Logger].info("Reference data refreshed from Sheets and Splitwise")
+
+
+def reference_data_to_dict(data: dict) -> dict:
+    """
+    Plain JSON data of the fields the bot uses, Splitwise objects are not serializable
+    """
+    return {
+        "self_id": data["self_id"],
+        "aspire": {
+            "groups": [[group.name, list(group.categories)] for group in data["aspire"].groups],
+            "accounts": list(data["aspire"].accounts),
+        },
+        "sw_categories": [
+            {"id": category.id, "name": category.name,
+             "subcategories": [{"id": sub.id, "name": sub.name} for sub in category.subcategories]}
+            for category in data["sw_categories"]
+        ],
+        "sw_groups": [{"id": group.id, "name": group.name} for group in data["sw_groups"]],
+        "sw_currencies": [{"currency_code": currency.code, "unit": currency.unit}
+                          for currency in data["sw_currencies"]],
+    }
+
+
+def reference_data_from_dict(data: dict) -> dict:
+    def group(item: dict) -> Group:
+        group = Group()
+        group.id = item["id"]
+        group.name = item["name"]
+        return group
+
+    return {
+        "self_id": data["self_id"],
+        "aspire": shared.utils.AspireConfig(
+            groups=tuple(shared.utils.CategoryGroup(name, tuple(categories))
+                         for name, categories in data["aspire"]["groups"]),
+            accounts=tuple(data["aspire"]["accounts"]),
+        ),
+        "sw_categories": [Category(item) for item in data["sw_categories"]],
+        "sw_groups": [group(item) for item in data["sw_groups"]],
+        "sw_currencies": [Currency(item) for item in data["sw_currencies"]],
+    }
+
+
+def load_snapshot(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        di[Logger].warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+    version = snapshot.get("version") if isinstance(snapshot, dict) else None
+    if version != SNAPSHOT_VERSION:
+        di[Logger].info(f"Ignoring snapshot {path} with version {version}")
+        return None
+    try:
+        return reference_data_from_dict(snapshot["data"])
+    except (KeyError, TypeError, ValueError) as e:
+        di[Logger].warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+
+def save_snapshot(path: str, data: dict) -> None:
+    payload = json.dumps(
+        {"version": SNAPSHOT_VERSION, "saved_at": time.time(),
+         "data": reference_data_to_dict(data)},
+        ensure_ascii=False,
     )
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        di[Logger].warning(f"Could not save snapshot {path}: {e}")
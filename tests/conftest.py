@@ -0,0 +1,42 @@
+import logging
+from logging import Logger
+
+import pytest
+from kink import di
+from splitwise.category import Category
+from splitwise.currency import Currency
+
+from shared.tracing import Tracer
+from shared.utils import SplitwiseCache
+
+CATEGORY_GROUPS = {
+    "Living": ["Rent", "Groceries", "Utilities"],
+    "Transport": ["Fuel", "Commute"],
+    "Fun": ["Dining Out", "Games"],
+}
+SW_CATEGORIES = [
+    {"id": 1, "name": "Food and drink", "subcategories": [
+        {"id": 11, "name": "Groceries"}, {"id": 12, "name": "Dining out"}]},
+    {"id": 2, "name": "Transportation", "subcategories": [
+        {"id": 21, "name": "Taxi"}, {"id": 22, "name": "Parking"}]},
+    {"id": 3, "name": "Uncategorized", "subcategories": [
+        {"id": 31, "name": "General"}]},
+]
+SW_CURRENCIES = [{"currency_code": code, "unit": code} for code in ("PHP", "USD")]
+
+
+@pytest.fixture
+def services():
+    """
+    The services the parser and the write queues look up in the container
+    """
+    di[Logger] = logging.getLogger("tests")
+    di[Tracer] = Tracer(di[Logger])
+    di["trx_categories"] = {group: list(categories) for group, categories in CATEGORY_GROUPS.items()}
+    di["trx_accounts"] = ["Bank", "Cash", "Credit Card"]
+    # seeded entries are fresh, so the cache never calls Splitwise
+    cache = SplitwiseCache(None)
+    cache.seed("categories", [Category(category) for category in SW_CATEGORIES])
+    cache.seed("currencies", [Currency(currency) for currency in SW_CURRENCIES])
+    di[SplitwiseCache] = cache
+    return di
@@ -0,0 +1,33 @@
+from shared.services import UpdateDeduplicator
+from shared.storage import MemoryStore
+
+
+class UnreachableStore(MemoryStore):
+    def add(self, key, value, ttl):
+        raise ConnectionError("Connection refused")
+
+    def delete(self, key):
+        raise ConnectionError("Connection refused")
+
+
+def test_deduplicator_drops_redeliveries():
+    dedup = UpdateDeduplicator(MemoryStore())
+    assert not dedup.seen(1)
+    assert dedup.seen(1)
+    dedup.forget(1)
+    assert not dedup.seen(1)
+    assert not dedup.seen(None)
+
+
+def test_deduplicator_shares_updates_through_the_store():
+    store = MemoryStore()
+    assert not UpdateDeduplicator(store).seen(1)
+    assert UpdateDeduplicator(store).seen(1)
+
+
+def test_deduplicator_without_its_store(services):
+    dedup = UpdateDeduplicator(UnreachableStore())
+    # new updates are processed rather than dropped
+    assert not dedup.seen(1)
+    dedup.forget(1)
+    assert not dedup.seen(1)
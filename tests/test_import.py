@@ -0,0 +1,158 @@
+import io
+
+import pytest
+import requests
+
+import shared.utils
+from shared.utils import (DownloadError, import_summary, import_trx_rows, parse_amount,
+                          parse_import_date, stream_lines)
+
+CATEGORIES = {"Living": ["Rent", "Groceries"], "Fun": ["Dining Out"]}
+ACCOUNTS = ["Bank", "Cash"]
+
+
+def run_import(text: str, **kwargs):
+    batches = []
+    result = import_trx_rows(text.splitlines(), CATEGORIES, ACCOUNTS, batches.append, **kwargs)
+    return result, [row for batch in batches for row in batch]
+
+
+@pytest.mark.parametrize("value, amount", [
+    ("120", 120.0),
+    ("1,200.50", 1200.5),
+    ("₱ 35.25", 35.25),
+    ("-80", -80.0),
+    ("(80.00)", -80.0),
+])
+def test_parse_amount(value, amount):
+    assert parse_amount(value) == amount
+
+
+def test_parse_amount_rejects_text():
+    with pytest.raises(ValueError):
+        parse_amount("n/a")
+
+
+def test_import_outflow_and_inflow_columns():
+    result, rows = run_import(
+        "Date,Outflow,Inflow,Category,Account,Memo\n"
+        "01/02/26,120,,Groceries,Cash,market\n"
+        "01/03/26,,1000,,Bank,salary\n"
+        "01/04/26,,,Rent,Cash,nothing\n")
+    assert result == (2, ["line 4: no amount"])
+    assert rows == [["01/02/26", 120.0, "", "Groceries", "Cash", "market"],
+                    ["01/03/26", "", 1000.0, "", "Bank", "salary"]]
+
+
+def test_import_matches_other_header_names():
+    result, rows = run_import(
+        "Transaction Date, Debit ,Credit,Description\n"
+        "01/02/26,45.50,,coffee\n")
+    assert result.imported == 1
+    assert rows == [["01/02/26", 45.5, "", "", "", "coffee"]]
+
+
+def test_import_signed_amount_column():
+    result, rows = run_import(
+        "date,amount,memo\n"
+        "01/02/26,-120,market\n"
+        "01/03/26,(35.00),refund fee\n"
+        "01/04/26,500,salary\n",
+        default_account="Bank")
+    assert result.imported == 3
+    assert [(row[1], row[2], row[4]) for row in rows] == [
+        (120.0, "", "Bank"), (35.0, "", "Bank"), ("", 500.0, "Bank")]
+
+
+def test_import_skips_invalid_rows():
+    result, rows = run_import(
+        "Date,Amount,Category,Account,Memo\n"
+        "01/02/26,-10,Groceries,Cash,ok\n"
+        "01/02/26,-10,Fuel,Cash,unknown category\n"
+        "01/02/26,-10,Rent,Wallet,unknown account\n"
+        "01/02/26,ten,Rent,Cash,bad amount\n"
+        ",,,,\n")
+    assert result.imported == 1
+    assert result.skipped == ["line 3: unknown category Fuel",
+                              "line 4: unknown account Wallet",
+                              "line 5: invalid amount"]
+    assert [row[5] for row in rows] == ["ok"]
+    assert import_summary(result, max_lines=2).splitlines() == [
+        "✅ Imported 1 transactions", "Skipped 3:",
+        "line 3: unknown category Fuel", "line 4: unknown account Wallet", "... and 1 more"]
+
+
+def test_import_needs_date_and_amount_columns():
+    with pytest.raises(ValueError):
+        run_import("Date,Memo\n01/02/26,lunch\n")
+    with pytest.raises(ValueError):
+        run_import("Amount,Memo\n-10,lunch\n")
+
+
+def test_import_writes_in_batches():
+    batches = []
+    progress = []
+    lines = ["Date,Amount"] + [f"01/02/26,-{i}" for i in range(1, 6)]
+    result = import_trx_rows(lines, CATEGORIES, ACCOUNTS, batches.append, batch_size=2,
+                             progress=lambda imported, skipped: progress.append(imported))
+    assert result.imported == 5
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert progress[:2] == [2, 4]
+
+
+@pytest.mark.parametrize("value, date", [
+    ("01/02/26", "01/02/26"),
+    ("1/2/2026", "01/02/26"),
+    ("2026-01-02", "01/02/26"),
+])
+def test_parse_import_date(value, date):
+    assert parse_import_date(value) == date
+
+
+@pytest.mark.parametrize("value", ["02/30/26", "2026-13-01", "yesterday", ""])
+def test_parse_import_date_rejects_invalid_dates(value):
+    with pytest.raises(ValueError, match="invalid date"):
+        parse_import_date(value)
+
+
+def test_import_skips_invalid_dates():
+    result, rows = run_import(
+        "Date,Amount,Memo\n"
+        "2026-01-02,-10,ok\n"
+        "02/30/26,-10,no such day\n"
+        "soon,-10,not a date\n")
+    assert result.skipped == ["line 3: invalid date 02/30/26", "line 4: invalid date soon"]
+    assert rows == [["01/02/26", 10.0, "", "", "", "ok"]]
+
+
+def test_import_reports_progress_by_time():
+    progress = []
+    lines = ["Date,Amount"] + [f"01/02/26,-{i}" for i in range(1, 4)]
+    result = import_trx_rows(lines, CATEGORIES, ACCOUNTS, lambda rows: None, progress_interval=0,
+                             progress=lambda imported, skipped: progress.append(imported))
+    assert result.imported == 3
+    assert progress == [1, 2, 3]
+
+
+FILE_URL = "https://api.telegram.org/file/bot123:SECRET/documents/file_1.csv"
+
+
+def not_found(url, **kwargs):
+    response = requests.Response()
+    response.status_code = 404
+    response.url = url
+    response.raw = io.BytesIO(b"Not Found")
+    return response
+
+
+def unreachable(url, **kwargs):
+    raise requests.ConnectionError(f"Max retries exceeded with url: {url}")
+
+
+@pytest.mark.parametrize("get, error", [(not_found, "HTTP 404"), (unreachable, "ConnectionError")])
+def test_stream_lines_leaves_the_url_out_of_errors(monkeypatch, get, error):
+    monkeypatch.setattr(shared.utils.requests, "get", get)
+    with pytest.raises(DownloadError) as raised:
+        list(stream_lines(FILE_URL))
+    assert str(raised.value) == error
+    assert raised.value.__cause__ is None and raised.value.__suppress_context__
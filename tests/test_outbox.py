@@ -0,0 +1,226 @@
+import threading
+
+import pytest
+from gspread import Spreadsheet
+from kink import di
+from splitwise.category import Category
+from splitwise.expense import Expense
+
+import shared.utils
+from shared.storage import Outbox
+from shared.utils import (OutboxReplayer, ReplyEditor, RowCursor, TransactionQueue, WriteDeferred,
+                          expense_from_dict, expense_to_dict, find_written_row)
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"))
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item, key=None):
+        self.items.append((item, key))
+
+
+def test_transaction_queue_journals_rows(services, outbox):
+    def writer(rows, on_claim):
+        on_claim(10)
+
+    queue = TransactionQueue(writer, max_size=2, max_delay=1, outbox=outbox)
+    try:
+        futures = [queue.put(["01/02/26", 10]), queue.put(["01/02/26", 20])]
+        assert [future.result(timeout=5) for future in futures] == [2, 2]
+    finally:
+        queue.close()
+    entries = outbox.entries([Outbox.done])
+    assert [(entry.payload, entry.result, entry.attempts) for entry in entries] == [
+        ({"row": ["01/02/26", 10]}, {"row": 10}, 1),
+        ({"row": ["01/02/26", 20]}, {"row": 11}, 1),
+    ]
+
+
+def test_transaction_queue_journals_put_many(services, outbox):
+    queue = TransactionQueue(lambda rows, on_claim: on_claim(10), max_size=2, max_delay=1,
+                             outbox=outbox)
+    try:
+        assert queue.put_many([["01/02/26", 10], ["01/02/26", 20]]).result(timeout=5) == 2
+    finally:
+        queue.close()
+    assert [(entry.payload, entry.result) for entry in outbox.entries([Outbox.done])] == [
+        ({"row": ["01/02/26", 10]}, {"row": 10}),
+        ({"row": ["01/02/26", 20]}, {"row": 11}),
+    ]
+
+
+def test_transaction_queue_defers_failed_writes(services, outbox):
+    def writer(rows, on_claim):
+        raise ConnectionError("Sheets is down")
+
+    queue = TransactionQueue(writer, max_size=1, max_delay=0.01, outbox=outbox)
+    try:
+        with pytest.raises(WriteDeferred):
+            queue.put(["01/02/26", 10]).result(timeout=5)
+    finally:
+        queue.close()
+    [entry] = outbox.entries([Outbox.retry])
+    assert entry.payload == {"row": ["01/02/26", 10]}
+
+
+def test_transaction_queue_without_outbox_fails(services):
+    def writer(rows, on_claim):
+        raise ConnectionError("Sheets is down")
+
+    queue = TransactionQueue(writer, max_size=1, max_delay=0.01)
+    try:
+        with pytest.raises(ConnectionError):
+            queue.put(["01/02/26", 10]).result(timeout=5)
+    finally:
+        queue.close()
+
+
+def test_reply_editor_edits_off_the_writer_thread(services):
+    threads = []
+    editor = ReplyEditor()
+    queue = TransactionQueue(lambda rows, on_claim: None, max_size=1, max_delay=0.01)
+    try:
+        future = queue.put(["01/02/26", 10])
+        editor.when_done(future, lambda f: threads.append(threading.current_thread().name))
+        future.result(timeout=5)
+    finally:
+        queue.close()
+        editor.close()
+    assert len(threads) == 1 and threads[0].startswith("reply-edit")
+
+
+def test_expense_round_trip():
+    expense = Expense()
+    expense.setCost("300.00")
+    expense.setDescription("dinner")
+    expense.setGroupId(5)
+    expense.setCurrencyCode("PHP")
+    category = Category()
+    category.setId(12)
+    expense.setCategory(category)
+    data = expense_to_dict(expense)
+    assert (data["cost"], data["description"], data["group_id"], data["category_id"],
+            data["currency_code"]) == ("300.00", "dinner", 5, 12, "PHP")
+    assert expense_to_dict(expense_from_dict(data)) == data
+
+
+def test_expense_without_category():
+    expense = Expense()
+    expense.setCost("10")
+    data = expense_to_dict(expense)
+    assert data["category_id"] is None
+    assert expense_from_dict(data).getCategory() is None
+
+
+@pytest.fixture
+def replayer(services, outbox):
+    return OutboxReplayer(outbox, RecordingQueue(), RecordingQueue(), max_attempts=3)
+
+
+def test_replayer_queues_unconfirmed_writes(replayer, outbox):
+    trx_key = outbox.record("trx", {"row": ["01/02/26", 10]})
+    expense_key = outbox.record("expense", {"cost": "10", "description": "taxi", "group_id": 5,
+                                            "category_id": 21, "currency_code": "PHP"})
+    outbox.mark([trx_key, expense_key], Outbox.retry)
+    replayer.replay(outbox.entries([Outbox.retry]))
+
+    assert replayer.trx_queue.items == [(["01/02/26", 10], trx_key)]
+    [(expense, key)] = replayer.expense_queue.items
+    assert (expense.getDescription(), expense.getCategory().getId(), key) == \
+        ("taxi", 21, expense_key)
+    # back to pending so the next pass does not queue them again
+    assert outbox.entries([Outbox.retry]) == []
+    assert len(outbox.entries([Outbox.pending])) == 2
+
+
+class SheetRows:
+    """
+    Transactions worksheet answering the range reads of RowCursor
+    """
+
+    def __init__(self, rows: dict[int, list]):
+        self.rows = rows
+
+    def get(self, range_name):
+        first, last = (int(cell.lstrip("ABCDEFGH")) for cell in range_name.split(":"))
+        values = [self.rows.get(row, []) for row in range(first, last + 1)]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+
+@pytest.fixture
+def sheet_rows(monkeypatch):
+    cursor = RowCursor(SheetRows({}))
+    cursor._column, cursor._first_row = "B", 2
+    monkeypatch.setattr(shared.utils, "get_row_cursor", lambda spreadsheet: cursor)
+    di[Spreadsheet] = object()
+    return cursor.worksheet.rows
+
+
+def test_find_written_row(sheet_rows):
+    row = ["01/02/26", 10, "", "Groceries", "Cash", "market"]
+    sheet_rows.update({10: ["01/02/26", "10", "", "Rent", "Cash", "rent"],
+                       14: ["01/02/26", "10", "", "Groceries", "Cash", "market"]})
+    # the append landed four rows below the row it was sent to
+    assert find_written_row(di[Spreadsheet], 10, row, set()) == 14
+    assert find_written_row(di[Spreadsheet], 10, row, {14}) is None
+    assert find_written_row(di[Spreadsheet], 40, row, set()) is None
+    # an empty row never matches, even for a row with no category, account or memo
+    assert find_written_row(di[Spreadsheet], 11, ["01/02/26", 10, "", "", "", ""], set()) is None
+
+
+def test_replayer_skips_rows_already_written(replayer, outbox, sheet_rows):
+    sheet_rows.update({10: ["01/02/26", "10", "", "", "", "taxi"],
+                       13: ["01/02/26", "20", "", "", "", "lunch"]})
+    written = outbox.record("trx", {"row": ["01/02/26", 10, "", "", "", "taxi"]})
+    moved = outbox.record("trx", {"row": ["01/02/26", 20, "", "", "", "lunch"]})
+    lost = outbox.record("trx", {"row": ["01/02/26", 30, "", "", "", "fuel"]})
+    outbox.mark([written, moved, lost], Outbox.sending, [{"row": 10}, {"row": 11}, {"row": 12}])
+    replayer.replay(outbox.entries([Outbox.sending]))
+
+    assert replayer.trx_queue.items == [(["01/02/26", 30, "", "", "", "fuel"], lost)]
+    assert [(entry.key, entry.result) for entry in outbox.entries([Outbox.done])] == [
+        (written, {"row": 10}), (moved, {"row": 13})]
+
+
+def test_replayer_matches_identical_rows_once(replayer, outbox, sheet_rows):
+    sheet_rows.update({10: ["01/02/26", "5", "", "", "", "coffee"]})
+    row = ["01/02/26", 5, "", "", "", "coffee"]
+    first = outbox.record("trx", {"row": row})
+    second = outbox.record("trx", {"row": row})
+    outbox.mark([first, second], Outbox.sending, [{"row": 10}, {"row": 11}])
+    replayer.replay(outbox.entries([Outbox.sending]))
+
+    assert replayer.trx_queue.items == [(row, second)]
+
+
+def test_replayer_finds_expenses_already_created(replayer, outbox, monkeypatch):
+    monkeypatch.setattr(shared.utils, "find_written_expense",
+                        lambda splitwise, entry, known_ids: 4242)
+    di["splitwise"] = object()
+    key = outbox.record("expense", {"cost": "10", "description": "taxi", "group_id": 5,
+                                    "category_id": 21, "currency_code": "PHP"})
+    outbox.mark([key], Outbox.sending)
+    replayer.replay(outbox.entries([Outbox.sending]))
+
+    assert replayer.expense_queue.items == []
+    [entry] = outbox.entries([Outbox.done])
+    assert entry.result == {"id": 4242}
+
+
+def test_replayer_gives_up_after_max_attempts(replayer, outbox):
+    key = outbox.record("trx", {"row": ["01/02/26", 10]})
+    for _ in range(3):
+        outbox.mark([key], Outbox.sending)
+    outbox.mark([key], Outbox.retry)
+    replayer.replay(outbox.entries([Outbox.retry]))
+
+    assert replayer.trx_queue.items == []
+    assert [entry.key for entry in outbox.entries([Outbox.failed])] == [key]
@@ -0,0 +1,104 @@
+import datetime
+import types
+
+import pytest
+
+import shared.services
+from shared.services import QuickEntry, TextUtil
+
+
+class FrozenDateTime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 1, 15, 12, 0, tzinfo=tz)
+
+
+@pytest.fixture
+def january(monkeypatch):
+    monkeypatch.setattr(shared.services, "datetime", types.SimpleNamespace(
+        datetime=FrozenDateTime, date=datetime.date, timedelta=datetime.timedelta))
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("AddExp 120 lunch", QuickEntry("outflow", 120.0, "lunch")),
+    ("addinc 1,200.50 salary", QuickEntry("inflow", 1200.5, "salary")),
+    ("addexp ₱120+35-5 groceries", QuickEntry("outflow", 150.0, "groceries")),
+    ('addexp 80 "coffee with Ana" #Dining @Cash',
+     QuickEntry("outflow", 80.0, "coffee with Ana", category="Dining", account="Cash")),
+    ("addexp 80 coffee Dining", QuickEntry("outflow", 80.0, "coffee", category="Dining")),
+    ("addsplit usd 30 taxi Taxi",
+     QuickEntry("split", 30.0, "taxi", category="Taxi", currency="USD")),
+])
+def test_parse_quick_entry(text, expected):
+    assert TextUtil.parse_quick_entry(text) == expected
+
+
+def test_quick_entry_amounts_keep_their_form():
+    assert type(TextUtil.parse_quick_entry("addexp 120 lunch").amount) is int
+    assert type(TextUtil.parse_quick_entry("addexp 120.00 lunch").amount) is int
+    assert TextUtil.parse_quick_entry("addexp 0.1+0.2 gum").amount == 0.3
+
+
+@pytest.mark.parametrize("amount, text", [
+    (120, "120"), (1200, "1,200"), (1200.5, "1,200.50"), ("35", "35"), (0.3, "0.30")])
+def test_format_amount(amount, text):
+    assert TextUtil.format_amount(amount) == text
+
+
+def test_describe_entry():
+    assert TextUtil.describe_entry(
+        TextUtil.parse_quick_entry("addexp 120 lunch")._asdict()) == "Expense 120 lunch"
+
+
+@pytest.mark.parametrize("text, error", [
+    ("addfoo 10 lunch", "unknown entry addfoo"),
+    ("addexp", "missing amount"),
+    ("addexp ten lunch", "invalid amount ten"),
+    ("addexp 10-20 refund", "amount must be positive"),
+    ("addexp 10", "missing memo"),
+    ('addexp 10 ""', "empty memo"),
+    ('addexp 10 "lunch', "unterminated quote"),
+    ("addexp 10 lunch #Rent #Fuel", "unexpected Fuel"),
+    ("addexp 10 lunch 02/30", "invalid date 02/30"),
+])
+def test_parse_quick_entry_errors(text, error):
+    with pytest.raises(ValueError, match=error):
+        TextUtil.parse_quick_entry(text)
+
+
+@pytest.mark.parametrize("value, date", [
+    ("today", "01/15/26"),
+    ("yesterday", "01/14/26"),
+    ("1/2", "01/02/26"),
+    ("01/15", "01/15/26"),
+    # later than today, so last year
+    ("12/31", "12/31/25"),
+    ("12/31/26", "12/31/26"),
+    ("3/4/2024", "03/04/24"),
+])
+def test_parse_quick_entry_dates(january, value, date):
+    assert TextUtil.parse_quick_entry(f"addexp 10 lunch {value}").date == date
+
+
+def test_parse_quick_entries(services):
+    entries, errors = TextUtil.parse_quick_entries(
+        "addexp 120 lunch #din @cash\n"
+        "\n"
+        "addsplit 300 dinner\n"
+        "addinc abc salary\n"
+        "addexp 10 fuel #Unknown\n"
+        "addexp 40 snacks #Groc")
+    assert [(entry["kind"], entry["amount"], entry["category"], entry["account"])
+            for entry in entries] == [
+        ("outflow", 120.0, "Dining Out", "Cash"),
+        ("split", 300.0, "General", None),
+        ("outflow", 40.0, "Groceries", None),
+    ]
+    assert errors == ["line 4: invalid amount abc", "line 5: unknown category Unknown"]
+
+
+def test_parse_quick_entries_rejects_currencies_outside_splits(services):
+    entries, errors = TextUtil.parse_quick_entries("addexp usd 10 lunch\naddsplit eur 10 taxi")
+    assert entries == []
+    assert errors == ["line 1: currencies are only supported for AddSplit",
+                      "line 2: unknown currency EUR"]
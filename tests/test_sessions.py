@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from kink import di
+
+from shared.services import Action, SessionManager, with_session
+from shared.storage import MemoryStore
+
+
+class CountingStore(MemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get(self, key):
+        self.reads += 1
+        return super().get(key)
+
+
+@pytest.fixture
+def sessions():
+    di[SessionManager] = SessionManager(CountingStore())
+    return di[SessionManager]
+
+
+def message(chat_id=1, user_id=2):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=user_id))
+
+
+@with_session
+def set_state(update, session):
+    session.state = Action.outflow
+    return session
+
+
+def test_handler_reuses_session_loaded_by_filter(sessions):
+    update = message()
+    assert sessions.state(update) is None
+    assert sessions.state(update) is None
+    session = set_state(update)
+    assert sessions.store.reads == 1
+    assert sessions.state(message()) == Action.outflow
+    assert session.state == Action.outflow
+
+
+def test_handler_reloads_session_saved_after_filter(sessions):
+    first, second = message(), message()
+    assert sessions.state(second) is None
+    set_state(first)
+    reads = sessions.store.reads
+
+    @with_session
+    def read_state(update, session):
+        return session.state
+
+    assert read_state(second) == Action.outflow
+    assert sessions.store.reads == reads + 1
+
+
+def test_async_filter_reads_under_session_lock(sessions):
+    async def main():
+        update = message()
+        async with sessions.async_lock(update):
+            check = asyncio.create_task(sessions.async_state(update))
+            await asyncio.sleep(0.01)
+            assert not check.done()
+        return await check
+
+    assert asyncio.run(main()) is None
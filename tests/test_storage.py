@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from benchmarks.redis_standin import RedisHandler, RedisStandin
+from shared.storage import MemoryStore, Outbox, RedisStore, SQLiteStore, create_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore(str(tmp_path / "state.db"))
+
+
+def test_sqlite_store_get_set_delete(store):
+    assert store.get("a") is None
+    store.set("a", {"state": 1, "trx": {"Memo": "lunch"}}, ttl=60)
+    assert store.get("a") == {"state": 1, "trx": {"Memo": "lunch"}}
+    store.set("a", {"state": 2}, ttl=60)
+    assert store.get("a") == {"state": 2}
+    store.delete("a")
+    assert store.get("a") is None
+
+
+def test_sqlite_store_expires_entries(store):
+    store.set("a", {}, ttl=0.05)
+    time.sleep(0.1)
+    assert store.get("a") is None
+
+
+def test_sqlite_store_add(store):
+    assert store.add("update:1", {}, ttl=60)
+    assert not store.add("update:1", {}, ttl=60)
+    store.set("update:2", {}, ttl=-1)
+    assert store.add("update:2", {"again": True}, ttl=60)
+    assert store.get("update:2") == {"again": True}
+
+
+def test_sqlite_store_is_shared_between_connections(tmp_path):
+    first = SQLiteStore(str(tmp_path / "state.db"))
+    second = SQLiteStore(str(tmp_path / "state.db"))
+    first.set("a", {"value": 1}, ttl=60)
+    assert second.get("a") == {"value": 1}
+    assert first.add("b", {}, ttl=60)
+    assert not second.add("b", {}, ttl=60)
+
+
+def test_create_store(tmp_path):
+    assert isinstance(create_store("memory://"), MemoryStore)
+    store = create_store(f"sqlite:///{tmp_path / 'state.db'}")
+    assert isinstance(store, SQLiteStore)
+    store.set("a", {}, ttl=60)
+    assert (tmp_path / "state.db").exists()
+    with pytest.raises(ValueError):
+        create_store("mongodb://localhost")
+
+
+@pytest.fixture
+def redis():
+    server = RedisStandin(password="secret").start()
+    yield server
+    server.stop()
+
+
+def test_redis_store(redis):
+    store = create_store(redis.url.replace("/0", "/2"))
+    assert isinstance(store, RedisStore)
+    store.set("a", {"value": 1}, ttl=60)
+    assert store.get("a") == {"value": 1}
+    assert store.add("b", {}, ttl=60)
+    assert not store.add("b", {}, ttl=60)
+    store.delete("a")
+    assert store.get("a") is None
+    store.set("c", {}, ttl=0.05)
+    time.sleep(0.1)
+    assert store.get("c") is None
+
+
+def test_redis_store_does_not_resend_set_nx(redis, monkeypatch):
+    run = RedisHandler.run
+    dropped = []
+
+    def drop_first_nx_reply(handler, args):
+        reply = run(handler, args)
+        if b"NX" in args and not dropped:
+            dropped.append(args)
+            # the key is set but the reply never reaches the client
+            raise ConnectionError
+        return reply
+
+    monkeypatch.setattr(RedisHandler, "run", drop_first_nx_reply)
+    store = create_store(redis.url)
+    with pytest.raises(ConnectionError):
+        store.add("update:1", {}, ttl=60)
+    assert not store.add("update:1", {}, ttl=60)
+    # idempotent commands are sent again on a new connection
+    store.client._socket.close()
+    store.set("a", {"value": 1}, ttl=60)
+    assert store.get("a") == {"value": 1}
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"))
+
+
+def test_outbox_records_and_marks(outbox):
+    key = outbox.record("trx", {"row": ["01/02/26", 10]})
+    [entry] = outbox.entries([Outbox.pending])
+    assert (entry.key, entry.kind, entry.payload, entry.attempts) == \
+        (key, "trx", {"row": ["01/02/26", 10]}, 0)
+
+    outbox.mark([key], Outbox.sending, [{"row": 7}])
+    [entry] = outbox.entries([Outbox.sending])
+    assert (entry.result, entry.attempts) == ({"row": 7}, 1)
+
+    outbox.mark([key], Outbox.done)
+    [entry] = outbox.entries([Outbox.done], "trx")
+    # the result is kept when none is given
+    assert entry.result == {"row": 7}
+    assert outbox.entries([Outbox.done], "expense") == []
+
+
+def test_outbox_record_many(outbox):
+    keys = outbox.record_many("trx", [{"row": [1]}, {"row": [2]}], [None, "given"])
+    assert keys[1] == "given"
+    assert [entry.payload for entry in outbox.entries([Outbox.pending])] == \
+        [{"row": [1]}, {"row": [2]}]
+
+
+def test_outbox_record_keeps_existing_entries(outbox):
+    key = outbox.record("trx", {"row": [1]})
+    outbox.mark([key], Outbox.done)
+    assert outbox.record("trx", {"row": [2]}, key) == key
+    [entry] = outbox.entries([Outbox.pending, Outbox.done])
+    assert (entry.status, entry.payload) == (Outbox.done, {"row": [1]})
+
+
+def test_outbox_survives_reopening(tmp_path):
+    key = Outbox(str(tmp_path / "outbox.db")).record("expense", {"cost": "10"})
+    [entry] = Outbox(str(tmp_path / "outbox.db")).entries([Outbox.pending])
+    assert entry.key == key